@@ -1,12 +1,17 @@
 """Module which provides flask embed aplication factory"""
 
 import os
+import multiprocessing
 
 from flask import Flask
 import redis
 
 from app import views
-from models import db
+from models import db, ITEM_CHANNEL
+from cache import LRUCache, SingleFlight, InvalidationListener
+from sanitize import sanitizedSize, SANITIZE_CACHE_BYTES
+from manifest import createManifestFactory
+from helper import loadAssets, assetUrl, resetSqlConnection, IIIF_SERVER
 
 
 def app_factory(db_backend=None):
@@ -18,20 +23,42 @@ def app_factory(db_backend=None):
 
 	app.config.update(
 		SERVER_NAME=os.getenv('SERVER_NAME', '127.0.0.1:5000'),
-		IIIF_SERVER=os.getenv('IIIF_SERVER', '127.0.0.1'),
+		IIIF_SERVER=IIIF_SERVER,
 		REDIS_SERVER=os.getenv('REDIS_SERVER', 'localhost'),
 		REDIS_PORT_NUMBER=int(os.getenv('REDIS_PORT_NUMBER', 6379)),
 		DEBUG=os.getenv('DEBUG', False),
 		HOST=os.getenv('HOST', '127.0.0.1'),
 		PORT=int(os.getenv('PORT', 5000)),
-		SQL_DB_URL = os.getenv('SQL_DB_URL', None)
+		SQL_DB_URL = os.getenv('SQL_DB_URL', None),
+		SQL_TIMEOUT=float(os.getenv('SQL_TIMEOUT', 30)),
+		REDIS_MAX_CONNECTIONS=int(os.getenv('REDIS_MAX_CONNECTIONS', max(int(os.getenv('UWSGI_THREADS', 1)), int(os.getenv('UWSGI_GEVENT', 1))) + 2)),
+		REDIS_POOL_TIMEOUT=int(os.getenv('REDIS_POOL_TIMEOUT', 10)),
+		MANIFEST_CACHE_SIZE=int(os.getenv('MANIFEST_CACHE_SIZE', 1024)),
+		MANIFEST_DEBUG=os.getenv('MANIFEST_DEBUG', False),
+		OEMBED_CACHE_SIZE=int(os.getenv('OEMBED_CACHE_SIZE', 4096)),
+		ITEM_CACHE_SIZE=int(os.getenv('ITEM_CACHE_SIZE', 10000)),
+		ITEM_CACHE_TTL=int(os.getenv('ITEM_CACHE_TTL', 300)),
+		SANITIZE_CACHE_BYTES=SANITIZE_CACHE_BYTES,
+		SANITIZE_PROCESSES=int(os.getenv('SANITIZE_PROCESSES', 0)),
+		BULK_ITEMS_LIMIT=int(os.getenv('BULK_ITEMS_LIMIT', 100)),
+		INGEST_PAGE_LIMIT=int(os.getenv('INGEST_PAGE_LIMIT', 1000)),
+		INGEST_STREAM_TIMEOUT=int(os.getenv('INGEST_STREAM_TIMEOUT', 3600)),
+		INGEST_ASYNC=int(os.getenv('INGEST_ASYNC', 0)),
+		BATCH_DIR=os.getenv('BATCH_DIR', '/data/batch')
 	)
 	
+	### Pool of processes which sanitize large ingest batches ###
+	# it is forked before the process opens connections and starts threads, so the processes don't inherit them
+	if app.config['SANITIZE_PROCESSES']:
+		app.extensions['sanitize_pool'] = multiprocessing.Pool(app.config['SANITIZE_PROCESSES'])
+	
 	### Db initialization ###
 	if db_backend:
 		db.init_db(db_backend)
 	else:
-		db.init_db(redis.StrictRedis(host=app.config['REDIS_SERVER'], port=app.config['REDIS_PORT_NUMBER'], db=0))
+		# every thread (or greenlet) of the process takes its own connection from the pool, the pub/sub listener holds one connection permanently
+		pool = redis.BlockingConnectionPool(host=app.config['REDIS_SERVER'], port=app.config['REDIS_PORT_NUMBER'], db=0, max_connections=app.config['REDIS_MAX_CONNECTIONS'], timeout=app.config['REDIS_POOL_TIMEOUT'])
+		db.init_db(redis.StrictRedis(connection_pool=pool))
 
 	if not hasattr(app, 'extensions'):
 		app.extensions = dict()
@@ -40,13 +67,38 @@ def app_factory(db_backend=None):
 		raise ValueError('Already registered config prefix "redis"')
 	
 	app.extensions['redis'] = db
+	
+	### Manifest factory shared by all requests ###
+	app.extensions['manifest_factory'] = createManifestFactory(app.config)
+	
+	### In-process caches ###
+	app.extensions['caches'] = {'manifest': LRUCache(app.config['MANIFEST_CACHE_SIZE']), 'oembed': LRUCache(app.config['OEMBED_CACHE_SIZE']), 'item': LRUCache(app.config['ITEM_CACHE_SIZE'], app.config['ITEM_CACHE_TTL']), 'sanitize': LRUCache(app.config['SANITIZE_CACHE_BYTES'], sizeof=sanitizedSize)}
+	
+	# changes of Items made by other processes are announced via redis pub/sub
+	app.extensions['item_listener'] = InvalidationListener(db, ITEM_CHANNEL, [app.extensions['caches']['item']])
+	
+	if not db_backend:
+		app.extensions['item_listener'].start()
+	app.extensions['manifest_flight'] = SingleFlight()
+
+	### Fingerprinted static files ###
+	app.extensions['assets'] = loadAssets(app.static_folder)
+	app.jinja_env.globals['asset_url'] = assetUrl
+	app.after_request(views.assetHeaders)
+	app.teardown_appcontext(resetSqlConnection)
 
 	### Setting of relation between particular url and view function
 	app.route('/')(views.index)
 	app.route('/<item_id>')(views.iFrame)
 	app.route('/<item_id>/<order>')(views.iFrame)
 	app.route('/<item_id>/manifest.json')(views.iiifMeta)
+	app.route('/batch/<name>/collection.json')(views.batchCollection)
+	app.route('/institution/<name>/collection.json')(views.institutionCollection)
 	app.route('/oembed', methods=['GET'])(views.oEmbed)
+	app.route('/items', methods=['GET', 'POST'])(views.items)
+	app.route('/stats')(views.stats)
 	app.route('/ingest', methods=['GET', 'POST'])(views.ingest)
+	app.route('/ingest/summary')(views.ingestSummary)
+	app.route('/ingest/stream', methods=['POST'])(views.ingestStream)
 
 	return app
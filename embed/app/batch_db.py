@@ -0,0 +1,192 @@
+"""Module which provides sqlite database of ingest batches, their items and archived tasks"""
+
+import sqlite3
+
+import simplejson as json
+
+from db_wrapper import BATCH_SIZE
+
+
+# Count of prepared statements kept by every connection, all statements of this module fit in
+STATEMENT_CACHE_SIZE = 32
+
+SCHEMA = [
+	"CREATE TABLE IF NOT EXISTS Batch (batch_id INTEGER PRIMARY KEY AUTOINCREMENT, batch_data TEXT)",
+	"CREATE TABLE IF NOT EXISTS Task (task_id INTEGER, batch_id INTEGER, item_id VARCHAR(256), status VARCHAR(16), url TEXT, message INTEGER)",
+	"CREATE INDEX IF NOT EXISTS test_index ON Task (batch_id, item_id)",
+	# urls are JSON list, they are NULL for items marked to be deleted
+	"CREATE TABLE IF NOT EXISTS BatchItem (batch_id INTEGER, item_order INTEGER, item_id VARCHAR(256), status VARCHAR(16), urls TEXT, PRIMARY KEY (batch_id, item_order))",
+	"CREATE INDEX IF NOT EXISTS batch_item_id_index ON BatchItem (batch_id, item_id)",
+	"CREATE INDEX IF NOT EXISTS batch_item_status_index ON BatchItem (batch_id, status, item_order)"
+]
+
+SQL_INSERT_BATCH = "INSERT INTO Batch(batch_data) VALUES (NULL)"
+SQL_SELECT_BATCH = "SELECT batch_id FROM Batch WHERE batch_id=?"
+SQL_INSERT_ITEM = "INSERT INTO BatchItem(batch_id, item_order, item_id, status, urls) VALUES (?,?,?,?,?)"
+SQL_SELECT_ITEMS = "SELECT item_order, item_id, status, urls FROM BatchItem WHERE batch_id=? AND item_order>=? ORDER BY item_order LIMIT ?"
+SQL_SELECT_STATUS_ITEMS = "SELECT item_order, item_id, status, urls FROM BatchItem WHERE batch_id=? AND status IN (%s) AND item_order>=? ORDER BY item_order LIMIT ?"
+SQL_UPDATE_ITEM_STATUS = "UPDATE BatchItem SET status=? WHERE batch_id=? AND item_id=?"
+SQL_SELECT_TASKS = "SELECT url, status, message FROM Task WHERE batch_id=? AND item_id=?"
+SQL_COUNT_STATUSES = "SELECT status, COUNT(*) FROM BatchItem WHERE batch_id=? GROUP BY status"
+SQL_COUNT_TASKS = "SELECT COUNT(*) FROM Task WHERE batch_id=?"
+SQL_COUNT_MESSAGES = "SELECT message, COUNT(DISTINCT item_id) FROM Task WHERE batch_id=? AND status='error' GROUP BY message"
+
+
+def connect(path, timeout):
+	"""Function which returns new sqlite connection in WAL mode, so readers don't wait for writers. Connections should be reused, their prepared statements are cached.
+	   'path' - path of the database file
+	   'timeout' - number in seconds for which the connection waits for locks of concurrent writers
+	"""
+
+	conn = sqlite3.connect(path, timeout=timeout, cached_statements=STATEMENT_CACHE_SIZE)
+	# WAL mode is persistent, it is set here for databases created before it was used
+	conn.execute("PRAGMA journal_mode=WAL")
+	# commits in WAL mode are durable after checkpoint, fsync on every commit isn't needed
+	conn.execute("PRAGMA synchronous=NORMAL")
+
+	return conn
+
+
+def createSchema(conn):
+	"""Function which creates tables and indexes which don't exist yet.
+	   'conn' - sqlite connection
+	"""
+
+	for statement in SCHEMA:
+		conn.execute(statement)
+
+	conn.commit()
+
+
+def itemRow(batch_id, order, item_data):
+	"""Function which returns row of BatchItem table for item of batch.
+	   'batch_id' - ID of the batch
+	   'order' - position of the item in the batch
+	   'item_data' - data of the item from the batch
+	"""
+
+	if item_data.get('status') == 'deleted':
+		return (batch_id, order, item_data['id'], 'deleted', None)
+
+	return (batch_id, order, item_data['id'], 'pending', json.dumps(item_data['url']))
+
+
+def insertBatch(conn, batch_data):
+	"""Function which stores new batch with its items in one transaction and returns ID of the batch.
+	   'conn' - sqlite connection
+	   'batch_data' - list of items of the batch, items of streamed batch are added later by insertBatchItems
+	"""
+
+	c = conn.cursor()
+	c.execute(SQL_INSERT_BATCH)
+	batch_id = c.lastrowid
+	insertBatchItems(conn, batch_id, batch_data)
+	conn.commit()
+
+	return batch_id
+
+
+def insertBatchItems(conn, batch_id, batch_data, start=0):
+	"""Function which stores items of batch, it doesn't commit.
+	   'conn' - sqlite connection
+	   'batch_id' - ID of the batch
+	   'batch_data' - list of items
+	   'start' - position of the first item in the batch
+	"""
+
+	for i in range(0, len(batch_data), BATCH_SIZE):
+		conn.executemany(SQL_INSERT_ITEM, [itemRow(batch_id, order, item_data) for order, item_data in enumerate(batch_data[i:i + BATCH_SIZE], start + i)])
+
+
+def batchExists(conn, batch_id):
+	"""Function which returns True if batch is stored.
+	   'conn' - sqlite connection
+	   'batch_id' - ID of the batch
+	"""
+
+	return conn.execute(SQL_SELECT_BATCH, (batch_id,)).fetchone() is not None
+
+
+def batchItems(conn, batch_id, cursor=0, limit=BATCH_SIZE, statuses=None):
+	"""Function which returns list of tuples (position, item data, status) of items of batch ordered by their position.
+	   'conn' - sqlite connection
+	   'batch_id' - ID of the batch
+	   'cursor' - position of the first returned item
+	   'limit' - maximal count of returned items
+	   'statuses' - list of statuses, only items with one of them are returned, all items are returned if it is None
+	"""
+
+	if statuses is None:
+		rows = conn.execute(SQL_SELECT_ITEMS, (batch_id, cursor, limit))
+	else:
+		rows = conn.execute(SQL_SELECT_STATUS_ITEMS % ','.join('?' * len(statuses)), [batch_id] + list(statuses) + [cursor, limit])
+
+	output = []
+
+	for order, item_id, item_status, urls in rows:
+		if urls is None:
+			output.append((order, {'id': item_id, 'status': 'deleted'}, item_status))
+		else:
+			output.append((order, {'id': item_id, 'url': json.loads(urls)}, item_status))
+
+	return output
+
+
+def iterBatchItems(conn, batch_id):
+	"""Function which returns generator of tuples (position, item data, status) of all items of batch. Items are loaded in chunks of BATCH_SIZE items.
+	   'conn' - sqlite connection
+	   'batch_id' - ID of the batch
+	"""
+
+	cursor = 0
+
+	while True:
+		chunk = batchItems(conn, batch_id, cursor)
+
+		for row in chunk:
+			yield row
+
+		if len(chunk) < BATCH_SIZE:
+			return
+
+		cursor = chunk[-1][0] + 1
+
+
+def itemTasks(conn, batch_id, item_id):
+	"""Function which returns list of tuples (url, status, message) of archived tasks of item of batch.
+	   'conn' - sqlite connection
+	   'batch_id' - ID of the batch
+	   'item_id' - ID of the item
+	"""
+
+	return conn.execute(SQL_SELECT_TASKS, (batch_id, item_id)).fetchall()
+
+
+def updateItemStatuses(conn, batch_id, statuses):
+	"""Function which stores final statuses of items of batch, it doesn't commit.
+	   'conn' - sqlite connection
+	   'batch_id' - ID of the batch
+	   'statuses' - dictionary with IDs of items and their statuses
+	"""
+
+	conn.executemany(SQL_UPDATE_ITEM_STATUS, [(status, batch_id, item_id) for item_id, status in statuses.items()])
+
+
+def batchSummary(conn, batch_id):
+	"""Function which returns dictionary with counts of items of batch by their status and counts of archived tasks, and dictionary with counts of items with error messages of archived tasks, or None if the batch doesn't exist. Items whose tasks weren't archived by compact.py yet are counted as pending.
+	   'conn' - sqlite connection
+	   'batch_id' - ID of the batch
+	"""
+
+	if not batchExists(conn, batch_id):
+		return None
+
+	summary = {'total': 0, 'pending': 0, 'ok': 0, 'error': 0, 'deleted': 0}
+
+	for status, count in conn.execute(SQL_COUNT_STATUSES, (batch_id,)):
+		summary[status] = count
+		summary['total'] += count
+
+	summary['tasks'] = summary['tasks_finished'] = conn.execute(SQL_COUNT_TASKS, (batch_id,)).fetchone()[0]
+
+	return summary, dict(conn.execute(SQL_COUNT_MESSAGES, (batch_id,)).fetchall())
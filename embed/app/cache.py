@@ -0,0 +1,196 @@
+"""Module which provides in-process caches shared by requests of one embed process"""
+
+import sys
+import time
+import threading
+import traceback
+from collections import OrderedDict
+
+
+class LRUCache():
+	"""Class which provides bounded thread-safe cache with least recently used eviction.
+	'maxsize' - maximal count of entries kept in the cache or maximal total size of entries if sizeof is set
+	'ttl' - number of seconds after which entries expire, entries never expire if it is None
+	'sizeof' - function which returns size of entry from its key and value, every entry has size 1 if it is None
+	"""
+
+	def __init__(self, maxsize=1024, ttl=None, sizeof=None):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.sizeof = sizeof
+		self.data = OrderedDict()
+		self.size = 0
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, default=None):
+		"""Method for getting of cached value, which is marked as recently used.
+		   'key' - unique key to cache
+		   'default' - value which is returned if the key is not cached
+		"""
+
+		with self.lock:
+			try:
+				value, expires, size = self.data.pop(key)
+			except KeyError:
+				self.misses += 1
+				return default
+
+			if expires is not None and expires < time.time():
+				self.size -= size
+				self.misses += 1
+				return default
+
+			self.data[key] = (value, expires, size)
+			self.hits += 1
+
+			return value
+
+	def set(self, key, value):
+		"""Method for storing of value to cache, the least recently used entry is evicted if the cache is full.
+		   'key' - unique key to cache
+		   'value' - value which have to be cached
+		"""
+
+		if self.ttl is None:
+			expires = None
+		else:
+			expires = time.time() + self.ttl
+
+		if self.sizeof is None:
+			size = 1
+		else:
+			size = self.sizeof(key, value)
+
+		with self.lock:
+			self.discard(key)
+			self.data[key] = (value, expires, size)
+			self.size += size
+
+			while self.size > self.maxsize:
+				self.size -= self.data.popitem(last=False)[1][2]
+
+	def discard(self, key):
+		"""Method for removing of entry and its size from cache, the lock has to be held by the caller.
+		   'key' - unique key to cache
+		"""
+
+		entry = self.data.pop(key, None)
+
+		if entry is not None:
+			self.size -= entry[2]
+
+	def delete(self, key):
+		"""Method for removing of value from cache.
+		   'key' - unique key to cache
+		"""
+
+		with self.lock:
+			self.discard(key)
+
+	def clear(self):
+		"""Method for removing of all values from cache"""
+
+		with self.lock:
+			self.data.clear()
+			self.size = 0
+
+	def stats(self):
+		"""Method which returns dictionary with size and hit/miss counters of cache"""
+
+		with self.lock:
+			total = self.hits + self.misses
+
+			if total:
+				ratio = float(self.hits) / total
+			else:
+				ratio = 0.0
+
+			return {'size': self.size, 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses, 'hit_ratio': ratio}
+
+
+class SingleFlight():
+	"""Class which collapses concurrent calls with the same key into one call. Callers which come while the call is running wait for its result."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.calls = {}
+
+	def do(self, key, fn, *args):
+		"""Method which calls function only once for all concurrent callers with the same key and returns its result to all of them.
+		   'key' - key identifying the call
+		   'fn' - function which have to be called
+		   'args' - arguments for the function
+		"""
+
+		with self.lock:
+			call = self.calls.get(key, None)
+
+			if call is None:
+				call = {'event': threading.Event(), 'result': None, 'error': None}
+				self.calls[key] = call
+				leader = True
+			else:
+				leader = False
+
+		if not leader:
+			call['event'].wait()
+
+			if call['error'] is not None:
+				raise call['error'][0], call['error'][1], call['error'][2]
+
+			return call['result']
+
+		try:
+			call['result'] = fn(*args)
+		except:
+			call['error'] = sys.exc_info()
+			raise
+		finally:
+			with self.lock:
+				self.calls.pop(key, None)
+
+			call['event'].set()
+
+		return call['result']
+
+
+class InvalidationListener(threading.Thread):
+	"""Class which provides thread listening on redis pub/sub channel. Keys published to the channel are removed from the caches, so the caches of all embed processes stay coherent.
+	'db' - database wrapper
+	'channel' - name of pub/sub channel
+	'caches' - list of caches whose entries are invalidated
+	"""
+
+	def __init__(self, db, channel, caches):
+		threading.Thread.__init__(self, name='invalidation-%s' % channel)
+		self.daemon = True
+		self.db = db
+		self.channel = channel
+		self.caches = caches
+
+	def invalidate(self, key):
+		"""Method for removing of key from all caches.
+		   'key' - key which have to be removed
+		"""
+
+		for cache in self.caches:
+			cache.delete(key)
+
+	def run(self):
+		while True:
+			try:
+				pubsub = self.db.pubsub()
+				pubsub.subscribe(self.channel)
+
+				# messages could be missed while the listener wasn't subscribed
+				for cache in self.caches:
+					cache.clear()
+
+				for message in pubsub.listen():
+					if message['type'] == 'message':
+						self.invalidate(message['data'])
+			except:
+				print 'Invalidation listener of channel "%s" failed:\n%s' % (self.channel, traceback.format_exc())
+				time.sleep(1)
@@ -0,0 +1,143 @@
+"""Module which provides indexes of Items and paged IIIF collections of ingest batches and institutions"""
+
+import os
+import time
+
+from flask import url_for
+from flask import current_app as app
+import simplejson as json
+
+from models import db, Item
+
+
+# Count of manifests on one page of collection
+COLLECTION_PAGE_SIZE = int(os.getenv('COLLECTION_PAGE_SIZE', 100))
+# Count of Items loaded from redis in one round-trip while the page is streamed
+COLLECTION_CHUNK_SIZE = 50
+
+
+def indexItem(batch_id, item, old_item=None, pipe=None):
+	"""Function which adds finalized Item to indexes of its batch and its institution. Items keep their position in the indexes when they are finalized again, so paging of harvesters isn't shifted.
+	   'batch_id' - ID of Batch which finalized the Item, the Item is indexed only in its institution if it is None
+	   'item' - finalized Item
+	   'old_item' - previous version of the Item or None
+	   'pipe' - Pipeline to which the commands are queued, they are sent immediately if it is None
+	"""
+
+	if pipe is None:
+		pipe = db
+
+	score = time.time()
+
+	if batch_id is not None:
+		pipe.zadd(collectionIndex('batch', batch_id), {item.id: score}, nx=True)
+		# batches of the Item are needed to remove it from their indexes when it is deleted
+		pipe.sadd('collection@batches@%s' % item.id, batch_id)
+
+	if old_item and old_item.institution != item.institution:
+		pipe.zrem(collectionIndex('institution', old_item.institution), item.id)
+
+	if item.institution:
+		pipe.zadd(collectionIndex('institution', item.institution), {item.id: score}, nx=True)
+
+
+def collectionIndex(kind, name):
+	"""Function which returns key of index of collection.
+	   'kind' - kind of collection, 'batch' or 'institution'
+	   'name' - ID of batch or name of institution
+	"""
+
+	return 'collection@%s@%s' % (kind, name)
+
+
+def renderCollection(view, kind, name, label):
+	"""Function which returns serialized top level IIIF collection with links to its pages or None if the collection is empty.
+	   'view' - name of view function of the collection
+	   'kind' - kind of collection, 'batch' or 'institution'
+	   'name' - ID of batch or name of institution
+	   'label' - label of the collection
+	"""
+
+	total = db.zcard(collectionIndex(kind, name))
+
+	if not total:
+		return None
+
+	fac = app.extensions['manifest_factory']
+
+	coll = fac.collection(ident=collectionUrl(view, name), label=label)
+	coll.total = total
+	coll.first = collectionUrl(view, name, 0)
+	coll.last = collectionUrl(view, name, (total - 1) / COLLECTION_PAGE_SIZE)
+
+	return json.dumps(coll.toJSON(top=True))
+
+
+def streamCollectionPage(view, kind, name, label, page):
+	"""Function which returns generator of serialized page of IIIF collection or None if there is no such page. Items of the page are loaded in chunks while the page is streamed.
+	   'view' - name of view function of the collection
+	   'kind' - kind of collection, 'batch' or 'institution'
+	   'name' - ID of batch or name of institution
+	   'label' - label of the collection
+	   'page' - number of the page
+	"""
+
+	if page < 0:
+		return None
+
+	start = page * COLLECTION_PAGE_SIZE
+	item_ids = db.zrange(collectionIndex(kind, name), start, start + COLLECTION_PAGE_SIZE)
+
+	if not item_ids:
+		return None
+
+	fac = app.extensions['manifest_factory']
+
+	coll = fac.collection(ident=collectionUrl(view, name, page), label=label)
+	coll.within = collectionUrl(view, name)
+	coll.startIndex = start
+
+	if page > 0:
+		coll.prev = collectionUrl(view, name, page - 1)
+
+	# one more member is loaded to find out whether the next page exists
+	if len(item_ids) > COLLECTION_PAGE_SIZE:
+		coll.next = collectionUrl(view, name, page + 1)
+		item_ids = item_ids[:COLLECTION_PAGE_SIZE]
+
+	header = json.dumps(coll.toJSON(top=True))
+
+	def generate():
+		# manifests are appended to the serialized header without its closing bracket
+		yield header[:-1] + ', "manifests": ['
+
+		count = 0
+
+		for i in range(0, len(item_ids), COLLECTION_CHUNK_SIZE):
+			for item in Item.load_many(item_ids[i:i + COLLECTION_CHUNK_SIZE]):
+				# Items deleted after their batch was finished are skipped
+				if item is None:
+					continue
+
+				if count:
+					yield ', '
+
+				yield json.dumps({'@id': url_for('iiifMeta', item_id=item.id, _external=True), '@type': 'sc:Manifest', 'label': item.title or item.id})
+				count += 1
+
+		yield ']}'
+
+	return generate()
+
+
+def collectionUrl(view, name, page=None):
+	"""Function which returns url of collection or of its page.
+	   'view' - name of view function of the collection
+	   'name' - ID of batch or name of institution
+	   'page' - number of the page, url of top level collection is returned if it is None
+	"""
+
+	if page is None:
+		return url_for(view, name=name, _external=True)
+
+	return url_for(view, name=name, page=page, _external=True)
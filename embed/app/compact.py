@@ -0,0 +1,139 @@
+"""Module which archives tasks of finished ingest batches from redis to sqlite and then removes the batches from redis, so status requests only read and redis doesn't grow with every ingest"""
+
+import os
+import time
+
+import simplejson as json
+
+from models import db, Task
+from db_wrapper import BATCH_SIZE
+from batch_db import batchExists, iterBatchItems, updateItemStatuses
+from ingest import batchItemStatus
+
+
+# Number in seconds after which counters of finished tasks of items are removed from redis
+COMPACT_COUNTER_TTL = int(os.getenv('COMPACT_COUNTER_TTL', 86400))
+
+
+def compactItems(conn, batch_id, item_ids):
+	"""Function which moves tasks of items of Batch from redis to sqlite and stores final statuses of the items in one transaction. Tasks of items which aren't finished are kept in redis. It returns count of archived tasks.
+	   'conn' - sqlite connection
+	   'batch_id' - ID of the Batch
+	   'item_ids' - IDs of items of the Batch
+	"""
+
+	tasks = Task.get_items_tasks(batch_id, item_ids)
+	finished = [item_tasks for item_tasks in tasks.values() if item_tasks and 'pending' not in [task.status for task in item_tasks]]
+	# unchanged items are finished by the planner without tasks, deleted items have their status since the start
+	untasked = [item_id for item_id in item_ids if not tasks.get(item_id)]
+	planned = {}
+
+	for item_id, stored in zip(untasked, db.hmget('batch@id@%s@finished' % batch_id, untasked) if untasked else []):
+		if stored is not None and json.loads(stored)['status'] == 'ok':
+			planned[item_id] = 'ok'
+
+	if planned:
+		updateItemStatuses(conn, batch_id, planned)
+		conn.commit()
+
+	if not finished:
+		return 0
+
+	c = conn.cursor()
+	# rows of interrupted compaction are replaced, so the compaction can be repeated
+	c.executemany("DELETE FROM Task WHERE batch_id=? AND item_id=?", [(batch_id, item_tasks[0].item_id) for item_tasks in finished])
+	c.executemany("INSERT INTO Task VALUES (?,?,?,?,?,?)", [(task.task_id, task.batch_id, task.item_id, task.status, task.url, task.message) for item_tasks in finished for task in item_tasks])
+	# the last task of item has all its data
+	updateItemStatuses(conn, batch_id, dict((item_tasks[0].item_id, batchItemStatus(item_tasks[-1].item_data, [(task.url, task.status, task.message) for task in item_tasks])['status']) for item_tasks in finished))
+	conn.commit()
+
+	# redis keys are removed only after the tasks are committed to sqlite
+	db.delete_many([task.key() for item_tasks in finished for task in item_tasks])
+
+	with db.pipeline() as pipe:
+		for item_tasks in finished:
+			pipe.expire('batch@id@%s@item@id%s@finished' % (batch_id, item_tasks[0].item_id), COMPACT_COUNTER_TTL)
+
+	return sum(len(item_tasks) for item_tasks in finished)
+
+
+def compactBatch(conn, batch_id, item_ids=None):
+	"""Function which moves tasks of finished items of Batch from redis to sqlite in transactions of BATCH_SIZE items. It returns count of archived tasks.
+	   'conn' - sqlite connection
+	   'batch_id' - ID of the Batch
+	   'item_ids' - IDs of items of the Batch, they are read from index of the Batch if it is None
+	"""
+
+	count = 0
+
+	if item_ids is not None:
+		for i in range(0, len(item_ids), BATCH_SIZE):
+			count += compactItems(conn, batch_id, item_ids[i:i + BATCH_SIZE])
+
+		return count
+
+	start = 0
+
+	while True:
+		chunk = db.zrange('batch@id@%s@items' % batch_id, start, start + BATCH_SIZE - 1)
+
+		if not chunk:
+			return count
+
+		count += compactItems(conn, batch_id, chunk)
+		start += BATCH_SIZE
+
+
+def expireBatch(batch_id):
+	"""Function which sets expiration of counters, indexes and stored statuses of items of compacted Batch in redis. They aren't needed when all items are archived, the Batch is read from sqlite after they are removed.
+	   'batch_id' - ID of the Batch
+	"""
+
+	with db.pipeline() as pipe:
+		for key in ['summary', 'items', 'finished', 'status@pending', 'status@ok', 'status@error', 'status@deleted']:
+			pipe.expire('batch@id@%s@%s' % (batch_id, key), COMPACT_COUNTER_TTL)
+
+
+def finishedBatches():
+	"""Function which returns IDs of Batches without pending items and unfinished tasks, whose tasks weren't archived yet and to which no items are streamed. Deleted items aren't pending since the start of their Batch, so their tasks are checked by the counter of finished tasks."""
+
+	batch_ids = [int(key.split('@')[2]) for key in db.scan_iter('batch@id@*@summary')]
+
+	with db.pipeline() as pipe:
+		for batch_id in batch_ids:
+			pipe.hmget('batch@id@%s@summary' % batch_id, ['pending', 'tasks', 'tasks_finished'])
+			pipe.exists('batch@id@%s@compacted' % batch_id)
+			# items of streamed batch are still added
+			pipe.exists('batch@id@%s@open' % batch_id)
+
+		values = pipe.execute()
+
+	return sorted(batch_id for batch_id, (pending, tasks, tasks_finished), compacted, opened in zip(batch_ids, values[0::3], values[1::3], values[2::3]) if int(pending or 0) <= 0 and int(tasks_finished or 0) >= int(tasks or 0) and not compacted and not opened)
+
+
+def compactFinishedBatches(conn):
+	"""Function which archives tasks of all finished Batches and marks the Batches as compacted. Their keys in redis are removed after COMPACT_COUNTER_TTL, so redis doesn't grow with every ingested item. It returns dictionary with IDs of compacted Batches and counts of their archived tasks.
+	   'conn' - sqlite connection
+	"""
+
+	output = {}
+
+	for batch_id in finishedBatches():
+		output[batch_id] = compactBatch(conn, batch_id)
+		expireBatch(batch_id)
+		# the mark expires together with the summary, so the Batch isn't found by finishedBatches again
+		db.setnx('batch@id@%s@compacted' % batch_id, json.dumps(time.time()), COMPACT_COUNTER_TTL)
+
+	return output
+
+
+def batchItemIds(conn, batch_id):
+	"""Function which returns IDs of items of Batch stored in sqlite or None if there is no such Batch. It is needed for Batches started before their indexes were introduced.
+	   'conn' - sqlite connection
+	   'batch_id' - ID of the Batch
+	"""
+
+	if not batchExists(conn, batch_id):
+		return None
+
+	return [item['id'] for order, item, status in iterBatchItems(conn, batch_id)]
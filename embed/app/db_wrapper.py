@@ -1,25 +1,188 @@
 """Module which provides wrapper for database. It can wraps redis and fakeredis for testing"""
 
+import os
+import zlib
+
 import redis
 import fakeredis
+import simplejson as json
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+from exceptions import UnsupportedDbBackend, UnsupportedCodec
 
-from exceptions import UnsupportedDbBackend
+
+# Version bytes which prefix encoded records, records without the version byte are JSON
+VERSION_MSGPACK = '\x01'
+VERSION_MSGPACK_ZLIB = '\x02'
+
+# Maximal count of keys sent to database in one command or in one round-trip of pipeline
+BATCH_SIZE = 1000
+
+
+class RecordCodec():
+	"""Class which provides encoding of records (dictionaries) stored in database. Records of all versions can be decoded regardless of the codec used for encoding.
+	'name' - codec used for encoding, it can be 'json' or 'msgpack'
+	'compress_size' - size in bytes from which msgpack records are compressed by zlib
+	"""
+	
+	def __init__(self, name='json', compress_size=1024):
+		if name not in ('json', 'msgpack'):
+			raise UnsupportedCodec('%s record codec is not allowed' % name)
+		if name == 'msgpack' and msgpack is None:
+			raise UnsupportedCodec('msgpack record codec requires msgpack package')
+		
+		self.name = name
+		self.compress_size = compress_size
+	
+	def encode(self, record):
+		"""Method which returns record encoded for storing in database.
+		   'record' - dictionary which have to be encoded
+		"""
+		
+		if self.name == 'json':
+			return json.dumps(record)
+		
+		data = msgpack.packb(record, use_bin_type=False)
+		
+		if len(data) >= self.compress_size:
+			return VERSION_MSGPACK_ZLIB + zlib.compress(data)
+		else:
+			return VERSION_MSGPACK + data
+	
+	def decode(self, data):
+		"""Method which returns record decoded from data stored in database.
+		   'data' - encoded record
+		"""
+		
+		if data[0] == VERSION_MSGPACK:
+			return msgpack.unpackb(data[1:], raw=False)
+		elif data[0] == VERSION_MSGPACK_ZLIB:
+			return msgpack.unpackb(zlib.decompress(data[1:]), raw=False)
+		else:
+			return json.loads(data)
+
+
+class Pipeline():
+	"""Class which queues commands of database backend and sends them to database in one round-trip. It can be used as context manager, then queued commands are executed at the end of the block unless an exception was raised.
+	'backend' - database backend
+	'codec' - RecordCodec used for records
+	'flush_size' - count of queued commands after which they are executed automatically, results of such commands are discarded, so it is usable only for writes
+	'transaction' - if it is True, queued commands are executed atomically
+	"""
+	
+	def __init__(self, backend, codec, flush_size=None, transaction=False):
+		self.pipe = backend.pipeline(transaction=transaction)
+		self.codec = codec
+		self.flush_size = flush_size
+		self.decoders = []
+	
+	def __getattr__(self, name):
+		command = getattr(self.pipe, name)
+		
+		def queue(*args, **kwargs):
+			command(*args, **kwargs)
+			self.queued(None)
+			
+			return self
+		
+		return queue
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.execute()
+		else:
+			self.pipe.reset()
+			self.decoders = []
+	
+	def queued(self, decoder):
+		self.decoders.append(decoder)
+		
+		if self.flush_size and len(self.decoders) >= self.flush_size:
+			self.execute()
+	
+	def get_record(self, key):
+		"""Method which queues getting of decoded record, its result is None if there is no record.
+		   'key' - unique key to database
+		"""
+		
+		self.pipe.get(key)
+		self.queued(self.decode)
+		
+		return self
+	
+	def set_record(self, key, record):
+		"""Method which queues setting of record encoded by the codec.
+		   'key' - unique key to database
+		   'record' - dictionary which have to be pushed to database
+		"""
+		
+		self.pipe.set(key, self.codec.encode(record))
+		self.queued(None)
+		
+		return self
+	
+	def decode(self, data):
+		if not data:
+			return None
+		
+		return self.codec.decode(data)
+	
+	def execute(self):
+		"""Method which sends queued commands to database and returns list with their results"""
+		
+		values = self.pipe.execute()
+		decoders = self.decoders
+		self.decoders = []
+		
+		return [decoder(value) if decoder else value for decoder, value in zip(decoders, values)]
 
 
 class DatabaseWrapper():
-	"""Class which provides wrapper for database and can be used to instantiate database itself"""
+	"""Class which provides wrapper for database and can be used to instantiate database itself. Its methods can be called by concurrent threads, the backend takes a connection from its pool for every command."""
 	
-	def init_db(self, backend=None):
+	def init_db(self, backend=None, codec=None):
 		"""Method for initialization of database wrapper.
 		   'backend' - desired backend for database, it can be redis or fakeredis for testing
+		   'codec' - RecordCodec used for records, it is configured by RECORD_CODEC environment variable by default
 		"""
 		
 		if not isinstance(backend, redis.StrictRedis) and not isinstance(backend, fakeredis.FakeStrictRedis):
 			raise UnsupportedDbBackend('%s database backend is not allowed' % backend)
 		self.backend = backend
 		
+		if codec is None:
+			codec = RecordCodec(os.getenv('RECORD_CODEC', 'json'), int(os.getenv('RECORD_COMPRESS_SIZE', 1024)))
+		self.codec = codec
+		
 		return self
 	
+	def get_record(self, key):
+		"""Method for getting of decoded record from database by unique key. It returns None if there is no record.
+		   'key' - unique key to database
+		"""
+		
+		data = self.backend.get(key)
+		
+		if not data:
+			return None
+		
+		return self.codec.decode(data)
+	
+	def set_record(self, key, record):
+		"""Method for setting of record encoded by the codec to database by unique key.
+		   'key' - unique key to database
+		   'record' - dictionary which have to be pushed to database
+		"""
+		
+		return self.backend.set(key, self.codec.encode(record))
+	
 	def get(self, key):
 		"""Method for getting of data from database by unique key.
 		   'key' - unique key to database
@@ -35,12 +198,162 @@ class DatabaseWrapper():
 		
 		return self.backend.set(key, data)
 	
+	def mget(self, keys):
+		"""Method for getting of data of several keys from database in one round-trip (one per BATCH_SIZE keys). Value of missing key is None.
+		   'keys' - list of unique keys to database
+		"""
+		
+		values = []
+		
+		for i in range(0, len(keys), BATCH_SIZE):
+			values.extend(self.backend.mget(keys[i:i + BATCH_SIZE]))
+		
+		return values
+	
+	def mset(self, data):
+		"""Method for setting of data of several keys to database in one round-trip (one per BATCH_SIZE keys).
+		   'data' - dictionary with unique keys to database and data which have to be pushed to database
+		"""
+		
+		items = data.items()
+		
+		for i in range(0, len(items), BATCH_SIZE):
+			self.backend.mset(dict(items[i:i + BATCH_SIZE]))
+	
+	def get_records(self, keys):
+		"""Method for getting of decoded records of several keys from database. Value of missing key is None.
+		   'keys' - list of unique keys to database
+		"""
+		
+		return [self.codec.decode(data) if data else None for data in self.mget(keys)]
+	
+	def set_records(self, records):
+		"""Method for setting of records of several keys encoded by the codec to database.
+		   'records' - dictionary with unique keys to database and records which have to be pushed to database
+		"""
+		
+		self.mset(dict((key, self.codec.encode(record)) for key, record in records.items()))
+	
+	def delete_many(self, keys):
+		"""Method for deleting of data of several keys from database in one round-trip (one per BATCH_SIZE keys).
+		   'keys' - list of unique keys to database
+		"""
+		
+		count = 0
+		
+		for i in range(0, len(keys), BATCH_SIZE):
+			count += self.backend.delete(*keys[i:i + BATCH_SIZE])
+		
+		return count
+	
+	def pipeline(self, flush_size=None, transaction=False):
+		"""Method which returns Pipeline. Commands queued in the pipeline are sent to database in one round-trip by its execute method or at the end of with block.
+		   'flush_size' - count of queued commands after which they are executed automatically, it is usable only for writes
+		   'transaction' - if it is True, the commands are executed atomically
+		"""
+		
+		return Pipeline(self.backend, self.codec, flush_size, transaction)
+	
+	def hget(self, key, field):
+		"""Method for getting of one field of hash from database.
+		   'key' - unique key to database
+		   'field' - field of the hash
+		"""
+		
+		return self.backend.hget(key, field)
+	
+	def hmget(self, key, fields):
+		"""Method for getting of several fields of hash from database. Value of missing field is None.
+		   'key' - unique key to database
+		   'fields' - list of fields of the hash
+		"""
+		
+		return self.backend.hmget(key, fields)
+	
+	def hgetall(self, key):
+		"""Method for getting of whole hash from database as dictionary.
+		   'key' - unique key to database
+		"""
+		
+		return self.backend.hgetall(key)
+	
+	def replace_hashes(self, hashes):
+		"""Method for atomic replacing of whole hashes in database. Hash with empty dictionary is deleted.
+		   'hashes' - dictionary with unique keys to database and dictionaries with fields of the hashes
+		"""
+		
+		pipe = self.backend.pipeline(transaction=True)
+		
+		for key, fields in hashes.items():
+			pipe.delete(key)
+			
+			if fields:
+				pipe.hmset(key, fields)
+		
+		return pipe.execute()
+	
+	def hsetnx(self, key, field, data):
+		"""Method for setting of one field of hash in database only if the field doesn't exist yet. It returns True if the field was set.
+		   'key' - unique key to database
+		   'field' - field of the hash
+		   'data' - data which have to be stored in the field
+		"""
+		
+		return bool(self.backend.hsetnx(key, field, data))
+	
+	def hincrby(self, key, field, amount=1):
+		"""Method for atomically increasing of numerical field of hash in database. Missing field is counted from zero.
+		   'key' - unique key to database
+		   'field' - field of the hash
+		   'amount' - number which is added to the field, it can be negative
+		"""
+		
+		return self.backend.hincrby(key, field, amount)
+	
+	def setnx(self, key, data, expire):
+		"""Method for setting of data to database only if the key doesn't exist yet. It is needed for implementation of locks.
+		   'key' - unique key to database
+		   'data' - data which have to be pushed to database and be reachable by key
+		   'expire' - number of seconds after which the key is removed from database
+		"""
+		
+		return self.backend.set(key, data, ex=expire, nx=True)
+	
+	def expire(self, key, expire):
+		"""Method for setting of number of seconds after which the key is removed from database.
+		   'key' - unique key to database
+		   'expire' - number of seconds
+		"""
+		
+		return self.backend.expire(key, expire)
+	
 	def delete(self, key):
 		"""Method for deleting of data from database by unique key.
 		   'key' - unique key to database
 		"""
 		
 		return self.backend.delete(key)
+	
+	def delete_if_equal(self, key, data):
+		"""Method for atomically deleting of data from database only if they are equal to the provided data. It is needed for releasing of lock which could expire and be taken by another process. It returns True if the data were deleted.
+		   'key' - unique key to database
+		   'data' - expected data reachable by key
+		"""
+		
+		with self.backend.pipeline() as pipe:
+			try:
+				# the transaction fails if the key is changed after it is read
+				pipe.watch(key)
+				
+				if pipe.get(key) != data:
+					return False
+				
+				pipe.multi()
+				pipe.delete(key)
+				
+				return bool(pipe.execute()[0])
+			except redis.WatchError:
+				return False
 		
 	def incr(self, key, default):
 		"""Method for atomically increasing numerical data in database. It is needed for implementation of counters.
@@ -49,3 +362,107 @@ class DatabaseWrapper():
 		"""
 		
 		return self.backend.incr(key, default)
+	
+	def lrange(self, key, start, end):
+		"""Method for getting of items of list in database, both positions are inclusive.
+		   'key' - unique key to database
+		   'start' - position of the first returned item
+		   'end' - position of the last returned item
+		"""
+		
+		return self.backend.lrange(key, start, end)
+	
+	def ltrim(self, key, start, end):
+		"""Method for keeping of only items of list in database between the positions, both positions are inclusive.
+		   'key' - unique key to database
+		   'start' - position of the first kept item
+		   'end' - position of the last kept item
+		"""
+		
+		return self.backend.ltrim(key, start, end)
+	
+	def sadd(self, key, member):
+		"""Method for adding of member to set in database.
+		   'key' - unique key to database
+		   'member' - member which have to be added
+		"""
+		
+		return self.backend.sadd(key, member)
+	
+	def smembers(self, key):
+		"""Method which returns members of set in database, it is empty if there is no such set.
+		   'key' - unique key to database
+		"""
+		
+		return self.backend.smembers(key)
+	
+	def zadd(self, key, members, nx=False):
+		"""Method for adding of members to sorted set in database.
+		   'key' - unique key to database
+		   'members' - dictionary with members and their scores
+		   'nx' - if it is True, scores of members already in the set aren't updated
+		"""
+		
+		return self.backend.zadd(key, members, nx=nx)
+	
+	def zrem(self, key, member):
+		"""Method for removing of member from sorted set in database.
+		   'key' - unique key to database
+		   'member' - member which have to be removed
+		"""
+		
+		return self.backend.zrem(key, member)
+	
+	def zrange(self, key, start, end):
+		"""Method for getting of members of sorted set ordered by score, both positions are inclusive.
+		   'key' - unique key to database
+		   'start' - position of the first returned member
+		   'end' - position of the last returned member
+		"""
+		
+		return self.backend.zrange(key, start, end)
+	
+	def zrangebyscore(self, key, min_score, count):
+		"""Method for getting of members of sorted set with score from the minimal score ordered by score. It returns list of tuples (member, score).
+		   'key' - unique key to database
+		   'min_score' - minimal score of returned members
+		   'count' - maximal count of returned members
+		"""
+		
+		return self.backend.zrangebyscore(key, min_score, '+inf', start=0, num=count, withscores=True)
+	
+	def zscore(self, key, member):
+		"""Method which returns score of member of sorted set or None if it isn't in the set.
+		   'key' - unique key to database
+		   'member' - member of the sorted set
+		"""
+		
+		return self.backend.zscore(key, member)
+	
+	def zcard(self, key):
+		"""Method which returns count of members of sorted set in database.
+		   'key' - unique key to database
+		"""
+		
+		return self.backend.zcard(key)
+	
+	def publish(self, channel, message):
+		"""Method for publishing of message to pub/sub channel.
+		   'channel' - name of channel
+		   'message' - message which have to be published
+		"""
+		
+		return self.backend.publish(channel, message)
+	
+	def pubsub(self):
+		"""Method which returns new pub/sub object which can subscribe to channels"""
+		
+		return self.backend.pubsub(ignore_subscribe_messages=True)
+	
+	def scan_iter(self, match, count=BATCH_SIZE):
+		"""Method which iterates over keys in database matching the pattern without blocking of database.
+		   'match' - glob-style pattern of keys
+		   'count' - count of keys checked by database in one round-trip
+		"""
+		
+		return self.backend.scan_iter(match=match, count=count)
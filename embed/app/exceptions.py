@@ -9,6 +9,9 @@ class ErrorItemImport(Exception):
 class UnsupportedDbBackend(Exception):
 	pass
 
+class UnsupportedCodec(Exception):
+	pass
+
 class ErrorImageIdentify(Exception):
 	pass
 
@@ -2,35 +2,125 @@
 
 import os
 import math
+import gzip
+import hashlib
+import threading
+from cStringIO import StringIO
+from datetime import datetime
+from collections import OrderedDict
 
 import boto
+import simplejson as json
 from flask import current_app as app
+from flask import request, url_for
+from flask.json import htmlsafe_dumps
+from werkzeug.http import http_date
 
 from exceptions import WrongCloudSearchService
+from models import db, Item
+from batch_db import connect
 
 S3_HOST = os.getenv('S3_HOST', '')
 S3_DEFAULT_BUCKET = os.getenv('S3_DEFAULT_BUCKET', '')
 CLOUDSEARCH_REGION = os.getenv('CLOUDSEARCH_REGION', '')
+# Base url of IIIF server, the application config and the ingest worker use this one value
+IIIF_SERVER = os.getenv('IIIF_SERVER', '127.0.0.1')
+# Responses smaller than this number of bytes aren't compressed
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
 
+# sqlite connections of threads, sqlite connection can't be shared by threads
+sql_local = threading.local()
 
-def prepareTileSources(item, url, order):
-	"""Function which returns item with properly formated data for IIIF zooming.
+
+def getItem(item_id, fields=None):
+	"""Function which returns Item from the in-process cache or loads it from database. Returned Item is shared by requests and must not be modified.
+	   'item_id' - ID of requested Item
+	   'fields' - list of Item's fields which are needed, other fields are loaded lazily if the Item isn't cached
+	"""
+	
+	cache = app.extensions['caches']['item']
+	item = cache.get(item_id)
+	
+	if item is None:
+		item = Item(item_id, fields=fields)
+		
+		# only whole Items are cached, partially loaded Item would load missing fields in other requests
+		if not item.partial:
+			cache.set(item_id, item)
+	
+	return item
+
+
+def getItems(item_ids):
+	"""Function which returns list of Items from the in-process cache, Items which aren't cached are loaded from database in one round-trip. Missing Items are None.
+	   'item_ids' - list of IDs of requested Items
+	"""
+	
+	cache = app.extensions['caches']['item']
+	items = [cache.get(item_id) for item_id in item_ids]
+	missing = [item_id for item_id, item in zip(item_ids, items) if item is None]
+	
+	if missing:
+		loaded = dict(zip(missing, Item.load_many(missing)))
+		
+		for item_id, item in loaded.items():
+			if item is not None:
+				cache.set(item_id, item)
+		
+		items = [item or loaded[item_id] for item_id, item in zip(item_ids, items)]
+	
+	return items
+
+
+def itemSummary(item):
+	"""Function which returns dictionary with metadata of Item and sizes of its images for bulk lookups.
+	   'item' - Item whose metadata have to be returned
+	"""
+	
+	summary = OrderedDict()
+	summary['id'] = item.id
+	
+	for field in ['title', 'creator', 'source', 'institution', 'institution_link', 'license', 'description', 'timestamp']:
+		summary[field] = getattr(item, field)
+	
+	summary['images'] = [OrderedDict([('url', url), ('width', item.image_meta.get(url, {}).get('width')), ('height', item.image_meta.get(url, {}).get('height'))]) for url in item.url]
+	
+	return summary
+
+
+def getItemTimestamp(item_id):
+	"""Function which returns timestamp of Item from the in-process cache or from database without loading of whole Item.
+	   'item_id' - ID of requested Item
+	"""
+	
+	item = app.extensions['caches']['item'].get(item_id)
+	
+	if item is None:
+		return Item.get_timestamp(item_id)
+	
+	return item.timestamp or None
+
+
+def prepareTileSources(item, url, order, iiif_server):
+	"""Function which returns descriptor of image with properly formated data for IIIF zooming.
 	   'item' - item whose data have to be formated
 	   'url' - base url of processed image
 	   'order' - order number of specified image
+	   'iiif_server' - base url of IIIF server
 	"""
 	
 	if order == 0:
 		filename = item.id
 	else:
 		filename = '%s/%s' % (item.id, order)
+	
+	tile_source = dict(item.image_meta[url])
+	tile_source['@context'] = 'http://iiif.io/api/image/2/context.json'
+	tile_source['@id'] = 'http://%s/%s' % (iiif_server, filename)
+	tile_source['protocol'] = 'http://iiif.io/api/image'
+	tile_source['profile'] = ['http://iiif.io/api/image/2/level1.json', {'formats': ['jpg'], 'qualities': ['native', 'color', 'gray'], 'supports': ['regionByPct', 'sizeByForcedWh', 'sizeByWh', 'sizeAboveFull', 'rotationBy90s', 'mirroring', 'gray']}]
 		
-	item.image_meta[url]['@context'] = 'http://iiif.io/api/image/2/context.json'
-	item.image_meta[url]['@id'] = 'http://%s/%s' % (app.config['IIIF_SERVER'], filename)
-	item.image_meta[url]['protocol'] = 'http://iiif.io/api/image'
-	item.image_meta[url]['profile'] = ['http://iiif.io/api/image/2/level1.json', {'formats': ['jpg'], 'qualities': ['native', 'color', 'gray'], 'supports': ['regionByPct', 'sizeByForcedWh', 'sizeByWh', 'sizeAboveFull', 'rotationBy90s', 'mirroring', 'gray']}]
-		
-	num_resolutions = math.log(max(item.image_meta[url]['width'], item.image_meta[url]['height']) / 256.0, 2)
+	num_resolutions = math.log(max(tile_source['width'], tile_source['height']) / 256.0, 2)
 		
 	num_resolutions = int(math.ceil(num_resolutions))
 		
@@ -39,11 +129,202 @@ def prepareTileSources(item, url, order):
 	for i in range(1, num_resolutions + 1):
 		scaleFactors.append(int(math.pow(2.0, i)))
 		
-	item.image_meta[url]['tiles'] = [{'width' : 256, 'height' : 256, 'scaleFactors': scaleFactors}]
+	tile_source['tiles'] = [{'width' : 256, 'height' : 256, 'scaleFactors': scaleFactors}]
+	
+	tile_source.pop('url', None)
+	
+	return tile_source
+
+
+def storeTileSources(item, iiif_server):
+	"""Function which serializes descriptors of all Item's images for IIIF zooming and stores them to database. It returns list of serialized descriptors.
+	   'item' - item whose descriptors have to be stored
+	   'iiif_server' - base url of IIIF server, IIIF_SERVER in the ingest worker and IIIF_SERVER of application config in the embed application, so stored descriptors are reused by getTileSources
+	"""
+	
+	tile_sources = [htmlsafe_dumps(prepareTileSources(item, url, order, iiif_server)) for order, url in enumerate(item.url)]
+	
+	db.set('tile_sources@%s' % item.id, '\n'.join([item.timestamp, iiif_server] + tile_sources))
+	
+	return tile_sources
+
+
+def getTileSources(item, order, iiif_server):
+	"""Function which returns serialized list of descriptors for IIIF zooming, ready to be inserted into the viewer page. Descriptors are computed and stored if they aren't stored yet or they are outdated.
+	   'item' - item whose descriptors have to be returned
+	   'order' - order number of specified image or -1 for all images
+	   'iiif_server' - base url of IIIF server
+	"""
+	
+	data = db.get('tile_sources@%s' % item.id)
+	tile_sources = None
+	
+	if data:
+		data = data.split('\n')
+		
+		if data[0] == item.timestamp and data[1] == iiif_server and len(data) == len(item.url) + 2:
+			tile_sources = data[2:]
+	
+	if tile_sources is None:
+		tile_sources = storeTileSources(item, iiif_server)
+	
+	if order == -1:
+		return '[%s]' % ', '.join(tile_sources)
+	else:
+		return '[%s]' % tile_sources[order]
+
+
+def cacheHeaders(item_id, timestamp, variant):
+	"""Function which returns ETag and Last-Modified headers for representation of Item derived from Item's timestamp. Empty dictionary is returned if the timestamp is unknown.
+	   'item_id' - ID of Item
+	   'timestamp' - timestamp of Item's last change
+	   'variant' - string which distinguishes representations of the same Item
+	"""
+	
+	if not timestamp:
+		return {}
+	
+	headers = {'ETag': '"%s"' % hashlib.sha1('%s\n%s\n%s' % (item_id, timestamp, variant)).hexdigest()}
+	
+	try:
+		headers['Last-Modified'] = http_date(datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ'))
+	except ValueError:
+		pass
+	
+	return headers
+
+
+def isNotModified(headers):
+	"""Function which checks If-None-Match and If-Modified-Since headers of request against the representation's headers.
+	   'headers' - dictionary with ETag and Last-Modified headers of the representation
+	"""
+	
+	if not headers:
+		return False
+	
+	if request.headers.get('If-None-Match'):
+		return request.if_none_match.contains_weak(headers['ETag'].strip('"'))
+	
+	if request.if_modified_since and headers.has_key('Last-Modified'):
+		last_modified = datetime.strptime(headers['Last-Modified'], '%a, %d %b %Y %H:%M:%S GMT')
+		return last_modified <= request.if_modified_since.replace(tzinfo=None)
+	
+	return False
+
+
+def getSqlConnection():
+	"""Function which returns sqlite connection of current thread. The connection is opened by the first request of the thread and reused by its following requests, so statements prepared by it are reused too. Connection to previously configured database is closed when SQL_DB_URL is changed. Connections of concurrent threads wait for locks held by each other instead of failing."""
+	
+	if getattr(sql_local, 'path', None) != app.config['SQL_DB_URL']:
+		closeSqlConnection()
+	
+	if getattr(sql_local, 'connection', None) is None:
+		sql_local.connection = connect(app.config['SQL_DB_URL'], app.config['SQL_TIMEOUT'])
+		sql_local.path = app.config['SQL_DB_URL']
+	
+	return sql_local.connection
+
+
+def closeSqlConnection():
+	"""Function which closes sqlite connection of current thread if it is open"""
+	
+	if getattr(sql_local, 'connection', None) is not None:
+		sql_local.connection.close()
+	
+	sql_local.connection = None
+	sql_local.path = None
+
+
+def getSanitizePool():
+	"""Function which returns pool of SANITIZE_PROCESSES processes shared by requests of this process or None if SANITIZE_PROCESSES is 0. The pool is started by app_factory before the process starts its threads."""
+	
+	return app.extensions.get('sanitize_pool')
+
+
+def resetSqlConnection(exception=None):
+	"""Function which rolls back transaction left open by current request, so the next request of the thread starts with clean connection.
+	   'exception' - exception which ended the request or None
+	"""
+	
+	if getattr(sql_local, 'connection', None) is not None:
+		sql_local.connection.rollback()
+
+
+def acceptedEncoding():
+	"""Function which returns 'gzip' if client of current request accepts gzip compressed responses, otherwise it returns 'identity'"""
+	
+	if request.accept_encodings.quality('gzip') > 0:
+		return 'gzip'
+	
+	return 'identity'
+
+
+def gzipData(data, level=6):
+	"""Function which returns data compressed by gzip.
+	   'data' - data which have to be compressed
+	   'level' - compression level from 1 (fastest) to 9 (smallest)
+	"""
+	
+	output = StringIO()
+	# fixed mtime makes the same data always compressed to the same bytes
+	gz = gzip.GzipFile(filename='', mode='wb', compresslevel=level, fileobj=output, mtime=0)
+	gz.write(data)
+	gz.close()
+	
+	return output.getvalue()
+
+
+def gunzipData(data):
+	"""Function which returns data decompressed by gzip.
+	   'data' - data compressed by gzip
+	"""
+	
+	return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+def compressResponse(data, headers):
+	"""Function which returns response compressed by gzip if client accepts it and data are large enough.
+	   'data' - body of the response
+	   'headers' - dictionary with headers of the response
+	"""
+	
+	headers['Vary'] = 'Accept-Encoding'
+	
+	if len(data) >= COMPRESS_MIN_SIZE and acceptedEncoding() == 'gzip':
+		data = gzipData(data)
+		headers['Content-Encoding'] = 'gzip'
+	
+	return data, 200, headers
+
+
+def loadAssets(static_folder):
+	"""Function which returns dictionary with paths of static files and paths of their fingerprinted copies built by build_assets.py. It is empty if the assets weren't built.
+	   'static_folder' - static folder of embed application
+	"""
+	
+	filename = os.path.join(static_folder, 'dist', 'assets.json')
+	
+	if not os.path.exists(filename):
+		return {}
+	
+	f = open(filename)
+	assets = json.loads(f.read())
+	f.close()
+	
+	return assets
+
+
+def assetUrl(filename):
+	"""Function which returns url of static file for templates. Url of fingerprinted copy is returned if the assets were built.
+	   'filename' - path of the file in static folder
+	"""
+	
+	assets = app.extensions['assets']
 	
-	item.image_meta[url].pop('url', None)
+	if filename in assets:
+		return url_for('static', filename='dist/%s' % assets[filename])
 	
-	return item.image_meta[url]
+	return url_for('static', filename=filename)
 
 
 def getBucket():
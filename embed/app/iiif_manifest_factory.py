@@ -84,6 +84,9 @@ KEY_ORDER = ["@context", "@id", "@type", "@value", "@language", "label", "value"
 
 KEY_ORDER_HASH = dict([(KEY_ORDER[x],x) for x in range(len(KEY_ORDER))])
 
+# Path to ImageMagick's identify, shared by all factories in the process once detected
+IDENTIFY_PATH = None
+
 class ManifestFactory(object):
 	metadata_base = ""
 	metadata_dir = ""
@@ -130,12 +133,26 @@ class ManifestFactory(object):
 		self.debug_level = "warn"
 		self.log_stream = sys.stdout
 
-		# Try to find ImageMagick's identify
-		try:
-			self.whichid = commands.getoutput('which identify')
-		except:
-			# No IM or not unix
-			self.whichid = ""
+		# ImageMagick's identify is looked up only when it is needed
+		self._whichid = None
+
+	def _get_whichid(self):
+		global IDENTIFY_PATH
+		if self._whichid is None:
+			if IDENTIFY_PATH is None:
+				# Try to find ImageMagick's identify
+				try:
+					IDENTIFY_PATH = commands.getoutput('which identify')
+				except:
+					# No IM or not unix
+					IDENTIFY_PATH = ""
+			self._whichid = IDENTIFY_PATH
+		return self._whichid
+
+	def _set_whichid(self, value):
+		self._whichid = value
+
+	whichid = property(_get_whichid, _set_whichid)
 
 	def set_debug_stream(self, strm):
 		self.log_stream = strm
@@ -687,6 +704,9 @@ class Collection(BaseMetadataObject):
 	_uri_segment = ""
 	_required = ["@id", 'label']
 	_warn = ["description"]
+	# paging properties of Presentation API 2.1
+	_extra_properties = ['first', 'last', 'next', 'prev', 'total', 'startIndex']
+	_integer_properties = ['total', 'startIndex']
 	collections = []
 	manifests = []
 
@@ -20,9 +20,15 @@ import requests
 import boto.exception
 
 from app.task_queue import task_queue
-from models import Item, Task
+from models import db, Item, Task
+from db_wrapper import BATCH_SIZE
 from exceptions import NoItemInDb, ErrorItemImport, ErrorImageIdentify
-from helper import getBucket, getCloudSearch
+from helper import getBucket, getCloudSearch, storeTileSources, IIIF_SERVER
+from manifest import invalidateManifest
+from collection import indexItem
+from publish import publishItem, unpublishItem
+from sanitize import sanitizeItems, sanitizedSize, SANITIZE_CACHE_BYTES
+from cache import LRUCache
 
 
 S3_CHUNK_SIZE = int(os.getenv('S3_CHUNK_SIZE', 52428800))
@@ -40,6 +46,494 @@ ERR_MESSAGE_S3 = 2
 ERR_MESSAGE_OTHER = 1
 ERR_MESSAGE_NONE = 0
 
+ERR_MESSAGE_OUTPUT = {ERR_MESSAGE_CLOUDSEARCH: 'Interaction with Cloud Search failed', ERR_MESSAGE_HTTP: 'Download failed', ERR_MESSAGE_IMAGE: 'Image processing failed', ERR_MESSAGE_S3: 'Interaction with S3 failed', ERR_MESSAGE_OTHER: 'Another error'}
+
+# Counters in summary of batch, counters of error messages are prefixed by 'message@'
+BATCH_SUMMARY_FIELDS = ['total', 'pending', 'ok', 'error', 'deleted', 'tasks', 'tasks_finished']
+# Statuses of items which have index in batch, items are ordered by their position in the batch
+BATCH_STATUSES = ['pending', 'ok', 'error', 'deleted']
+# Metadata fields of Item which can be changed without ingest of its images
+ITEM_METADATA_FIELDS = ['title', 'creator', 'source', 'institution', 'institution_link', 'license', 'description']
+# Number in seconds for which Batch submitted by POST is kept open while its items wait for planBatch and are planned
+PLAN_TIMEOUT = int(os.getenv('PLAN_TIMEOUT', 86400))
+# Count of retries of interrupted planBatch and number in seconds after which it is retried
+PLAN_RETRIES = int(os.getenv('PLAN_RETRIES', 5))
+PLAN_RETRY_DELAY = int(os.getenv('PLAN_RETRY_DELAY', 60))
+# Values sanitized by planBatch in this process
+sanitize_cache = LRUCache(SANITIZE_CACHE_BYTES, sizeof=sanitizedSize)
+
+
+def addBatchItems(batch_id, item_ids, deleted_ids, tasks_count, start=0, pipe=None, finished=None):
+	"""Function which adds items to counters and indexes of Batch. They are updated by ingest, so status of the Batch can be shown without loading of its items and tasks. Items of large Batch can be added in chunks.
+	   'batch_id' - ID of the Batch
+	   'item_ids' - IDs of the items in their order
+	   'deleted_ids' - set of IDs of items marked to be deleted, they are already finished
+	   'tasks_count' - count of tasks of the items
+	   'start' - position of the first item in the Batch
+	   'pipe' - Pipeline to which the commands are queued, they are sent immediately if it is None
+	   'finished' - dictionary with IDs and data of items which were finished as 'ok' without tasks by the planner
+	"""
+	
+	if pipe is None:
+		with db.pipeline() as pipe:
+			return addBatchItems(batch_id, item_ids, deleted_ids, tasks_count, start, pipe, finished)
+	
+	finished = finished or {}
+	counters = dict((field, 0) for field in BATCH_SUMMARY_FIELDS)
+	counters.update({'total': len(item_ids), 'pending': len(item_ids) - len(deleted_ids) - len(finished), 'ok': len(finished), 'deleted': len(deleted_ids), 'tasks': tasks_count})
+	
+	for field, value in counters.items():
+		pipe.hincrby('batch@id@%s@summary' % batch_id, field, value)
+	
+	for i in range(0, len(item_ids), BATCH_SIZE):
+		chunk = [(order, item_id) for order, item_id in enumerate(item_ids[i:i + BATCH_SIZE], start + i)]
+		pipe.zadd('batch@id@%s@items' % batch_id, dict((item_id, order) for order, item_id in chunk))
+		pending = dict((item_id, order) for order, item_id in chunk if item_id not in deleted_ids and item_id not in finished)
+		deleted = dict((item_id, order) for order, item_id in chunk if item_id in deleted_ids)
+		ok = dict((item_id, order) for order, item_id in chunk if item_id in finished)
+		
+		if pending:
+			pipe.zadd('batch@id@%s@status@pending' % batch_id, pending)
+		if deleted:
+			pipe.zadd('batch@id@%s@status@deleted' % batch_id, deleted)
+			pipe.hmset('batch@id@%s@finished' % batch_id, dict((item_id, json.dumps({'id': item_id, 'status': 'deleted'})) for item_id in deleted))
+		if ok:
+			pipe.zadd('batch@id@%s@status@ok' % batch_id, ok)
+			pipe.hmset('batch@id@%s@finished' % batch_id, dict((item_id, json.dumps(batchItemStatus(finished[item_id], []))) for item_id in ok))
+
+
+def batchItemStatus(item_data, tasks):
+	"""Function which returns dictionary with status of item of Batch, statuses of its urls and error messages.
+	   'item_data' - data of the item from the Batch
+	   'tasks' - list of tuples (url, status, message) of tasks of the item
+	"""
+	
+	item_id = item_data['id']
+	tmp = {'id': item_id}
+	
+	if item_data.has_key('status') and item_data['status'] == 'deleted':
+		tmp['status'] = 'deleted'
+		return tmp
+	
+	item_tasks_status = {}
+	item_tasks_message = {}
+	
+	for url, status, message in tasks:
+		if not item_tasks_status.has_key(url) or (item_tasks_status.has_key(url) and item_tasks_status[url] != 'ok'):
+			item_tasks_status[url] = status
+			item_tasks_message[url] = message
+	
+	tmp['urls'] = []
+	
+	for url in item_data['url']:
+		# actualy ingested url
+		if item_tasks_status.has_key(url):
+			tmp['urls'].append(item_tasks_status[url])
+		# ingested url in past
+		else:
+			tmp['urls'].append('ok')
+	
+	if len(tmp['urls']) == 1:
+		tmp.pop('urls', None)
+	
+	if 'error' in item_tasks_status.values():
+		tmp['status'] = 'error'
+		tmp['message'] = []
+		
+		for message in item_tasks_message.values():
+			if message != ERR_MESSAGE_NONE:
+				tmp['message'].append(ERR_MESSAGE_OUTPUT[message])
+		
+		if len(tmp['message']) == 1:
+			tmp['message'] = tmp['message'][0]
+		
+	elif 'pending' in item_tasks_status.values():
+		tmp['status'] = 'pending'
+	else:
+		tmp['status'] = 'ok'
+	
+	return tmp
+
+
+def countBatchItem(batch_id, item_data, item_tasks, status):
+	"""Function which moves finalized item from pending items of Batch to items with its final status and stores its status for listing of the Batch. Item finalized again (e.g. after retry of Cloud Search) and deleted item, which is finished when the Batch is started, aren't counted. It returns True if the item was counted.
+	   'batch_id' - ID of the Batch
+	   'item_data' - data of the item from the Batch
+	   'item_tasks' - list of Tasks of the item
+	   'status' - final status of the item, 'ok' or 'error'
+	"""
+	
+	item_id = item_data['id']
+	tmp = batchItemStatus(item_data, [(task.url, task.status, task.message) for task in item_tasks])
+	tmp['status'] = status
+	
+	if not db.hsetnx('batch@id@%s@finished' % batch_id, item_id, json.dumps(tmp)):
+		return False
+	
+	key = 'batch@id@%s@summary' % batch_id
+	order = db.zscore('batch@id@%s@items' % batch_id, item_id)
+	
+	with db.pipeline() as pipe:
+		pipe.hincrby(key, 'pending', -1)
+		pipe.hincrby(key, status, 1)
+		
+		for message in set(task.message for task in item_tasks if task.status == 'error'):
+			if message != ERR_MESSAGE_NONE:
+				pipe.hincrby(key, 'message@%s' % message, 1)
+		
+		if order is not None:
+			pipe.zrem('batch@id@%s@status@pending' % batch_id, item_id)
+			pipe.zadd('batch@id@%s@status@%s' % (batch_id, status), {item_id: order})
+	
+	return True
+
+
+def getBatchSummary(batch_id):
+	"""Function which returns dictionary with counters of Batch and dictionary with counts of items with ERR_MESSAGE_* codes or None if the Batch has no summary.
+	   'batch_id' - ID of the Batch
+	"""
+	
+	stored = db.hgetall('batch@id@%s@summary' % batch_id)
+	
+	if not stored:
+		return None
+	
+	summary = {}
+	messages = {}
+	
+	for field, value in stored.items():
+		if field.startswith('message@'):
+			messages[int(field[len('message@'):])] = int(value)
+		else:
+			summary[field] = int(value)
+	
+	return summary, messages
+
+
+def getBatchPlanned(batch_id):
+	"""Function which returns count of items of Batch which are already planned by planBatch or None if all items of the Batch are planned (or it isn't planned by planBatch). Items are planned in their order, so items from this position have no Tasks and indexes yet and they are pending.
+	   'batch_id' - ID of the Batch
+	"""
+	
+	plan_total, planned = db.hmget('batch@id@%s@summary' % batch_id, ['plan_total', 'planned'])
+	
+	if plan_total is None or int(planned or 0) >= int(plan_total):
+		return None
+	
+	return int(planned or 0)
+
+
+def getBatchItems(batch_id, status=None, cursor=0, limit=BATCH_SIZE):
+	"""Function which returns list with statuses of items of Batch from the cursor and cursor of the next page (None if there is no next page) or None if the Batch has no index. Statuses of finished items are stored, statuses of pending items are built from their tasks.
+	   'batch_id' - ID of the Batch
+	   'status' - only items with this status are returned, all items are returned if it is None
+	   'cursor' - position of the first returned item in the Batch
+	   'limit' - maximal count of returned items
+	"""
+	
+	if status is None:
+		key = 'batch@id@%s@items' % batch_id
+	else:
+		key = 'batch@id@%s@status@%s' % (batch_id, status)
+	
+	# one more item is loaded to find out the cursor of the next page
+	members = db.zrangebyscore(key, cursor, limit + 1)
+	
+	if not members and not db.zcard('batch@id@%s@items' % batch_id):
+		return None
+	
+	next_cursor = None
+	
+	if len(members) > limit:
+		next_cursor = int(members[limit][1])
+		members = members[:limit]
+	
+	item_ids = [item_id for item_id, order in members]
+	output = []
+	pending = []
+	
+	for item_id, stored in zip(item_ids, db.hmget('batch@id@%s@finished' % batch_id, item_ids) if item_ids else []):
+		if stored is None:
+			pending.append(item_id)
+		
+		output.append(stored)
+	
+	tasks = Task.get_items_tasks(batch_id, pending) if pending else {}
+	
+	for i, item_id in enumerate(item_ids):
+		if output[i] is not None:
+			output[i] = json.loads(output[i])
+		elif tasks.get(item_id):
+			# the last task of item has all its data
+			item_tasks = tasks[item_id]
+			output[i] = batchItemStatus(item_tasks[-1].item_data, [(task.url, task.status, task.message) for task in item_tasks])
+		else:
+			output[i] = {'id': item_id, 'status': 'pending'}
+	
+	return output, next_cursor
+
+
+def createItemTasks(batch_id, item_data, old_item, pipe):
+	"""Function which creates Tasks of item of ingest batch and returns list of them. The last Task receives all data of the item, which has to be already sanitized. No Task is created for deleted item which isn't stored.
+	   'batch_id' - ID of the batch
+	   'item_data' - validated item of the batch
+	   'old_item' - already stored Item or None
+	   'pipe' - Pipeline where the Tasks are saved
+	"""
+	
+	item_id = item_data['id']
+	tasks = []
+	
+	### Delete a item ###
+	if item_data.has_key('status') and item_data['status'] == 'deleted':
+		# if there is no item --> nothing is going to be done
+		if old_item:
+			task_order = 0
+			
+			for url in old_item.url:
+				data = {'url': url, 'item_id': item_id, 'item_tasks_count': len(old_item.url), 'url_order': task_order, 'type': 'del'}
+				task = Task(batch_id, item_id, task_order, data, pipe)
+				tasks.append(task)
+				task_order += 1
+		else:
+			return tasks
+	
+	### Update or create a new item ###
+	else:
+		### Already stored item ###
+		if old_item:
+			new_count = len(item_data['url'])
+			old_count = len(old_item.url)
+			update_list = []
+		
+			for url_order in range(0, max(new_count, old_count)):
+				if url_order < new_count and url_order < old_count:
+					# different url on the specific position --> overwrite
+					if item_data['url'][url_order] != old_item.url[url_order]:
+						data = {'url': item_data['url'][url_order], 'item_id': item_id, 'url_order': url_order, 'type': 'add'}
+						update_list.append(data)
+				else:
+					# end of both lists
+					if new_count == old_count:
+						break
+				
+					# a new url list is shorter than old one --> something to delelete
+					if url_order >= new_count:
+						data = {'url': old_item.url[url_order], 'item_id': item_id, 'url_order': url_order, 'type': 'del'}
+						update_list.append(data)
+					
+					# a new url list is longer than old one --> something to add
+					elif url_order >= old_count:
+						data = {'url': item_data['url'][url_order], 'item_id': item_id, 'url_order': url_order, 'type': 'add'}
+						update_list.append(data)
+			
+			### No change in url, change in other data possible ###
+			if not update_list:
+				data = {'item_id': item_id, 'type': 'mod', 'item_tasks_count': 1}
+				task = Task(batch_id, item_id, 0, data, pipe)
+				tasks.append(task)
+			else:
+				task_order = 0
+				
+				for data in update_list:
+					data['item_tasks_count'] = len(update_list)
+					task = Task(batch_id, item_id, task_order, data, pipe)
+					tasks.append(task)
+					task_order += 1
+				
+		### New item ###
+		else:
+			task_order = 0
+		
+			for url in item_data['url']:
+				data = {'url': url, 'item_id': item_id, 'url_order': task_order, 'item_tasks_count': len(item_data['url']), 'type': 'add'}
+				task = Task(batch_id, item_id, task_order, data, pipe)
+				tasks.append(task)
+				task_order += 1
+			
+	### Last task for specific item receives all item`s data ###
+	task.item_data = item_data
+	task.save(pipe)
+	
+	return tasks
+
+
+def processBatchItems(batch_id, batch_data, start, pipe, cache, pool=None, apply_changes=False):
+	"""Function which sanitizes items of ingest batch, creates Tasks of changed items, adds the items to indexes of the batch and returns list of created Tasks. Already stored Items are loaded from redis in chunks, items identical with them are finished as 'ok' without Tasks and added to the collection of the batch.
+	   'batch_id' - ID of the batch
+	   'batch_data' - list of validated items
+	   'start' - position of the first item in the batch
+	   'pipe' - Pipeline where the Tasks and indexes are saved
+	   'cache' - LRUCache with already sanitized values
+	   'pool' - multiprocessing Pool which sanitizes large chunks or None
+	   'apply_changes' - if it is True, changed metadata of stored Items with the same urls are stored by applyMetadataChanges instead of 'mod' Tasks, it needs settings of the ingest worker
+	"""
+	
+	tasks = []
+	deleted_ids = set()
+	finished = {}
+	
+	for i in range(0, len(batch_data), BATCH_SIZE):
+		chunk = batch_data[i:i + BATCH_SIZE]
+		sanitizeItems(chunk, cache, pool)
+		changes = []
+		
+		for item_data, old_item in zip(chunk, Item.load_many([item_data['id'] for item_data in chunk])):
+			if item_data.has_key('status') and item_data['status'] == 'deleted':
+				deleted_ids.add(item_data['id'])
+			elif old_item is not None:
+				change = itemChanges(item_data, old_item)
+				
+				if change is None:
+					finished[item_data['id']] = item_data
+					# the Item is a part of collection of the batch also without change
+					indexItem(batch_id, old_item, pipe=pipe)
+					continue
+				elif change == 'metadata' and apply_changes:
+					changes.append((item_data, old_item))
+					continue
+			
+			tasks.extend(createItemTasks(batch_id, item_data, old_item, pipe))
+		
+		if changes:
+			if applyMetadataChanges(batch_id, changes):
+				for item_data, old_item in changes:
+					finished[item_data['id']] = item_data
+			else:
+				# Cloud Search is retried by finalizeItem
+				for item_data, old_item in changes:
+					tasks.extend(createItemTasks(batch_id, item_data, old_item, pipe))
+	
+	addBatchItems(batch_id, [item_data['id'] for item_data in batch_data], deleted_ids, len(tasks), start, pipe, finished)
+	
+	return tasks
+
+
+def itemChanges(item_data, old_item):
+	"""Function which returns 'urls' if urls of item of batch differ from stored Item, 'metadata' if only its metadata differ or None if the item doesn't change the Item.
+	   'item_data' - sanitized item of the batch
+	   'old_item' - stored Item
+	"""
+	
+	if item_data['url'] != old_item.url:
+		return 'urls'
+	
+	for attribute in ITEM_METADATA_FIELDS:
+		if item_data.get(attribute, '') != getattr(old_item, attribute, ''):
+			return 'metadata'
+	
+	return None
+
+
+def applyMetadataChanges(batch_id, changes):
+	"""Function which stores changed metadata of stored Items whose urls don't change, so their images are kept. Documents of all the Items are sent to Cloud Search in one commit, then the Items are stored in one round-trip. It returns False if Cloud Search failed, then no Item is stored.
+	   'batch_id' - ID of the batch
+	   'changes' - list of tuples (sanitized item of the batch, stored Item)
+	"""
+	
+	timestamp = datetime.utcnow().isoformat("T") + "Z"
+	items = [(Item(item_data['id'], dict(item_data, timestamp=timestamp, image_meta=old_item.image_meta)), old_item) for item_data, old_item in changes]
+	
+	if CLOUDSEARCH_ITEM_DOMAIN is not None:
+		try:
+			cloudsearch = getCloudSearch(CLOUDSEARCH_ITEM_DOMAIN, 'document')
+			
+			for item, old_item in items:
+				ordered_image_meta = [dict(item.image_meta.get(url, {}), url=url) for url in item.url]
+				cloudsearch.add(hashlib.sha512(item.id).hexdigest()[:128], {'id': item.id, 'title': item.title, 'creator': item.creator, 'source': item.source, 'institution': item.institution, 'institution_link': item.institution_link, 'license': item.license, 'description': item.description, 'url': json.dumps(item.url), 'timestamp': item.timestamp, 'image_meta': json.dumps(ordered_image_meta)})
+			
+			cloudsearch.commit()
+		except:
+			print '\nFailed Cloud Search update of %s items of batch %s, they are finalized by tasks\nError message:\n###\n%s###' % (len(items), batch_id, traceback.format_exc())
+			return False
+	
+	Item.save_many([item for item, old_item in items])
+	
+	for item, old_item in items:
+		invalidateManifest(item.id)
+		storeTileSources(item, IIIF_SERVER)
+		indexItem(batch_id, item, old_item)
+		publishItem(item.id)
+		print "Item '%s' finalized - metadata modified" % item.id
+	
+	return True
+
+
+def storeBatchPlan(batch_id, batch_data):
+	"""Function which stores validated items of Batch for planBatch, so the request which submitted the Batch doesn't wait for creation of its Tasks. The Batch is open until all its items are planned, progress of the planning is shown by 'plan_total' and 'planned' counters of the Batch summary.
+	   'batch_id' - ID of the Batch
+	   'batch_data' - list of validated items
+	"""
+	
+	with db.pipeline() as pipe:
+		# compact.py doesn't archive the Batch while it has no pending items yet
+		pipe.set('batch@id@%s@open' % batch_id, 1, ex=PLAN_TIMEOUT)
+		pipe.hincrby('batch@id@%s@summary' % batch_id, 'plan_total', len(batch_data))
+		pipe.hincrby('batch@id@%s@summary' % batch_id, 'planned', 0)
+		
+		for i in range(0, len(batch_data), BATCH_SIZE):
+			pipe.rpush('batch@id@%s@plan' % batch_id, *[json.dumps(item_data) for item_data in batch_data[i:i + BATCH_SIZE]])
+
+
+def queuePlannedTasks(batch_id):
+	"""Function which puts Tasks saved by planBatch to the queue in chunks of BATCH_SIZE Tasks. Tasks are removed from the list of planned Tasks only after they are put to the queue, so Tasks of interrupted planning are put to the queue by the next planning. Task put to the queue twice isn't counted twice by its Item (see Task.finish_item_task).
+	   'batch_id' - ID of the Batch
+	"""
+	
+	key = 'batch@id@%s@plan@tasks' % batch_id
+	
+	while True:
+		chunk = db.lrange(key, 0, BATCH_SIZE - 1)
+		
+		if not chunk:
+			return
+		
+		for task in chunk:
+			item_id, task_id = json.loads(task)
+			ingestQueue.delay(batch_id, item_id, task_id)
+		
+		db.ltrim(key, len(chunk), -1)
+
+
+@task_queue.task(bind=True, acks_late=True, max_retries=PLAN_RETRIES, default_retry_delay=PLAN_RETRY_DELAY)
+def planBatch(self, batch_id):
+	"""Function which creates Tasks of items of Batch stored by storeBatchPlan in chunks of BATCH_SIZE items and puts them to the queue. Tasks, counters and indexes of every chunk are saved in one transaction together with removing of the chunk from the plan and with the list of its Tasks for queueing, so interrupted planning is retried and continues with Tasks which weren't put to the queue and with the next chunk.
+	   'batch_id' - ID of the Batch
+	"""
+	
+	key = 'batch@id@%s@plan' % batch_id
+	
+	try:
+		queuePlannedTasks(batch_id)
+		start = int(db.hget('batch@id@%s@summary' % batch_id, 'planned') or 0)
+		
+		while True:
+			chunk = [json.loads(item_data) for item_data in db.lrange(key, 0, BATCH_SIZE - 1)]
+			
+			if not chunk:
+				break
+			
+			with db.pipeline(transaction=True) as pipe:
+				tasks = processBatchItems(batch_id, chunk, start, pipe, sanitize_cache, apply_changes=True)
+				pipe.ltrim(key, len(chunk), -1)
+				pipe.hincrby('batch@id@%s@summary' % batch_id, 'planned', len(chunk))
+				
+				if tasks:
+					pipe.rpush('batch@id@%s@plan@tasks' % batch_id, *[json.dumps([task.item_id, task.task_id]) for task in tasks])
+			
+			queuePlannedTasks(batch_id)
+			start += len(chunk)
+			# the Batch is kept open while it is planned
+			db.expire('batch@id@%s@open' % batch_id, PLAN_TIMEOUT)
+	except Exception as err:
+		print '\nPlanning of batch %s failed, it is retried\nError message:\n###\n%s###' % (batch_id, traceback.format_exc())
+		raise self.retry(exc=err)
+	
+	db.delete('batch@id@%s@open' % batch_id)
+	
+	return start
+
+
 @task_queue.task
 def ingestQueue(batch_id, item_id, task_id):
 	try:
@@ -181,17 +675,20 @@ def ingestQueue(batch_id, item_id, task_id):
 			task.status = 'error'
 			task.save()
 	
-	if task.increment_finished_item_tasks() >= task.item_tasks_count:
+	added, finished = task.finish_item_task()
+	
+	# retried Cloud Search task and task put to the queue twice were already counted
+	if added:
+		db.hincrby('batch@id@%s@summary' % batch_id, 'tasks_finished')
+	
+	if finished >= task.item_tasks_count:
 		finalizeItem(batch_id, item_id, task.item_tasks_count)
 	
 	return
 
 
 def finalizeItem(batch_id, item_id, item_tasks_count):
-	item_tasks = []
-	
-	for task_order in range(0, item_tasks_count):
-		item_tasks.append(Task(batch_id, item_id, task_order))
+	item_tasks = Task.get_item_tasks(batch_id, item_id, item_tasks_count)
 	
 	# the task with highest id for the specific item has all item data
 	last_task = item_tasks[-1]
@@ -212,15 +709,11 @@ def finalizeItem(batch_id, item_id, item_tasks_count):
 		if not whole_item_delete:
 			# check if there is any change on item
 			if last_task.type == 'mod':
-				modify_test = False
-			
-				for attribute in ['title', 'creator', 'source', 'institution', 'institution_link', 'license', 'description']:
-					if item_data.get(attribute, '') != getattr(old_item, attribute, ''):
-						modify_test = True
-						break
-			
 				# without modification we can finish immediately
-				if not modify_test:
+				if itemChanges(item_data, old_item) is None:
+					# the Item is a part of collection of the batch also without change
+					indexItem(batch_id, old_item)
+					countBatchItem(batch_id, item_data, item_tasks, 'ok')
 					print "Item '%s' finalized - without modification" % item_id
 					return
 
@@ -281,16 +774,24 @@ def finalizeItem(batch_id, item_id, item_tasks_count):
 					last_task.save()
 		
 		if last_task.status == 'error':
+			countBatchItem(batch_id, item_data, item_tasks, 'error')
 			cleanErrItem(item_id, len(item_data['image_meta']))
 			print "Item '%s' failed" % item_id
 		elif old_item and whole_item_delete:
 			old_item.delete()
+			unpublishItem(item_id)
 			print "Item '%s' deleted" % item_id
 		else:
 			item.save()
+			invalidateManifest(item_id)
+			storeTileSources(item, IIIF_SERVER)
+			indexItem(batch_id, item, old_item)
+			publishItem(item_id)
+			countBatchItem(batch_id, item_data, item_tasks, 'ok')
 			print "Item '%s' finalized" % item_id
 	
 	else:
+		countBatchItem(batch_id, item_data, item_tasks, 'error')
 		cleanErrItem(item_id, len(item_data['image_meta']))
 		print "Item '%s' failed" % item_id
 	
@@ -331,4 +832,6 @@ def cleanErrItem(item_id, count):
 	except:
 		pass
 	
+	unpublishItem(item_id)
+	
 	return
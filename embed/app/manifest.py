@@ -0,0 +1,249 @@
+"""Module which provides rendering and caching of IIIF manifests"""
+
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import url_for
+from flask import current_app as app
+import simplejson as json
+
+from iiif_manifest_factory import ManifestFactory
+from models import db
+from helper import gzipData, gunzipData
+
+
+# Seconds for which one process can hold the lock for manifest regeneration
+MANIFEST_LOCK_TIMEOUT = int(os.getenv('MANIFEST_LOCK_TIMEOUT', 10))
+# Seconds between checks of redis while another process regenerates the manifest
+MANIFEST_LOCK_POLL = 0.05
+
+
+def createManifestFactory(config):
+	"""Function which returns ManifestFactory configured for rendering of manifests. The factory is created once per process and shared by all requests.
+	   'config' - configuration of embed application
+	"""
+
+	fac = ManifestFactory()
+	fac.set_base_metadata_uri(config['SERVER_NAME'])
+	fac.set_base_metadata_dir(os.path.abspath(os.path.dirname(__file__)))
+	fac.set_base_image_uri('http://%s' % config['IIIF_SERVER'])
+	fac.set_iiif_image_info(2.0, 2)
+
+	return fac
+
+
+def renderManifest(item):
+	"""Function which returns serialized IIIF manifest for particular Item. Manifest is built directly, with MANIFEST_DEBUG it is built by validating ManifestFactory.
+	   'item' - Item whose manifest have to be rendered
+	"""
+
+	if app.config['MANIFEST_DEBUG']:
+		manifest = buildValidatedManifest(item)
+	else:
+		manifest = buildManifest(item)
+
+	return json.JSONEncoder(separators=(',', ':')).encode(manifest)
+
+
+def buildManifest(item):
+	"""Function which returns IIIF manifest for particular Item as ordered dictionary. It builds the same structure as ManifestFactory, but without validation of every attribute and without sorting of keys.
+	   'item' - Item whose manifest have to be built
+	"""
+
+	server_name = app.config['SERVER_NAME']
+	iiif_server = app.config['IIIF_SERVER']
+
+	mf = OrderedDict()
+	mf['@context'] = 'http://iiif.io/api/presentation/2/context.json'
+	mf['@id'] = url_for('iiifMeta', item_id=item.id, _external=True)
+	mf['@type'] = 'sc:Manifest'
+
+	if item.title:
+		mf['label'] = item.title
+
+	mf['metadata'] = [OrderedDict([('label', 'Author'), ('value', item.creator)]), OrderedDict([('label', 'Source'), ('value', item.source)]), OrderedDict([('label', 'Institution'), ('value', item.institution)]), OrderedDict([('label', 'Institution link'), ('value', item.institution_link)])]
+
+	if item.description:
+		mf['description'] = item.description
+	if item.license:
+		mf['license'] = item.license
+
+	canvases = []
+
+	for count, url in enumerate(item.url):
+		width = item.image_meta[url].get('width', 1)
+		height = item.image_meta[url].get('height', 1)
+
+		if count == 0:
+			filename = item.id
+		else:
+			filename = '%s/%s' % (item.id, count)
+
+		canvas_id = 'http://%s/canvas/c%s.json' % (server_name, count)
+
+		img = OrderedDict()
+		img['@id'] = 'http://%s/%s/full/full/0/native.jpg' % (iiif_server, filename)
+		img['@type'] = 'dctypes:Image'
+
+		if height:
+			img['height'] = height
+		if width:
+			img['width'] = width
+
+		img['service'] = OrderedDict([('@context', 'http://iiif.io/api/image/2/context.json'), ('@id', 'http://%s/%s' % (iiif_server, filename)), ('profile', 'http://iiif.io/api/image/2/profiles/level2.json')])
+
+		cvs = OrderedDict()
+		cvs['@id'] = canvas_id
+		cvs['@type'] = 'sc:Canvas'
+		cvs['label'] = 'Item %s - image %s' % (item.id, count)
+
+		if height:
+			cvs['height'] = height
+		if width:
+			cvs['width'] = width
+
+		cvs['images'] = [OrderedDict([('@type', 'oa:Annotation'), ('motivation', 'sc:painting'), ('resource', img), ('on', canvas_id)])]
+		canvases.append(cvs)
+
+	seq = OrderedDict()
+	seq['@id'] = 'http://%s/sequence/s.json' % server_name
+	seq['@type'] = 'sc:Sequence'
+	seq['label'] = 'Item %s - sequence 1' % item.id
+
+	if canvases:
+		seq['canvases'] = canvases
+
+	mf['sequences'] = [seq]
+
+	return mf
+
+
+def buildValidatedManifest(item):
+	"""Function which returns IIIF manifest for particular Item as ordered dictionary built by ManifestFactory, which validates the whole structure.
+	   'item' - Item whose manifest have to be built
+	"""
+
+	fac = app.extensions['manifest_factory']
+
+	mf = fac.manifest(ident=url_for('iiifMeta', item_id=item.id, _external=True), label=item.title)
+	mf.description = item.description
+	mf.license = item.license
+
+	mf.set_metadata({"label":"Author", "value":item.creator})
+	mf.set_metadata({"label":"Source", "value":item.source})
+	mf.set_metadata({"label":"Institution", "value":item.institution})
+	mf.set_metadata({"label":"Institution link", "value":item.institution_link})
+
+	seq = mf.sequence(ident='http://%s/sequence/s.json' % app.config['SERVER_NAME'], label='Item %s - sequence 1' % item.id)
+
+	count = 0
+
+	for url in item.url:
+		if item.image_meta[url].has_key('width'):
+			width = item.image_meta[url]['width']
+		else:
+			width = 1
+
+		if item.image_meta[url].has_key('height'):
+			height = item.image_meta[url]['height']
+		else:
+			height = 1
+
+		cvs = seq.canvas(ident='http://%s/canvas/c%s.json' % (app.config['SERVER_NAME'], count), label='Item %s - image %s' % (item.id, count))
+		cvs.set_hw(height, width)
+
+		anno = cvs.annotation()
+
+		if count == 0:
+			filename = item.id
+		else:
+			filename = '%s/%s' % (item.id, count)
+
+		img = anno.image(ident='/%s/full/full/0/native.jpg' % filename)
+		img.add_service(ident='http://%s/%s' % (app.config['IIIF_SERVER'], filename), context='http://iiif.io/api/image/2/context.json', profile='http://iiif.io/api/image/2/profiles/level2.json')
+
+		img.width = width
+		img.height = height
+
+		count += 1
+
+	return mf.toJSON(top=True)
+
+
+def getManifest(item, encoding='identity'):
+	"""Function which returns serialized IIIF manifest for particular Item from cache. Manifest is cached in the process and in redis and it is regenerated only once for concurrent requests when Item's timestamp changes. Manifest is cached already compressed, so it isn't compressed for every request.
+	   'item' - Item whose manifest have to be returned
+	   'encoding' - 'gzip' for manifest compressed by gzip or 'identity'
+	"""
+
+	cache = app.extensions['caches']['manifest']
+	key = (item.id, item.timestamp)
+	manifest = cache.get(key)
+
+	if manifest is None:
+		manifest = app.extensions['manifest_flight'].do(key, loadManifest, item)
+
+	if encoding == 'gzip':
+		return manifest[1]
+
+	return manifest[0]
+
+
+def loadManifest(item):
+	"""Function which loads manifest of Item from redis or regenerates it and stores it to redis and to the process cache. It returns tuple with the manifest and the manifest compressed by gzip.
+	   'item' - Item whose manifest have to be loaded
+	"""
+
+	compressed = getStoredManifest(item)
+
+	if compressed is None:
+		# the lock can expire while the manifest is rendered, so only own lock is released
+		token = uuid.uuid4().hex
+		
+		if db.setnx('manifest_lock@%s' % item.id, token, MANIFEST_LOCK_TIMEOUT):
+			try:
+				compressed = gzipData(renderManifest(item), 9)
+				db.set('manifest@%s' % item.id, '%s\n%s' % (item.timestamp, compressed))
+			finally:
+				db.delete_if_equal('manifest_lock@%s' % item.id, token)
+		else:
+			# another process is regenerating the manifest --> wait for it
+			deadline = time.time() + MANIFEST_LOCK_TIMEOUT
+
+			while compressed is None and time.time() < deadline:
+				time.sleep(MANIFEST_LOCK_POLL)
+				compressed = getStoredManifest(item)
+
+			if compressed is None:
+				compressed = gzipData(renderManifest(item), 9)
+
+	manifest = (gunzipData(compressed), compressed)
+	app.extensions['caches']['manifest'].set((item.id, item.timestamp), manifest)
+
+	return manifest
+
+
+def getStoredManifest(item):
+	"""Function which returns manifest of Item compressed by gzip stored in redis or None if it isn't stored or it is outdated.
+	   'item' - Item whose manifest have to be returned
+	"""
+
+	data = db.get('manifest@%s' % item.id)
+
+	if data:
+		timestamp, manifest = data.split('\n', 1)
+
+		if timestamp == item.timestamp:
+			return manifest
+
+	return None
+
+
+def invalidateManifest(item_id):
+	"""Function which removes cached manifest of Item from redis.
+	   'item_id' - ID of Item whose manifest have to be removed
+	"""
+
+	db.delete('manifest@%s' % item_id)
@@ -1,5 +1,8 @@
 """Module which defines data model"""
 
+import os
+import copy
+
 import simplejson as json
 
 from exceptions import NoItemInDb, ErrorItemImport
@@ -7,41 +10,40 @@ from db_wrapper import DatabaseWrapper
 
 db = DatabaseWrapper()
 
+# Pub/sub channel where IDs of saved and deleted Items are published
+ITEM_CHANNEL = 'item_changed'
+
+# Layout of stored Items, 'blob' stores whole Item in one record, 'hash' stores fields and metadata of images in hashes
+ITEM_STORAGE = os.getenv('ITEM_STORAGE', 'blob')
+
+# Item's fields stored in the item's hash, metadata of images are stored in separated hash
+ITEM_FIELDS = ['url', 'title', 'creator', 'source', 'institution', 'institution_link', 'license', 'description', 'timestamp']
+
 
 class Item():
 	"""Class which defines the Item model.
 	'id' - item ID which is unique in whole db
 	'data' - dictionary with Item's metadata
+	'fields' - list of Item's fields which have to be loaded from db, other fields are loaded lazily when they are used (only for hash storage)
 	"""
 	
-	def __init__(self, id, data=None):
+	def __init__(self, id, data=None, fields=None):
 		self.id = id
-		self.title = ''
-		self.creator = ''
-		self.source = ''
-		self.institution = ''
-		self.institution_link = ''
-		self.license = ''
-		self.description = ''
-		self.url = []
-		self.image_meta = {}
-		self.timestamp = ''
+		self.partial = False
 		
 		if data:
-			try:
-				data = json.loads(json.JSONEncoder().encode(data))
-			except:
+			if type(data) != dict:
 				raise ErrorItemImport('There is an error in the item`s model representation %s' % data)
+			
+			data = copy.deepcopy(data)
 		else:
-			data = db.get('item_id@%s' % id)
+			try:
+				data = self.load(fields)
+			except:
+				raise ErrorItemImport('There is an error in the item`s model representation of item %s' % id)
 			
 			if not data:
 				raise NoItemInDb('No item with specified id stored in db')
-			else:
-				try:
-					data = json.loads(data)
-				except:
-					raise ErrorItemImport('There is an error in the item`s model representation %s' % data)	
 					
 		if data.has_key('url'):
 			self.url = data['url']
@@ -53,31 +55,224 @@ class Item():
 				self.url[i] = str(u)
 		else:
 			raise ErrorItemImport('The item doesn`t have all required params')
-					
-		if data.has_key('title'):
-			self.title = data['title']
-		if data.has_key('creator'):
-			self.creator = data['creator']
-		if data.has_key('source'):
-			self.source = data['source']
-		if data.has_key('institution'):
-			self.institution = data['institution']
-		if data.has_key('institution_link'):
-			self.institution_link = data['institution_link']
-		if data.has_key('license'):
-			self.license = data['license']
-		if data.has_key('description'):
-			self.description = data['description']
-		if data.has_key('image_meta'):
-			self.image_meta = data['image_meta']
-		if data.has_key('timestamp'):
-			self.timestamp = data['timestamp']
+		
+		for attribute in ITEM_FIELDS + ['image_meta']:
+			if data.has_key(attribute):
+				setattr(self, attribute, data[attribute])
+			# fields of partially loaded Item are loaded when they are used
+			elif not self.partial and attribute == 'image_meta':
+				self.image_meta = {}
+			elif not self.partial and attribute != 'url':
+				setattr(self, attribute, '')
+	
+	def __getattr__(self, name):
+		if not self.__dict__.get('partial', False) or name not in ITEM_FIELDS + ['image_meta']:
+			raise AttributeError(name)
+		
+		if name == 'image_meta':
+			value = dict((url, db.codec.decode(meta)) for url, meta in db.hgetall('item_image@%s' % self.id).items())
+		else:
+			value = db.hmget('item@%s' % self.id, [name])[0]
+			
+			if value is None:
+				value = ''
+			else:
+				value = value.decode('utf-8')
+		
+		setattr(self, name, value)
+		
+		return value
+	
+	def load(self, fields=None):
+		"""Method which returns Item's data from db in any storage layout, the configured layout is tried first. It returns None if there is no Item in db.
+		'fields' - list of Item's fields which have to be loaded, all fields are loaded if it is None
+		"""
+		
+		if ITEM_STORAGE == 'hash':
+			data = self.load_hash(fields)
+			
+			if data is None:
+				data = db.get_record('item_id@%s' % self.id)
+		else:
+			data = db.get_record('item_id@%s' % self.id)
+			
+			if data is None:
+				data = self.load_hash(fields)
+		
+		return data
+	
+	def load_hash(self, fields=None):
+		"""Method which returns Item's data stored in hashes or None if the Item isn't stored in hashes.
+		'fields' - list of Item's fields which have to be loaded, all fields are loaded if it is None
+		"""
+		
+		if fields is None:
+			stored = db.hgetall('item@%s' % self.id)
+			
+			if not stored:
+				return None
+			
+			fields = ITEM_FIELDS + ['image_meta']
+		else:
+			fields = ['url'] + [field for field in fields if field in ITEM_FIELDS and field != 'url'] + [field for field in fields if field == 'image_meta']
+			values = db.hmget('item@%s' % self.id, fields)
+			
+			if values[0] is None:
+				return None
+			
+			stored = dict((field, value) for field, value in zip(fields, values) if value is not None)
+			self.partial = True
+		
+		if 'image_meta' in fields:
+			images = db.hgetall('item_image@%s' % self.id)
+		else:
+			images = None
+		
+		return Item.decode_hash(stored, images)
+	
+	@staticmethod
+	def decode_hash(stored, images=None):
+		"""Method which returns Item's data from fields of Item's hashes.
+		'stored' - dictionary with fields of the item's hash
+		'images' - dictionary with fields of the hash with metadata of images, image_meta isn't returned if it is None
+		"""
+		
+		data = {}
+		
+		for field, value in stored.items():
+			if field == 'url':
+				data['url'] = json.loads(value)
+			else:
+				data[field] = value.decode('utf-8')
+		
+		if images is not None:
+			data['image_meta'] = dict((url, db.codec.decode(meta)) for url, meta in images.items())
+		
+		return data
+	
+	@staticmethod
+	def load_many(ids):
+		"""Method which loads several whole Items stored in any layout from db in one round-trip. It returns list of Items where missing Items are None.
+		'ids' - list of Items' IDs
+		"""
+		
+		pipe = db.pipeline()
+		
+		for id in ids:
+			pipe.get('item_id@%s' % id)
+			pipe.hgetall('item@%s' % id)
+			pipe.hgetall('item_image@%s' % id)
+		
+		values = pipe.execute()
+		items = []
+		
+		for i, id in enumerate(ids):
+			record, stored, images = values[i * 3:i * 3 + 3]
+			
+			try:
+				if record:
+					data = db.codec.decode(record)
+				elif stored:
+					data = Item.decode_hash(stored, images)
+				else:
+					data = None
+			except:
+				raise ErrorItemImport('There is an error in the item`s model representation of item %s' % id)
+			
+			if data:
+				items.append(Item(id, data))
+			else:
+				items.append(None)
+		
+		return items
+	
+	def get_image_meta(self, url):
+		"""Method which returns metadata of one Item's image. Only this image's metadata is loaded from db if Item is loaded partially.
+		'url' - url of the image
+		"""
+		
+		if not self.partial or self.__dict__.has_key('image_meta'):
+			return self.image_meta[url]
+		
+		data = db.hget('item_image@%s' % self.id, url)
+		
+		if data is None:
+			raise KeyError(url)
+		
+		return db.codec.decode(data)
 
-	def save(self):
-		db.set('item_id@%s' % self.id, json.dumps({'url': self.url, 'title': self.title, 'creator': self.creator, 'source': self.source, 'institution': self.institution, 'institution_link': self.institution_link, 'license': self.license, 'description': self.description, 'image_meta': self.image_meta, 'timestamp': self.timestamp}))
+	@staticmethod
+	def get_ids():
+		"""Method which returns set with IDs of all Items stored in db in any layout"""
+		
+		ids = set()
+		
+		for pattern, prefix in [('item_id@*', 'item_id@'), ('item@*', 'item@')]:
+			for key in db.scan_iter(pattern):
+				ids.add(key[len(prefix):])
+		
+		return ids
+	
+	@staticmethod
+	def get_timestamp(id):
+		"""Method which returns timestamp of Item without loading of whole Item, or None if the timestamp isn't stored.
+		'id' - item ID
+		"""
+		
+		return db.get('item_timestamp@%s' % id)
+
+	def save(self, storage=None):
+		"""Method which stores Item to db.
+		'storage' - storage layout, 'blob' or 'hash', ITEM_STORAGE is used if it is None
+		"""
+		
+		Item.save_many([self], storage)
+	
+	@staticmethod
+	def save_many(items, storage=None):
+		"""Method which stores several Items to db atomically in one round-trip.
+		'items' - list of Items
+		'storage' - storage layout, 'blob' or 'hash', ITEM_STORAGE is used if it is None
+		"""
+		
+		if storage is None:
+			storage = ITEM_STORAGE
+		
+		with db.pipeline(transaction=True) as pipe:
+			for item in items:
+				pipe.delete('item@%s' % item.id)
+				pipe.delete('item_image@%s' % item.id)
+				
+				if storage == 'hash':
+					fields = dict((field, getattr(item, field)) for field in ITEM_FIELDS)
+					fields['url'] = json.dumps(item.url)
+					pipe.hmset('item@%s' % item.id, fields)
+					
+					if item.image_meta:
+						pipe.hmset('item_image@%s' % item.id, dict((url, db.codec.encode(meta)) for url, meta in item.image_meta.items()))
+					
+					pipe.delete('item_id@%s' % item.id)
+				else:
+					pipe.set_record('item_id@%s' % item.id, {'url': item.url, 'title': item.title, 'creator': item.creator, 'source': item.source, 'institution': item.institution, 'institution_link': item.institution_link, 'license': item.license, 'description': item.description, 'image_meta': item.image_meta, 'timestamp': item.timestamp})
+				
+				if item.timestamp:
+					pipe.set('item_timestamp@%s' % item.id, item.timestamp)
+				
+				pipe.publish(ITEM_CHANNEL, item.id)
 		
 	def delete(self):
 		db.delete('item_id@%s' % self.id)
+		db.replace_hashes({'item@%s' % self.id: {}, 'item_image@%s' % self.id: {}})
+		db.delete('item_timestamp@%s' % self.id)
+		db.delete('manifest@%s' % self.id)
+		db.delete('tile_sources@%s' % self.id)
+		db.zrem('collection@institution@%s' % self.institution, self.id)
+		
+		for batch_id in db.smembers('collection@batches@%s' % self.id):
+			db.zrem('collection@batch@%s' % batch_id, self.id)
+		
+		db.delete('collection@batches@%s' % self.id)
+		db.publish(ITEM_CHANNEL, self.id)
 
 
 class Task():
@@ -85,10 +280,12 @@ class Task():
 	'batch_id' - ID of parent Batch
 	'item_id' - ID of processed Item
 	'task_id' - ID of Task, it is order of tasks for one Item 
-	'data' - dictionary with Task's metadata
+	'data' - dictionary with Task's metadata, new Task is saved to db
+	'pipe' - Pipeline where new Task is saved, it is saved immediately if it is None
+	'stored' - True if data were loaded from db, so they aren't saved again
 	"""
 	
-	def __init__(self, batch_id, item_id, task_id, data=None):
+	def __init__(self, batch_id, item_id, task_id, data=None, pipe=None, stored=False):
 		self.task_id = task_id
 		self.batch_id = batch_id
 		self.item_id = item_id
@@ -105,17 +302,15 @@ class Task():
 		safe = True
 		
 		if data is None:
-			data = db.get('batch@id@%s@item@id%s@task@id@%s' % (self.batch_id, self.item_id, self.task_id))
+			try:
+				data = db.get_record(self.key())
+			except:
+				raise ErrorItemImport('There is an error in the batch`s model representation of task %s' % self.task_id)
 
 			if not data:
 				raise NoItemInDb('No task with specified id stored in db')
 			else:
-				try:
-					data = json.loads(data)
-					safe = False
-						
-				except:
-					raise ErrorItemImport('There is an error in the batch`s model representation %s' % data)
+				safe = False
 		
 		if data.has_key('status'):
 			self.status = data['status']
@@ -136,15 +331,78 @@ class Task():
 		if data.has_key('message'):
 			self.message = data['message']
 		
-		if safe:
-			self.save()
+		if safe and not stored:
+			self.save(pipe)
 	
-	def save(self):
-		db.set('batch@id@%s@item@id%s@task@id@%s' % (self.batch_id, self.item_id, self.task_id), json.dumps({'status': self.status, 'url': self.url, 'url_order': self.url_order, 'image_meta': self.image_meta, 'attempts': self.attempts, 'type': self.type, 'item_data': self.item_data, 'item_tasks_count': self.item_tasks_count, 'message': self.message}))
+	@staticmethod
+	def get_item_tasks(batch_id, item_id, count):
+		"""Method which loads all Tasks of Item from db in one round-trip.
+		'batch_id' - ID of parent Batch
+		'item_id' - ID of processed Item
+		'count' - count of Item's Tasks
+		"""
+		
+		tasks = []
+		
+		for task_id, data in enumerate(db.get_records(['batch@id@%s@item@id%s@task@id@%s' % (batch_id, item_id, task_id) for task_id in range(count)])):
+			if not data:
+				raise NoItemInDb('No task with specified id stored in db')
+			
+			tasks.append(Task(batch_id, item_id, task_id, data, stored=True))
+		
+		return tasks
 	
-	def increment_finished_item_tasks(self):
+	@staticmethod
+	def get_items_tasks(batch_id, item_ids):
+		"""Method which loads Tasks of several Items from db in two round-trips. It returns dictionary with lists of Tasks of the Items, the list is empty if Item's Tasks aren't in db.
+		'batch_id' - ID of parent Batch
+		'item_ids' - list of IDs of processed Items
+		"""
+		
+		tasks = {}
+		rest = []
+		
+		# the first Task knows count of Item's Tasks
+		for item_id, data in zip(item_ids, db.get_records(['batch@id@%s@item@id%s@task@id@0' % (batch_id, item_id) for item_id in item_ids])):
+			tasks[item_id] = []
+			
+			if data:
+				task = Task(batch_id, item_id, 0, data, stored=True)
+				tasks[item_id].append(task)
+				rest.extend([(item_id, task_id) for task_id in range(1, task.item_tasks_count)])
+		
+		for (item_id, task_id), data in zip(rest, db.get_records(['batch@id@%s@item@id%s@task@id@%s' % (batch_id, item_id, task_id) for item_id, task_id in rest])):
+			# Tasks after missing one aren't used
+			if data and len(tasks[item_id]) == task_id:
+				tasks[item_id].append(Task(batch_id, item_id, task_id, data, stored=True))
+		
+		return tasks
+	
+	def key(self):
+		"""Method which returns unique key of Task in db"""
+		
+		return 'batch@id@%s@item@id%s@task@id@%s' % (self.batch_id, self.item_id, self.task_id)
+	
+	def save(self, pipe=None):
+		"""Method which stores Task to db.
+		'pipe' - Pipeline where the Task is saved, it is saved immediately if it is None
+		"""
+		
+		if pipe is None:
+			pipe = db
+		
+		pipe.set_record(self.key(), {'status': self.status, 'url': self.url, 'url_order': self.url_order, 'image_meta': self.image_meta, 'attempts': self.attempts, 'type': self.type, 'item_data': self.item_data, 'item_tasks_count': self.item_tasks_count, 'message': self.message})
+	
+	def finish_item_task(self):
+		"""Method which adds the Task to finished Tasks of its Item and returns tuple (True if the Task wasn't finished before, count of finished Tasks of the Item). IDs of the finished Tasks are stored as set, so Task which runs again (e.g. Task put to the queue twice) isn't counted twice."""
+		
 		if self.item_id != '':
-			return db.incr('batch@id@%s@item@id%s' % (self.batch_id, self.item_id), 1)
+			pipe = db.pipeline()
+			pipe.sadd('batch@id@%s@item@id%s@finished' % (self.batch_id, self.item_id), self.task_id)
+			pipe.scard('batch@id@%s@item@id%s@finished' % (self.batch_id, self.item_id))
+			added, count = pipe.execute()
+			
+			return bool(added), count
 	
 	def delete(self):
-		db.delete('batch@id@%s@item@id%s@task@id@%s' % (self.batch_id, self.item_id, self.task_id))
+		db.delete(self.key())
@@ -0,0 +1,105 @@
+"""Module which publishes rendered pages, manifests and oEmbed responses of Items as static files, which can be served by nginx without embed application"""
+
+import os
+import shutil
+import urllib
+
+from models import db, Item
+
+
+# Directory where the static files are published, publishing is disabled if it isn't set
+PUBLISH_DIR = os.getenv('PUBLISH_DIR', None)
+
+# Embed application used for rendering, it is created on the first use in the process
+publisher_app = None
+
+
+def getPublisherApp():
+	"""Function which returns embed application used for rendering of published files"""
+
+	global publisher_app
+
+	if publisher_app is None:
+		# the application imports ingest, which imports this module
+		from app import app_factory
+
+		publisher_app = app_factory(db.backend)
+
+	return publisher_app
+
+
+def publishItem(item_id, publish_dir=None):
+	"""Function which renders iFrame pages, IIIF manifest and default oEmbed response of Item and writes them to directory of the Item. Files of Item which doesn't exist are removed. It returns True if the Item was published.
+	   'item_id' - ID of Item which have to be published
+	   'publish_dir' - directory with published files, PUBLISH_DIR is used if it is None
+	"""
+
+	publish_dir = publish_dir or PUBLISH_DIR
+
+	if not publish_dir or item_id in ('.', '..'):
+		return False
+
+	app = getPublisherApp()
+	# the application doesn't listen to changes of Items
+	app.extensions['item_listener'].invalidate(item_id)
+	client = app.test_client()
+
+	try:
+		item = Item(item_id)
+	except:
+		unpublishItem(item_id, publish_dir)
+		return False
+
+	paths = {'index.html': '/%s' % item_id, 'manifest.json': '/%s/manifest.json' % item_id, 'oembed.json': '/oembed?url=%s' % urllib.quote('http://%s/%s' % (app.config['SERVER_NAME'], item_id), safe='')}
+
+	for order in range(len(item.url)):
+		paths['%s/index.html' % order] = '/%s/%s' % (item_id, order)
+
+	# @ is never in ID of Item, so the temporary directory can't collide with directory of Item
+	new_dir = os.path.join(publish_dir, '@tmp', '%s.%s' % (item_id, os.getpid()))
+
+	if os.path.exists(new_dir):
+		shutil.rmtree(new_dir)
+
+	for filename, path in paths.items():
+		rv = client.get(path)
+
+		if rv.status_code != 200:
+			shutil.rmtree(new_dir, True)
+			unpublishItem(item_id, publish_dir)
+			return False
+
+		filename = os.path.join(new_dir, filename)
+
+		if not os.path.exists(os.path.dirname(filename)):
+			os.makedirs(os.path.dirname(filename))
+
+		f = open(filename, 'wb')
+		f.write(rv.data)
+		f.close()
+
+	# the directory is replaced at once, so nginx never serves a mix of old and new files
+	item_dir = os.path.join(publish_dir, item_id)
+	old_dir = '%s.old' % new_dir
+
+	if os.path.exists(item_dir):
+		os.rename(item_dir, old_dir)
+
+	os.rename(new_dir, item_dir)
+	shutil.rmtree(old_dir, True)
+
+	return True
+
+
+def unpublishItem(item_id, publish_dir=None):
+	"""Function which removes published files of Item.
+	   'item_id' - ID of Item whose files have to be removed
+	   'publish_dir' - directory with published files, PUBLISH_DIR is used if it is None
+	"""
+
+	publish_dir = publish_dir or PUBLISH_DIR
+
+	if not publish_dir or item_id in ('.', '..'):
+		return
+
+	shutil.rmtree(os.path.join(publish_dir, item_id), True)
@@ -0,0 +1,86 @@
+"""Module which sanitizes HTML in text fields of ingested items. Every distinct value of a batch is cleaned only once, because values like institution repeat in whole batches, and results are cached for next batches."""
+
+import os
+import sys
+
+import bleach
+
+
+# Tags which can be in Item description
+ALLOWED_TAGS = ['b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'strong', 'ul']
+
+# Fields of items which are sanitized, description can contain allowed tags, all tags are stripped from other fields
+SANITIZED_FIELDS = ['title', 'creator', 'institution', 'description']
+
+# Size in bytes of sanitized values cached by each process, the application config and the ingest worker use this one value
+SANITIZE_CACHE_BYTES = int(os.getenv('SANITIZE_CACHE_BYTES', 16 * 1024 * 1024))
+
+# Values which aren't cached are sanitized by pool of processes only if there is at least this count of them, smaller counts don't pay off sending them to processes
+SANITIZE_POOL_MIN = int(os.getenv('SANITIZE_POOL_MIN', 200))
+
+
+def sanitizeValue(key):
+	"""Function which returns sanitized value of field of item.
+	   'key' - tuple (html, value), ALLOWED_TAGS are kept if html is True (in description), otherwise all tags are stripped
+	"""
+
+	html, value = key
+
+	if html:
+		return bleach.clean(value, tags=ALLOWED_TAGS, attributes=[], styles=[], strip=True)
+
+	return bleach.clean(value, tags=[], attributes=[], styles=[], strip=True)
+
+
+def sanitizedSize(key, value):
+	"""Function which returns number of bytes of memory taken by cached sanitized value, it is used as size of entries of LRUCache.
+	   'key' - tuple (html, value) with original value
+	   'value' - sanitized value
+	"""
+
+	return sys.getsizeof(key[1]) + sys.getsizeof(value)
+
+
+def sanitizeItems(batch_data, cache, pool=None):
+	"""Function which sanitizes text fields of items of ingest batch in place, items marked to be deleted are skipped.
+	   'batch_data' - list of validated items
+	   'cache' - LRUCache with already sanitized values, sanitizedSize is size of its entries
+	   'pool' - multiprocessing Pool which sanitizes values if there are many of them, they are sanitized in this process if it is None
+	"""
+
+	values = {}
+
+	for item_data in batch_data:
+		if item_data.get('status') == 'deleted':
+			continue
+
+		for field in SANITIZED_FIELDS:
+			if item_data.has_key(field):
+				# title and creator are sanitized by the same rules, so their results are shared
+				values[(field == 'description', item_data[field])] = None
+
+	missing = []
+
+	for key in values:
+		values[key] = cache.get(key)
+
+		if values[key] is None:
+			missing.append(key)
+
+	if missing:
+		if pool is not None and len(missing) >= SANITIZE_POOL_MIN:
+			results = pool.map(sanitizeValue, missing, 50)
+		else:
+			results = map(sanitizeValue, missing)
+
+		for key, result in zip(missing, results):
+			values[key] = result
+			cache.set(key, result)
+
+	for item_data in batch_data:
+		if item_data.get('status') == 'deleted':
+			continue
+
+		for field in SANITIZED_FIELDS:
+			if item_data.has_key(field):
+				item_data[field] = values[(field == 'description', item_data[field])]
@@ -0,0 +1,219 @@
+"""Module which validates items of ingest batches. URLs are checked in linear time by isUrl, which accepts the same URLs as url_regular without its exponential backtracking."""
+
+import re
+
+
+# Regex for Item ID validation
+id_regular = re.compile(r"""
+	^([-_.:~a-zA-Z0-9]){1,255}$
+	""", re.VERBOSE)
+
+# Regex for general url validation, it is the definition of URLs accepted by isUrl, but it backtracks exponentially on long URLs without valid last character
+url_regular = re.compile(ur'(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:\'".,<>?\xab\xbb\u201c\u201d\u2018\u2019]))')
+
+# Fields allowed in items which aren't marked to be deleted
+ITEM_FIELDS = frozenset(['id', 'title', 'creator', 'source', 'institution', 'institution_link', 'license', 'description', 'url'])
+
+# Characters of url_regular classes, \s and \w of the regex are ASCII only
+WORD_CHARS = frozenset(u'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_')
+LETTERS = frozenset(u'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+DOMAIN_CHARS = frozenset(u'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789.-')
+# characters which can't be in url outside of parentheses
+NOT_PLAIN_CHARS = frozenset(u' \t\n\r\x0b\x0c()<>')
+# characters which can't be the last character of url
+NOT_LAST_CHARS = frozenset(u' \t\n\r\x0b\x0c`!()[]{};:\'".,<>?\xab\xbb\u201c\u201d\u2018\u2019')
+
+
+def urlPrefixEnds(value):
+	"""Function which returns positions where the path of url starts after each of the url_regular prefixes: scheme, www with dot or domain with slash.
+	   'value' - checked string
+	"""
+
+	ends = []
+	lower = value[:8].lower()
+
+	if lower.startswith('http://'):
+		ends.append(7)
+	elif lower.startswith('https://'):
+		ends.append(8)
+
+	if lower.startswith('www'):
+		i = 3
+
+		while i < len(value) and i < 6 and value[i].isdigit() and value[i] in WORD_CHARS:
+			i += 1
+
+		if i < len(value) and value[i] == '.':
+			ends.append(i + 1)
+
+	# the domain is the longest run of domain characters, it has to end with a dot, 2 - 4 letters and a slash
+	j = 0
+
+	while j < len(value) and value[j] in DOMAIN_CHARS:
+		j += 1
+
+	if j < len(value) and value[j] == '/':
+		for letters in range(2, 5):
+			if j - letters - 1 >= 1 and value[j - letters - 1] == '.' and all(c in LETTERS for c in value[j - letters:j]):
+				ends.append(j + 1)
+				break
+
+	return ends
+
+
+def parenthesesEnd(value, i):
+	"""Function which returns position after parentheses starting at the position or -1 if they aren't valid. Parentheses can contain one level of nested non-empty parentheses.
+	   'value' - checked string
+	   'i' - position of the opening parenthesis
+	"""
+
+	i += 1
+
+	while i < len(value):
+		c = value[i]
+
+		if c == ')':
+			return i + 1
+		elif c == '(':
+			j = i + 1
+
+			while j < len(value) and value[j] not in NOT_PLAIN_CHARS:
+				j += 1
+
+			if j == i + 1 or j >= len(value) or value[j] != ')':
+				return -1
+
+			i = j + 1
+		elif c in NOT_PLAIN_CHARS:
+			return -1
+		else:
+			i += 1
+
+	return -1
+
+
+def isUrlPath(value, i):
+	"""Function which returns True if a prefix of the path of url starting at the position is valid. The path consists of characters and parentheses, it is valid if its second or later part is parentheses or a character which can be the last one.
+	   'value' - checked string
+	   'i' - position where the path starts
+	"""
+
+	parts = 0
+
+	while i < len(value):
+		c = value[i]
+
+		if c == '(':
+			end = parenthesesEnd(value, i)
+
+			if end < 0:
+				return False
+			if parts:
+				return True
+
+			i = end
+		elif c in NOT_PLAIN_CHARS:
+			return False
+		elif parts and c not in NOT_LAST_CHARS:
+			return True
+		else:
+			i += 1
+
+		parts += 1
+
+	return False
+
+
+def isUrl(value):
+	"""Function which returns True if url_regular matches the value, but it needs time linear with length of the value.
+	   'value' - checked string
+	"""
+
+	if not isinstance(value, basestring):
+		return False
+
+	# byte strings are matched by url_regular as latin-1 characters
+	if isinstance(value, str):
+		value = value.decode('latin-1')
+
+	if not value or value[0] not in WORD_CHARS:
+		return False
+
+	for end in urlPrefixEnds(value):
+		if isUrlPath(value, end):
+			return True
+
+	return False
+
+
+def validateItem(order, item, item_ids):
+	"""Function which returns item of ingest batch with internal names of fields and list of its validation errors.
+	   'order' - position of the item in the batch
+	   'item' - item decoded from JSON
+	   'item_ids' - set of IDs of already validated items of the batch, ID of the item is added to it
+	"""
+
+	errors = []
+
+	if type(item) is not dict:
+		errors.append("The item num. %s must be inside of '{}'" % order)
+		return item, errors
+
+	item = dict((k.lower(), v) for k, v in item.iteritems())
+
+	if not item.has_key('id'):
+		errors.append("The item num. %s must have unique ID" % order)
+		return item, errors
+
+	if not isinstance(item['id'], basestring):
+		errors.append("The item num. %s must have valid ID" % order)
+		return item, errors
+
+	if item['id'] in item_ids:
+		errors.append("The item num. %s must have unique ID" % order)
+		return item, errors
+
+	if not id_regular.match(item['id']):
+		errors.append("The item num. %s must have valid ID" % order)
+
+	if item.has_key('status') and (len(item) != 2 or item['status'] != 'deleted'):
+		errors.append("The item num. %s has status, but it isn't set to 'deleted' or there are more fields" % order)
+		return item, errors
+
+	if item.has_key('status'):
+		return item, errors
+
+	### Another tests are useful only for items which aren't marked to be deleted ###
+
+	### Convert some input field's names to the internal names ###
+	if item.has_key('institutionlink'):
+		item['institution_link'] = item['institutionlink']
+		item.pop('institutionlink', None)
+	if item.has_key('imageurl'):
+		item['url'] = item['imageurl']
+		item.pop('imageurl', None)
+
+	if not item.has_key('url') or type(item['url']) != list or len(item['url']) == 0:
+		errors.append("The item num. %s doesn't have url field, or it isn't a list or a list is empty" % order)
+		return item, errors
+
+	for url in item['url']:
+		if not isUrl(url):
+			errors.append("The '%s' url in the item num. %s isn't valid url" % (url, order))
+
+	for key in item.keys():
+		if key not in ITEM_FIELDS:
+			errors.append("The item num. %s has a not allowed field '%s'" % (order, key))
+
+	if item.has_key('source') and item['source'] and not isUrl(item['source']):
+		errors.append("The item num. %s doesn't have valid url '%s' in the Source field" % (order, item['source']))
+
+	if item.has_key('institution_link') and item['institution_link'] and not isUrl(item['institution_link']):
+		errors.append("The item num. %s doesn't have valid url '%s' in the InstitutionLink field" % (order, item['institution_link']))
+
+	if item.has_key('license') and item['license'] and not isUrl(item['license']):
+		errors.append("The item num. %s doesn't have valid url '%s' in the License field" % (order, item['license']))
+
+	item_ids.add(item['id'])
+
+	return item, errors
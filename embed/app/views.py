@@ -6,24 +6,24 @@ import re
 from urlparse import urlparse
 import time
 import gzip
-import sqlite3
+import tempfile
 import cgitb
 
-from flask import request, render_template, abort, url_for, g
+from flask import request, render_template, abort, url_for, g, Response, stream_with_context
 import simplejson as json
 from flask import current_app as app
-import bleach
 
-from iiif_manifest_factory import ManifestFactory
-from ingest import ingestQueue, ERR_MESSAGE_CLOUDSEARCH, ERR_MESSAGE_HTTP, ERR_MESSAGE_IMAGE, ERR_MESSAGE_S3, ERR_MESSAGE_OTHER, ERR_MESSAGE_NONE
-from models import Item, Task
+from manifest import getManifest
+from collection import renderCollection, streamCollectionPage
+from ingest import ingestQueue, planBatch, storeBatchPlan, processBatchItems, getBatchSummary, getBatchItems, getBatchPlanned, batchItemStatus, BATCH_STATUSES, ERR_MESSAGE_OUTPUT
+from models import db, Task
+from db_wrapper import BATCH_SIZE
+from validator import validateItem
+from batch_db import insertBatch, insertBatchItems, batchExists, batchItems, itemTasks, batchSummary
 from exceptions import NoItemInDb, ErrorItemImport
-from helper import prepareTileSources
+from helper import getItem, getItems, itemSummary, getItemTimestamp, getTileSources, cacheHeaders, isNotModified, acceptedEncoding, compressResponse, getSqlConnection, getSanitizePool
 
 
-# Tags which can be in Item description
-ALLOWED_TAGS = ['b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'strong', 'ul']
-
 # Regex for Item ID with order (of image) validation
 item_url_regular = re.compile(r"""
 	^/
@@ -32,15 +32,20 @@ item_url_regular = re.compile(r"""
 	(?P<order>\d*)
 	""", re.VERBOSE)
 
-# Regex for Item ID validation
-id_regular = re.compile(r"""
-	^([-_.:~a-zA-Z0-9]){1,255}$
-	""", re.VERBOSE)
+# Seconds for which browsers can cache fingerprinted static files
+ASSET_MAX_AGE = 31536000
 
-# Regex for general url validation
-url_regular = re.compile(ur'(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:\'".,<>?\xab\xbb\u201c\u201d\u2018\u2019]))')
 
-ERR_MESSAGE_OUTPUT = {ERR_MESSAGE_CLOUDSEARCH: 'Interaction with Cloud Search failed', ERR_MESSAGE_HTTP: 'Download failed', ERR_MESSAGE_IMAGE: 'Image processing failed', ERR_MESSAGE_S3: 'Interaction with S3 failed', ERR_MESSAGE_OTHER: 'Another error'}
+def assetHeaders(response):
+	"""Function which sets far-future cache headers of fingerprinted static files, their content never changes under the same name.
+	'response' - response which is returned to client
+	"""
+	
+	if request.path.startswith('/static/dist/') and response.status_code == 200:
+		response.headers['Cache-Control'] = 'public, max-age=%s, immutable' % ASSET_MAX_AGE
+	
+	return response
+
 
 #@app.route('/')
 def index():
@@ -80,8 +85,13 @@ def iFrame(item_id, order=None):
 	else:
 		order = -1
 	
+	headers = cacheHeaders(item_id, getItemTimestamp(item_id), 'iframe/%s' % order)
+	
+	if isNotModified(headers):
+		return '', 304, headers
+	
 	try:
-		item = Item(item_id)
+		item = getItem(item_id)
 	except NoItemInDb as err:
 		return err.message, 404
 	except ErrorItemImport as err:
@@ -90,21 +100,12 @@ def iFrame(item_id, order=None):
 	if order >= len(item.url):
 		return 'Wrong item sequence', 404
 	
-	tile_sources = []
+	tile_sources = getTileSources(item, order, app.config['IIIF_SERVER'])
 	
 	if order == -1:
-		count = 0
-		
-		for url in item.url:
-			tile_sources.append(prepareTileSources(item, url, count))
-			count += 1
-		
 		order = 0
-	else:
-		url = item.url[order]
-		tile_sources.append(prepareTileSources(item, url, order))
-		
-	return render_template('iframe_openseadragon_inline.html', item = item, tile_sources = tile_sources, order = order)
+	
+	return render_template('iframe_openseadragon_inline.html', item = item, tile_sources = tile_sources, order = order), 200, headers
 
 
 #@app.route('/<item_id>/manifest.json')
@@ -113,62 +114,70 @@ def iiifMeta(item_id):
 	'item_id' - ID of requested Item
 	"""
 	
+	encoding = acceptedEncoding()
+	headers = cacheHeaders(item_id, getItemTimestamp(item_id), 'manifest/%s' % encoding)
+	headers['Access-Control-Allow-Origin'] = '*'
+	headers['Vary'] = 'Accept-Encoding'
+	
+	if isNotModified(headers):
+		return '', 304, headers
+	
 	try:
-		item = Item(item_id)
+		item = getItem(item_id)
 	except NoItemInDb as err:
 		return err.message, 404
 	except ErrorItemImport as err:
 		return err.message, 500
 	
-	fac = ManifestFactory()
-	fac.set_base_metadata_uri(app.config['SERVER_NAME'])
-	fac.set_base_metadata_dir(os.path.abspath(os.path.dirname(__file__)))
-	fac.set_base_image_uri('http://%s' % app.config['IIIF_SERVER'])
-	fac.set_iiif_image_info(2.0, 2)
+	headers['Content-Type'] = 'application/json'
 	
-	mf = fac.manifest(ident=url_for('iiifMeta', item_id=item_id, _external=True), label=item.title)
-	mf.description = item.description
-	mf.license = item.license
+	if encoding == 'gzip':
+		headers['Content-Encoding'] = 'gzip'
 	
-	mf.set_metadata({"label":"Author", "value":item.creator})
-	mf.set_metadata({"label":"Source", "value":item.source})
-	mf.set_metadata({"label":"Institution", "value":item.institution})
-	mf.set_metadata({"label":"Institution link", "value":item.institution_link})
+	return getManifest(item, encoding), 200, headers
+
+
+#@app.route('/batch/<name>/collection.json')
+def batchCollection(name):
+	"""View function which returns paged IIIF collection of Items finalized by ingest batch
+	'name' - ID of the batch
+	"""
 	
-	seq = mf.sequence(ident='http://%s/sequence/s.json' % app.config['SERVER_NAME'], label='Item %s - sequence 1' % item_id)
+	return collection('batchCollection', 'batch', name, 'Batch %s' % name)
+
 
-	count = 0
+#@app.route('/institution/<name>/collection.json')
+def institutionCollection(name):
+	"""View function which returns paged IIIF collection of Items of institution
+	'name' - name of the institution
+	"""
 	
-	for url in item.url:
-		if item.image_meta[url].has_key('width'):
-			width = item.image_meta[url]['width']
-		else:
-			width = 1
+	return collection('institutionCollection', 'institution', name, name)
 
-		if item.image_meta[url].has_key('height'):
-			height = item.image_meta[url]['height']
-		else:
-			height = 1
+
+def collection(view, kind, name, label):
+	"""Function which returns response with top level collection or with its page specified by page parameter"""
 	
-		cvs = seq.canvas(ident='http://%s/canvas/c%s.json' % (app.config['SERVER_NAME'], count), label='Item %s - image %s' % (item_id, count))
-		cvs.set_hw(height, width)
+	page = request.args.get('page', None)
+	headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
 	
-		anno = cvs.annotation()
+	if page is None:
+		output = renderCollection(view, kind, name, label)
 		
-		if count == 0:
-			filename = item_id
-		else:
-			filename = '%s/%s' % (item_id, count)
-
-		img = anno.image(ident='/%s/full/full/0/native.jpg' % filename)
-		img.add_service(ident='http://%s/%s' % (app.config['IIIF_SERVER'], filename), context='http://iiif.io/api/image/2/context.json', profile='http://iiif.io/api/image/2/profiles/level2.json')
-		
-		img.width = width
-		img.height = height
+		if output is None:
+			return 'No collection with specified name', 404
 		
-		count += 1
-
-	return json.JSONEncoder().encode(mf.toJSON(top=True)), 200, {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+		return output, 200, headers
+	
+	try:
+		output = streamCollectionPage(view, kind, name, label, int(page))
+	except ValueError:
+		return 'The page parameter must be a number', 400
+	
+	if output is None:
+		return 'No such page of the collection', 404
+	
+	return Response(stream_with_context(output), headers=headers)
 
 
 #@app.route('/oembed', methods=['GET'])
@@ -210,17 +219,6 @@ def oEmbed():
 	else:
 		return 'Unsupported format of ID', 404
 
-	### Loading of Item from DB with testing ###
-	try:
-		item = Item(item_id)
-	except NoItemInDb as err:
-		return err.message, 404
-	except ErrorItemImport as err:
-		return err.message, 500
-		
-	if order >= len(item.url):
-		return 'Wrong item sequence', 404
-
 	### Size of image configuration ###
 	maxwidth = request.args.get('maxwidth', None)
 	maxheight = request.args.get('maxheight', None)
@@ -235,15 +233,44 @@ def oEmbed():
 	if maxwidth is None and maxheight is None:
 		maxwidth = 560
 
+	### Cached response for the same normalized parameters ###
+	timestamp = getItemTimestamp(item_id)
+	headers = cacheHeaders(item_id, timestamp, 'oembed/%s/%s/%s/%s' % (order, maxwidth, maxheight, format))
+	
+	if isNotModified(headers):
+		return '', 304, headers
+	
+	cache_key = (item_id, order, maxwidth, maxheight, format, timestamp)
+	
+	if timestamp:
+		response = app.extensions['caches']['oembed'].get(cache_key)
+		
+		if response is not None:
+			headers['Content-Type'] = response[1]
+			return response[0], 200, headers
+
+	### Loading of Item from DB with testing ###
+	try:
+		item = getItem(item_id, ['title', 'creator', 'source', 'institution', 'institution_link', 'timestamp'])
+	except NoItemInDb as err:
+		return err.message, 404
+	except ErrorItemImport as err:
+		return err.message, 500
+		
+	if order >= len(item.url):
+		return 'Wrong item sequence', 404
+	
+	image_meta = item.get_image_meta(item.url[order])
+
 	# Get the items width, set to -1 if not found
-	if item.image_meta[item.url[order]].has_key('width'):
-		width = int(item.image_meta[item.url[order]]['width'])
+	if image_meta.has_key('width'):
+		width = int(image_meta['width'])
 	else:
 		width = -1
 
 	# Get the items height, set to -1 if not found
-	if item.image_meta[item.url[order]].has_key('height'):
-		height = int(item.image_meta[item.url[order]]['height'])
+	if image_meta.has_key('height'):
+		height = int(image_meta['height'])
 	else:
 		height = -1
 	
@@ -310,118 +337,338 @@ def oEmbed():
 	data[u'provider_url'] = item.institution_link
 
 	if format == 'xml':
-		return render_template('oembed_xml.html', data = data), 200, {'Content-Type': 'text/xml'}
+		response = (render_template('oembed_xml.html', data = data), 'text/xml')
 	else:
 		data[u'html'] = embed_code
-		return json.dumps(data), 200, {'Content-Type': 'application/json'}
+		response = (json.dumps(data), 'application/json')
+	
+	# changed Item has new timestamp, so its old responses are never used again
+	if timestamp:
+		app.extensions['caches']['oembed'].set(cache_key, response)
+	
+	headers['Content-Type'] = response[1]
+	
+	return response[0], 200, headers
 
 
-#@app.route('/ingest', methods=['GET', 'POST'])
-def ingest():
-	"""View function for ingest. It takes json with items (by POST) to ingest or batch_id to show batch state."""
+#@app.route('/items', methods=['GET', 'POST'])
+def items():
+	"""View function which returns metadata and sizes of images of several Items in one response. IDs of Items are passed as comma separated ids parameter (GET) or as json list (POST)."""
 	
-	### Show info about already started ingest (Batch) ###
-	if request.method == 'GET':
-		batch_id = request.args.get('batch_id', None)
-
-		if batch_id is None:
-			return "The batch ID must be provided", 400
+	if request.method == 'POST':
+		item_ids = request.get_json(force=True, silent=True)
+		
+		if type(item_ids) != list:
+			return 'The request body must be json list with IDs of items', 400
+		
+		item_ids = [unicode(item_id) for item_id in item_ids]
+	else:
+		item_ids = [item_id for item_id in request.args.get('ids', '').split(',') if item_id]
+	
+	# every Item is returned only once, in order of its first occurrence
+	seen = set()
+	item_ids = [item_id for item_id in item_ids if not (item_id in seen or seen.add(item_id))]
+	
+	if not item_ids:
+		return 'No ids parameter provided', 400
+	
+	if len(item_ids) > app.config['BULK_ITEMS_LIMIT']:
+		return 'At most %s items can be requested at once' % app.config['BULK_ITEMS_LIMIT'], 400
+	
+	try:
+		items = getItems(item_ids)
+	except ErrorItemImport as err:
+		return err.message, 500
+	
+	def generate():
+		yield '['
+		
+		for count, item_id in enumerate(item_ids):
+			if count:
+				yield ', '
+			
+			if items[count] is None:
+				yield json.dumps({'id': item_id, 'error': 'No item with specified id stored in db'})
+			else:
+				yield json.dumps(itemSummary(items[count]))
 		
-		conn = sqlite3.connect(app.config['SQL_DB_URL'])
-		c = conn.cursor()
-		c.execute("SELECT batch_data FROM Batch WHERE batch_id=?", (batch_id,))
+		yield ']'
+	
+	return Response(generate(), mimetype='application/json', headers={'Access-Control-Allow-Origin': '*'})
 
-		try:
-			batch_data = json.loads(c.fetchone()[0])
-		except:
-			return "Batch with provided ID doesn't exists", 400
-		output = []
+
+#@app.route('/stats')
+def stats():
+	"""View function which returns sizes and hit ratios of in-process caches"""
+	
+	output = {}
+	
+	for name, cache in app.extensions['caches'].items():
+		output[name] = cache.stats()
+	
+	return json.dumps(output), 200, {'Content-Type': 'application/json'}
+
+
+#@app.route('/ingest/summary')
+def ingestSummary():
+	"""View function which returns counts of items of batch by their status and counts of errors. The counters are maintained by ingest, so the response doesn't depend on size of the batch. Counters of batches removed from redis by compact.py are counted from sqlite."""
+	
+	batch_id = request.args.get('batch_id', None, type=int)
+	
+	if batch_id is None:
+		return "The batch ID must be provided", 400
+	
+	result = getBatchSummary(batch_id)
+	
+	if result is None and app.config['SQL_DB_URL']:
+		result = batchSummary(getSqlConnection(), batch_id)
+	
+	if result is None:
+		return "Batch with provided ID doesn't exists", 400
+	
+	summary, messages = result
+	summary['batch_id'] = batch_id
+	summary['errors'] = dict((ERR_MESSAGE_OUTPUT[message], count) for message, count in messages.items() if message in ERR_MESSAGE_OUTPUT)
+	
+	return json.dumps(summary), 200, {'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
+
+
+def ingestPage(batch_id):
+	"""Function which returns page of statuses of items of batch from its indexes, so only the requested items are loaded. Arguments of the request:
+	   'cursor' - position of the first item in the batch, it is returned as 'next_cursor' with the previous page
+	   'limit' - maximal count of items on the page, INGEST_PAGE_LIMIT by default, all items from the cursor are streamed in NDJSON format if it isn't set
+	   'status' - only items with this status ('pending', 'ok', 'error' or 'deleted') are returned
+	   'format' - 'json' (default) for object with items and 'next_cursor' or 'ndjson' for one item per line and cursor in X-Next-Cursor header
+	"""
+	
+	cursor = request.args.get('cursor', 0, type=int)
+	limit = request.args.get('limit', None, type=int)
+	status = request.args.get('status', None)
+	output_format = request.args.get('format', 'json')
+	
+	if status is not None and status not in BATCH_STATUSES:
+		return "Status must be one of: %s" % ', '.join(BATCH_STATUSES), 400
+	
+	if output_format not in ('json', 'ndjson'):
+		return "Format must be 'json' or 'ndjson'", 400
+	
+	if limit is not None and (limit < 1 or limit > app.config['INGEST_PAGE_LIMIT']):
+		return "Limit must be between 1 and %s" % app.config['INGEST_PAGE_LIMIT'], 400
+	
+	if limit is None and output_format == 'json':
+		limit = app.config['INGEST_PAGE_LIMIT']
+	
+	def loadPage(cursor, count):
+		result = None
+		
+		# indexes in redis don't contain items which aren't planned by planBatch yet
+		if getBatchPlanned(batch_id) is None:
+			result = getBatchItems(batch_id, status, cursor, count)
 		
-		for item in batch_data:
-			item_id = item['id']
-			tmp = {'id': item_id}
+		# batches without indexes in redis (started before the indexes were introduced or not planned yet) are read from sqlite
+		if result is None:
+			result = sqlBatchItems(batch_id, status, cursor, count)
+		
+		return result
+	
+	result = loadPage(cursor, limit or BATCH_SIZE)
+	
+	if result is None:
+		return "Batch with provided ID doesn't exists", 400
+	
+	output, next_cursor = result
+	
+	if output_format == 'json':
+		return compressResponse(json.JSONEncoder(separators=(',', ':')).encode({'items': output, 'next_cursor': next_cursor}), {'Content-Type': 'application/json'})
+	
+	headers = {}
+	
+	if limit is not None and next_cursor is not None:
+		headers['X-Next-Cursor'] = next_cursor
+	
+	def generate(output, next_cursor):
+		while True:
+			for tmp in output:
+				yield json.JSONEncoder(separators=(',', ':')).encode(tmp) + '\n'
 			
-			item_tasks = []
-			item_tasks_status = {}
-			item_tasks_message = {}
+			# without limit the rest of the batch is loaded in chunks while it is streamed
+			if limit is not None or next_cursor is None:
+				return
 			
-			item_task_count = 1
-			task_order = 0
+			output, next_cursor = loadPage(next_cursor, BATCH_SIZE)
+	
+	return Response(stream_with_context(generate(output, next_cursor)), mimetype='application/x-ndjson', headers=headers)
+
+
+def sqlBatchItems(batch_id, status=None, cursor=0, limit=BATCH_SIZE):
+	"""Function which returns list with statuses of items of batch read from sqlite and cursor of the next page (None if there is no next page) or None if the batch doesn't exist. Tasks of the items are read from redis, or from sqlite if they were archived.
+	   'batch_id' - ID of the batch
+	   'status' - only items with this status are returned, items which weren't archived by compact.py yet are stored as pending, so their status is derived from their tasks, items which aren't planned by planBatch yet are pending
+	   'cursor' - position of the first returned item in the batch
+	   'limit' - maximal count of returned items
+	"""
+	
+	# batches aren't stored in sqlite without its configuration
+	if not app.config['SQL_DB_URL']:
+		return None
+	
+	conn = getSqlConnection()
+	planned = getBatchPlanned(batch_id)
+	statuses = None
+	
+	# items which aren't planned yet are stored with their final status (e.g. deleted)
+	if status is not None and planned is None:
+		statuses = sorted(set([status, 'pending']))
+	
+	output = []
+	next_cursor = cursor
+	
+	while True:
+		# one more item is loaded to find out the cursor of the next page
+		rows = batchItems(conn, batch_id, next_cursor, limit + 1, statuses)
+		
+		if not rows and next_cursor == cursor and not batchExists(conn, batch_id):
+			return None
+		
+		tasks = Task.get_items_tasks(batch_id, [item['id'] for order, item, item_status in rows]) if rows else {}
+		
+		for order, item, item_status in rows:
+			if len(output) == limit:
+				return output, order
 			
-			while item_task_count > task_order:
-				try:
-					task = Task(batch_id, item_id, task_order)
-					item_tasks.append(task)
-					item_task_count = task.item_tasks_count
-					task_order += 1
-					
-					if not item_tasks_status.has_key(task.url) or (item_tasks_status.has_key(task.url) and item_tasks_status[task.url] != 'ok'):
-						item_tasks_status[task.url] = task.status
-						item_tasks_message[task.url] = task.message
-							
-				except:
-					break
-
-			if len(item_tasks) == 0:
-				# tasks are in sqlite
-				c.execute("SELECT * FROM Task WHERE batch_id=? AND item_id=?", (batch_id, item_id))
-
-				for task in c.fetchall():
-					task_status = task[3]
-					task_url = task[4]
-					task_message = task[5]
-				
-					if not item_tasks_status.has_key(task_url) or (item_tasks_status.has_key(task_url) and item_tasks_status[task_url] != 'ok'):
-						item_tasks_status[task_url] = task_status
-						item_tasks_message[task_url] = task_message
+			if planned is not None and order >= planned:
+				# tasks of the item aren't created by planBatch yet
+				tmp = {'id': item['id'], 'status': 'pending'}
 			else:
-				#if item tasks are finished move them from redis to sqlite
-				if not 'pending' in item_tasks_status.values():
-					for task in item_tasks:
-						c.execute("INSERT INTO Task VALUES (?,?,?,?,?,?)", (task.task_id, task.batch_id, task.item_id, task.status, task.url, task.message))
-						task.delete()
-					
-					conn.commit()
-
-			if item.has_key('status') and item['status'] == 'deleted':
-				tmp['status'] = 'deleted'
+				if tasks.get(item['id']):
+					item_tasks_status = [(task.url, task.status, task.message) for task in tasks[item['id']]]
+				else:
+					# tasks are in sqlite
+					item_tasks_status = itemTasks(conn, batch_id, item['id'])
+				
+				tmp = batchItemStatus(item, item_tasks_status)
+			
+			if status is None or tmp['status'] == status:
 				output.append(tmp)
-				continue
+		
+		if len(rows) <= limit:
+			return output, None
+		
+		next_cursor = rows[-1][0] + 1
+
+
+#@app.route('/ingest/stream', methods=['POST'])
+def ingestStream():
+	"""View function for ingest of large batch in NDJSON format (one item per line). Items are validated, stored and put to the queue in chunks while the request is read, so memory doesn't grow with size of the batch. Invalid items are skipped, the batch is created with the first valid item. The response is streamed in NDJSON format too: validation errors of items, ID of the batch when it is created and at last counts of ingested and invalid items."""
+	
+	if request.headers.get('Content-Type') != 'application/x-ndjson':
+		return "Content-Type must be 'application/x-ndjson'", 400
+	
+	conn = getSqlConnection()
+	
+	def ingestChunk(batch_id, chunk, start):
+		insertBatchItems(conn, batch_id, chunk, start)
+		conn.commit()
+		
+		with db.pipeline(BATCH_SIZE) as pipe:
+			tasks = processBatchItems(batch_id, chunk, start, pipe, app.extensions['caches']['sanitize'], getSanitizePool())
+		
+		for task in tasks:
+			ingestQueue.delay(batch_id, task.item_id, task.task_id)
+	
+	def generate():
+		### Storing of compressed ingest orders to local disk while they are read, the file is renamed by ID of the batch when it is created ###
+		fd, path = tempfile.mkstemp('.gz', '@stream.', app.config['BATCH_DIR'])
+		output = os.fdopen(fd, 'wb')
+		f = gzip.GzipFile('', 'wb', fileobj=output)
+		batch_id = None
+		item_ids = set()
+		chunk = []
+		count = 0
+		errors = 0
+		order = 0
+		
+		# the archive is closed and the batch is released for compact.py also if the client disconnects
+		try:
+			for line in request.stream:
+				f.write(line)
 				
-			tmp['urls'] = []
+				if not line.strip():
+					continue
 				
-			for url in item['url']:
-				# actualy ingested url
-				if item_tasks_status.has_key(url):
-					tmp['urls'].append(item_tasks_status[url])
-				# ingested url in past
+				try:
+					item = json.loads(line)
+				except ValueError:
+					item_errors = ["The item num. %s isn't valid JSON" % order]
 				else:
-					tmp['urls'].append('ok')
-			
-			if len(tmp['urls']) == 1:
-				tmp.pop('urls', None)
-			
-			if 'error' in item_tasks_status.values():
-				tmp['status'] = 'error'
-				tmp['message'] = []
+					item, item_errors = validateItem(order, item, item_ids)
 				
-				for message in item_tasks_message.values():
-					if message != ERR_MESSAGE_NONE:
-						tmp['message'].append(ERR_MESSAGE_OUTPUT[message])
+				if item_errors:
+					errors += 1
+					yield json.dumps({'order': order, 'errors': item_errors}) + '\n'
+				else:
+					if batch_id is None:
+						batch_id = insertBatch(conn, [])
+						# compact.py doesn't archive the batch until all its items are added
+						db.setnx('batch@id@%s@open' % batch_id, 1, app.config['INGEST_STREAM_TIMEOUT'])
+						os.rename(path, os.path.join(app.config['BATCH_DIR'], '%s.gz' % batch_id))
+						yield json.dumps({'batch_id': batch_id}) + '\n'
+					
+					chunk.append(item)
 				
-				if len(tmp['message']) == 1:
-					tmp['message'] = tmp['message'][0]
+				order += 1
 				
-			elif 'pending' in item_tasks_status.values():
-				tmp['status'] = 'pending'
-			else:
-				tmp['status'] = 'ok'
+				if len(chunk) == BATCH_SIZE:
+					ingestChunk(batch_id, chunk, count)
+					count += len(chunk)
+					chunk = []
+					db.expire('batch@id@%s@open' % batch_id, app.config['INGEST_STREAM_TIMEOUT'])
 			
-			output.append(tmp)
+			if chunk:
+				ingestChunk(batch_id, chunk, count)
+				count += len(chunk)
+		finally:
+			f.close()
+			output.close()
+			
+			if batch_id is None:
+				os.remove(path)
+			else:
+				db.delete('batch@id@%s@open' % batch_id)
 		
-		conn.close()
-				
-		return json.JSONEncoder().encode(output), 200, {'Content-Type': 'application/json'}
+		yield json.dumps({'batch_id': batch_id, 'items': count, 'errors': errors}) + '\n'
+	
+	return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+#@app.route('/ingest', methods=['GET', 'POST'])
+def ingest():
+	"""View function for ingest. It takes json with items (by POST) to ingest or batch_id to show batch state. Tasks of POSTed batch are created in background by planBatch if INGEST_ASYNC or 'async' parameter is set, then 202 is returned."""
+	
+	### Show info about already started ingest (Batch) ###
+	if request.method == 'GET':
+		batch_id = request.args.get('batch_id', None)
+
+		if batch_id is None:
+			return "The batch ID must be provided", 400
+		
+		### Page of items from indexes of the Batch ###
+		if set(['cursor', 'limit', 'status', 'format']) & set(request.args.keys()):
+			return ingestPage(batch_id)
+		
+		result = sqlBatchItems(batch_id)
+		
+		if result is None:
+			return "Batch with provided ID doesn't exists", 400
+		
+		# items are loaded from sqlite in chunks, finished tasks are moved from redis to sqlite by compact.py, so status requests only read
+		output, next_cursor = result
+		
+		while next_cursor is not None:
+			chunk, next_cursor = sqlBatchItems(batch_id, None, next_cursor)
+			output.extend(chunk)
+		
+		return compressResponse(json.JSONEncoder(separators=(',', ':')).encode(output), {'Content-Type': 'application/json'})
 		
 	### New ingest ###
 	else:
@@ -436,180 +683,36 @@ def ingest():
 		if type(batch_data) is not list or len(batch_data) == 0:
 			return "JSON file must contains a List with at least one item", 400
 		
-		item_ids = []
+		item_ids = set()
 		errors = []
 		
 		### Validation ###
 		for order in range(0, len(batch_data)):
-			item = batch_data[order]
-			
-			if type(item) is not dict:
-				errors.append("The item num. %s must be inside of '{}'" % order)
-				continue
-			
-			item = dict((k.lower(), v) for k, v in item.iteritems())
-
-			if not item.has_key('id'):
-				errors.append("The item num. %s must have unique ID" % order)
-				continue
-			
-			if item['id'] in item_ids:
-				errors.append("The item num. %s must have unique ID" % order)
-				continue
-					
-			if not id_regular.match(item['id']):
-				errors.append("The item num. %s must have valid ID" % order)
-			
-			if item.has_key('status') and (len(item) != 2 or item['status'] != 'deleted'):
-				errors.append("The item num. %s has status, but it isn't set to 'deleted' or there are more fields" % order)
-				continue
-			
-			if item.has_key('status'):
-				continue
-			
-			### Another tests are useful only for items which aren't marked to be deleted ###
-			
-			### Convert some input field's names to the internal names ###
-			if item.has_key('institutionlink'):
-				item['institution_link'] = item['institutionlink']
-				item.pop('institutionlink', None)
-			if item.has_key('imageurl'):
-				item['url'] = item['imageurl']
-				item.pop('imageurl', None)
-			
-			if not item.has_key('url') or type(item['url']) != list or len(item['url']) == 0:
-				errors.append("The item num. %s doesn't have url field, or it isn't a list or a list is empty" % order)
-				continue
-			
-			for url in item['url']:
-				if not url_regular.match(url):
-					errors.append("The '%s' url in the item num. %s isn't valid url" % (url, order))
-			
-			for key in item.keys():
-				if key not in ['id', 'title', 'creator', 'source', 'institution', 'institution_link', 'license', 'description', 'url']:
-					errors.append("The item num. %s has a not allowed field '%s'" % (order, key))
-			
-			if item.has_key('source') and item['source'] and not url_regular.match(item['source']):
-				errors.append("The item num. %s doesn't have valid url '%s' in the Source field" % (order, item['source']))
-			
-			if item.has_key('institution_link') and item['institution_link'] and not url_regular.match(item['institution_link']):
-				errors.append("The item num. %s doesn't have valid url '%s' in the InstitutionLink field" % (order, item['institution_link']))
-			
-			if item.has_key('license') and item['license'] and not url_regular.match(item['license']):
-				errors.append("The item num. %s doesn't have valid url '%s' in the License field" % (order, item['license']))
-			
-			item_ids.append(item['id'])
-			batch_data[order] = item
+			batch_data[order], item_errors = validateItem(order, batch_data[order], item_ids)
+			errors.extend(item_errors)
 		
 		if errors:
 			return json.dumps({'errors': errors}), 400, {'Content-Type': 'application/json'}
 		
-		conn = sqlite3.connect(app.config['SQL_DB_URL'])
-		c = conn.cursor()
-		c.execute("INSERT INTO Batch(batch_data) VALUES (?)", (json.dumps(batch_data), ))
-		
-		batch_id = c.lastrowid
-		
-		conn.commit()
-		conn.close()
+		batch_id = insertBatch(getSqlConnection(), batch_data)
 
 		### Storing of compressed json with all ingest orders to local disk ###
-		f = gzip.open('/data/batch/%s.gz' % batch_id, 'wb')
+		f = gzip.open(os.path.join(app.config['BATCH_DIR'], '%s.gz' % batch_id), 'wb')
 		f.write(request.data)
 		f.close()
 
-		tasks = []
-		
-		### Processing items from ingest one by one ###
-		for item_data in batch_data:
-			item_id = item_data['id']
-
-			try:
-				old_item = Item(item_id)
-			except NoItemInDb, ErrorItemImport:
-				old_item = None
+		### Planning of tasks by the ingest worker ###
+		if request.args.get('async', app.config['INGEST_ASYNC'], type=int):
+			storeBatchPlan(batch_id, batch_data)
+			planBatch.delay(batch_id)
 			
-			### Delete a item ###
-			if item_data.has_key('status') and item_data['status'] == 'deleted':
-				# if there is no item --> nothing is going to be done
-				if old_item:
-					task_order = 0
-					
-					for url in old_item.url:
-						data = {'url': url, 'item_id': item_id, 'item_tasks_count': len(old_item.url), 'url_order': task_order, 'type': 'del'}
-						task = Task(batch_id, item_id, task_order, data)
-						tasks.append(task)
-						task_order += 1
-				else:
-					continue
-			
-			### Update or create a new item ###
-			else:
-				### Sanitising input ###
-				if item_data.has_key('title'):
-					item_data['title'] = bleach.clean(item_data['title'], tags=[], attributes=[], styles=[], strip=True)
-				if item_data.has_key('creator'):
-					item_data['creator'] = bleach.clean(item_data['creator'], tags=[], attributes=[], styles=[], strip=True)
-				if item_data.has_key('institution'):
-					item_data['institution'] = bleach.clean(item_data['institution'], tags=[], attributes=[], styles=[], strip=True)
-				if item_data.has_key('description'):
-					item_data['description'] = bleach.clean(item_data['description'], tags=ALLOWED_TAGS, attributes=[], styles=[], strip=True)
-					
-				### Already stored item ###
-				if old_item:
-					new_count = len(item_data['url'])
-					old_count = len(old_item.url)
-					update_list = []
-				
-					for url_order in range(0, max(new_count, old_count)):
-						if url_order < new_count and url_order < old_count:
-							# different url on the specific position --> overwrite
-							if item_data['url'][url_order] != old_item.url[url_order]:
-								data = {'url': item_data['url'][url_order], 'item_id': item_id, 'url_order': url_order, 'type': 'add'}
-								update_list.append(data)
-						else:
-							# end of both lists
-							if new_count == old_count:
-								break
-						
-							# a new url list is shorter than old one --> something to delelete
-							if url_order >= new_count:
-								data = {'url': old_item.url[url_order], 'item_id': item_id, 'url_order': url_order, 'type': 'del'}
-								update_list.append(data)
-							
-							# a new url list is longer than old one --> something to add
-							elif url_order >= old_count:
-								data = {'url': item_data['url'][url_order], 'item_id': item_id, 'url_order': url_order, 'type': 'add'}
-								update_list.append(data)
-					
-					### No change in url, change in other data possible ###
-					if not update_list:
-						data = {'item_id': item_id, 'type': 'mod', 'item_tasks_count': 1}
-						task = Task(batch_id, item_id, 0, data)
-						tasks.append(task)
-					else:
-						task_order = 0
-						
-						for data in update_list:
-							data['item_tasks_count'] = len(update_list)
-							task = Task(batch_id, item_id, task_order, data)
-							tasks.append(task)
-							task_order += 1
-						
-				### New item ###
-				else:
-					task_order = 0
-				
-					for url in item_data['url']:
-						data = {'url': url, 'item_id': item_id, 'url_order': task_order, 'item_data': item_data, 'item_tasks_count': len(item_data['url']), 'type': 'add'}
-						task = Task(batch_id, item_id, task_order, data)
-						tasks.append(task)
-						task_order += 1
-					
-			### Last task for specific item receives all item`s data ###
-			task.item_data = item_data
-			task.save()
-
+			return json.JSONEncoder().encode({'batch_id': batch_id}), 202, {'Content-Type': 'application/json'}
+		
+		# new tasks are sent to redis in chunks
+		pipe = db.pipeline(BATCH_SIZE)
+		tasks = processBatchItems(batch_id, batch_data, 0, pipe, app.extensions['caches']['sanitize'], getSanitizePool())
+		pipe.execute()
+		
 		### Putting all tasks to the queue ###
 		for task in tasks:
 			ingestQueue.delay(batch_id, task.item_id, task.task_id)
@@ -0,0 +1,179 @@
+"""Script which runs micro-benchmarks of embed application. Names of benchmarks to run can be passed as arguments, all benchmarks are run by default."""
+
+import sys
+import time
+import commands
+import multiprocessing
+
+import fakeredis
+import simplejson as json
+
+from app import app_factory
+from app.models import Item
+from app.db_wrapper import RecordCodec
+from app.manifest import createManifestFactory, renderManifest, buildManifest, buildValidatedManifest
+from app.validator import isUrl, url_regular, validateItem
+from app.sanitize import sanitizeItems, sanitizeValue, SANITIZED_FIELDS
+from app.cache import LRUCache
+
+
+def measure(fn, number=200, repeat=3):
+	"""Function which returns the best average duration of one call of function in milliseconds.
+	   'fn' - function to measure
+	   'number' - count of calls in one round
+	   'repeat' - count of rounds
+	"""
+
+	best = None
+
+	for r in range(repeat):
+		start = time.time()
+
+		for n in range(number):
+			fn()
+
+		duration = (time.time() - start) * 1000.0 / number
+
+		if best is None or duration < best:
+			best = duration
+
+	return best
+
+
+def report(name, duration):
+	print '%-50s %10.3f ms' % (name, duration)
+
+
+def benchmarkItem(item_id, count):
+	"""Function which returns Item with specified count of images for benchmarks.
+	   'item_id' - ID of the Item
+	   'count' - count of images in the Item
+	"""
+
+	urls = ['http://benchmark.org/%s/%s.jpg' % (item_id, i) for i in range(count)]
+	image_meta = dict((url, {'width': 4000 + i, 'height': 3000 + i}) for i, url in enumerate(urls))
+
+	return Item(item_id, {'url': urls, 'title': 'Benchmark title', 'creator': 'Benchmark creator', 'source': 'http://benchmark.org/source', 'institution': 'Benchmark institution', 'institution_link': 'http://benchmark.org', 'license': 'http://creativecommons.org/publicdomain/zero/1.0/', 'description': 'Benchmark description', 'image_meta': image_meta, 'timestamp': '2016-01-01T00:00:00.000000Z'})
+
+
+def benchManifestFactory(app):
+	"""Manifest rendering with a factory created per request (including lookup of ImageMagick) and with the process-wide factory"""
+
+	item = benchmarkItem('bench_factory', 2)
+	shared = app.extensions['manifest_factory']
+
+	with app.test_request_context():
+		def perRequest():
+			# the factory constructor used to look up ImageMagick every time
+			commands.getoutput('which identify')
+			app.extensions['manifest_factory'] = createManifestFactory(app.config)
+			renderManifest(item)
+
+		def processWide():
+			renderManifest(item)
+
+		report('manifest, factory per request', measure(perRequest, 50))
+		app.extensions['manifest_factory'] = shared
+		report('manifest, process-wide factory', measure(processWide, 50))
+
+
+def benchManifestBuilder(app):
+	"""Manifest rendering by the validating ManifestFactory and by the direct builder for items with 1, 10 and 500 images"""
+
+	with app.test_request_context():
+		for count in [1, 10, 500]:
+			item = benchmarkItem('bench_builder_%s' % count, count)
+			number = max(5, 500 / count)
+
+			report('manifest, %s images, ManifestFactory' % count, measure(lambda: json.JSONEncoder().encode(buildValidatedManifest(item)), number))
+			report('manifest, %s images, direct builder' % count, measure(lambda: json.JSONEncoder().encode(buildManifest(item)), number))
+
+
+def benchRecordCodec(app):
+	"""Encoding and decoding of Item and Task records by JSON, msgpack and msgpack with zlib, with size of encoded records"""
+
+	item = benchmarkItem('bench_codec', 5)
+	item.description = ' '.join(['Long description of the benchmark item.'] * 60)
+	item_record = {'url': item.url, 'title': item.title, 'creator': item.creator, 'source': item.source, 'institution': item.institution, 'institution_link': item.institution_link, 'license': item.license, 'description': item.description, 'image_meta': item.image_meta, 'timestamp': item.timestamp}
+	task_record = {'status': 'ok', 'url': item.url[0], 'url_order': 0, 'image_meta': {'width': 4000, 'height': 3000}, 'attempts': 0, 'type': 'add', 'item_data': {}, 'item_tasks_count': 5, 'message': 0}
+
+	for name, codec in [('json', RecordCodec('json')), ('msgpack', RecordCodec('msgpack', sys.maxint)), ('msgpack+zlib', RecordCodec('msgpack', 0))]:
+		for record_name, record in [('item', item_record), ('task', task_record)]:
+			data = codec.encode(record)
+			report('%s %s, encode (%s bytes)' % (record_name, name, len(data)), measure(lambda: codec.encode(record), 2000))
+			report('%s %s, decode' % (record_name, name), measure(lambda: codec.decode(data), 2000))
+
+
+def benchItemStorage(app):
+	"""Loading of fields and one image needed by oEmbed from Items with 1, 10 and 500 images stored in one record and in hashes"""
+	
+	fields = ['title', 'creator', 'source', 'institution', 'institution_link', 'timestamp']
+	
+	for count in [1, 10, 500]:
+		item = benchmarkItem('bench_storage_%s' % count, count)
+		url = item.url[-1]
+		number = max(20, 2000 / count)
+		
+		item.save('blob')
+		report('item, %s images, blob, whole item' % count, measure(lambda: Item(item.id).image_meta[url], number))
+		item.save('hash')
+		report('item, %s images, hash, whole item' % count, measure(lambda: Item(item.id).image_meta[url], number))
+		report('item, %s images, hash, oEmbed fields' % count, measure(lambda: Item(item.id, fields=fields).get_image_meta(url), number))
+
+
+def benchValidator(app):
+	"""Validation of urls by the regex and by the linear checker, for typical urls and for urls on which the regex backtracks, and validation of batches with 10k, 100k and 1M items"""
+
+	url = 'http://benchmark.org/iiif/bench_validator/0.jpg'
+	report('url, regex', measure(lambda: url_regular.match(url), 20000))
+	report('url, linear checker', measure(lambda: isUrl(url), 20000))
+
+	# time of the regex grows 4 times with every 2 characters of such url
+	for count in [12, 16, 20]:
+		pathological = 'http://' + '!' * count
+		report('url with %s invalid last characters, regex' % count, measure(lambda: url_regular.match(pathological), 1, 1))
+		report('url with %s invalid last characters, linear checker' % count, measure(lambda: isUrl(pathological), 1000))
+
+	for count in [10000, 100000, 1000000]:
+		def validateBatch():
+			item_ids = set()
+
+			# items are generated, so the 1M batch doesn't need to fit in memory
+			for order in xrange(count):
+				validateItem(order, {'id': 'bench_%s' % order, 'url': ['http://benchmark.org/%s/0.jpg' % order], 'title': 'Benchmark title', 'source': 'http://benchmark.org/source', 'license': 'http://creativecommons.org/publicdomain/zero/1.0/'}, item_ids)
+
+		report('batch, %s items' % count, measure(validateBatch, 1, 1))
+
+
+def benchSanitize(app):
+	"""Sanitization of museum dump with 10k items (distinct titles and descriptions, 200 creators and one institution) field by field, with deduplication of values, with a pool of processes and repeated with cached values"""
+
+	def museumDump():
+		return [{'id': 'bench_%s' % i, 'url': ['http://benchmark.org/%s/0.jpg' % i], 'title': 'Portrait of <i>Unknown Man</i> no. %s' % i, 'creator': 'Workshop of <b>Painter %s</b>' % (i % 200), 'institution': 'Benchmark Museum &amp; Gallery', 'description': '<p>Oil on canvas, <b>%s</b> x 60 cm.</p> <a href="http://benchmark.org">Collection</a> entry <em>%s</em>' % (i % 90, i)} for i in xrange(10000)]
+
+	def fieldByField():
+		for item_data in museumDump():
+			for field in SANITIZED_FIELDS:
+				item_data[field] = sanitizeValue((field == 'description', item_data[field]))
+
+	pool = multiprocessing.Pool(multiprocessing.cpu_count())
+
+	report('sanitize 10k items, field by field', measure(fieldByField, 1, 1))
+	report('sanitize 10k items, deduplicated', measure(lambda: sanitizeItems(museumDump(), LRUCache(100000)), 1, 1))
+	report('sanitize 10k items, deduplicated, %s processes' % multiprocessing.cpu_count(), measure(lambda: sanitizeItems(museumDump(), LRUCache(100000), pool), 1, 1))
+	cache = LRUCache(100000)
+	sanitizeItems(museumDump(), cache)
+	report('sanitize 10k items, repeated ingest (cached)', measure(lambda: sanitizeItems(museumDump(), cache), 1, 1))
+	pool.terminate()
+
+
+BENCHMARKS = [('manifest_factory', benchManifestFactory), ('manifest_builder', benchManifestBuilder), ('record_codec', benchRecordCodec), ('item_storage', benchItemStorage), ('validator', benchValidator), ('sanitize', benchSanitize)]
+
+if __name__ == '__main__':
+	app = app_factory(fakeredis.FakeStrictRedis())
+	names = sys.argv[1:]
+
+	for name, fn in BENCHMARKS:
+		if not names or name in names:
+			print '### %s: %s' % (name, fn.__doc__)
+			fn(app)
@@ -0,0 +1,216 @@
+"""Script which builds fingerprinted static files of embed application into static/dist. Names of built files contain hash of their content, so they can be cached forever. Text files are precompressed by gzip (and brotli if it is installed) and WOFF2 subsets of fonts are generated if fontTools is installed."""
+
+import os
+import re
+import sys
+import gzip
+import hashlib
+import posixpath
+from cStringIO import StringIO
+
+import simplejson as json
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+try:
+	from fontTools import subset as font_subset
+except ImportError:
+	font_subset = None
+
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app', 'static')
+
+# Files which are never changed by the build, they are processed before the files which refer to them
+BINARY_EXTENSIONS = ['.png', '.jpg', '.gif', '.ico', '.ttf', '.woff', '.woff2', '.map']
+# Files which are precompressed
+COMPRESSED_EXTENSIONS = ['.css', '.js', '.map', '.svg', '.ttf', '.json']
+# Characters kept in WOFF2 subsets of fonts: Basic Latin, Latin-1 Supplement, Latin Extended-A and general punctuation
+FONT_UNICODES = range(0x20, 0x7f) + range(0xa0, 0x180) + range(0x2000, 0x2070) + [0x20ac]
+
+css_url_regular = re.compile(r"""url\(\s*['"]?(?P<path>[^'")]+?)['"]?\s*\)""")
+source_map_regular = re.compile(r'sourceMappingURL=(?P<path>\S+)')
+static_regular = re.compile(r"""static/(?P<path>[-_.a-zA-Z0-9/]+\.[a-zA-Z0-9]+)""")
+
+
+def fingerprint(path, data):
+	"""Function which returns path of file with hash of its content in its name.
+	   'path' - path of the file relative to static folder
+	   'data' - content of the file
+	"""
+
+	base, ext = posixpath.splitext(path)
+
+	return '%s.%s%s' % (base, hashlib.md5(data).hexdigest()[:10], ext)
+
+
+def subsetFont(data):
+	"""Function which returns WOFF2 subset of TrueType font with characters needed by European languages or None if fontTools or brotli isn't installed.
+	   'data' - content of the TrueType font
+	"""
+
+	if font_subset is None or brotli is None:
+		return None
+
+	options = font_subset.Options()
+	options.flavor = 'woff2'
+	options.layout_features = ['*']
+	font = font_subset.load_font(StringIO(data), options)
+	subsetter = font_subset.Subsetter(options)
+	subsetter.populate(unicodes=FONT_UNICODES)
+	subsetter.subset(font)
+	output = StringIO()
+	font_subset.save_font(font, output, options)
+
+	return output.getvalue()
+
+
+def rewriteReferences(path, data, assets, fonts):
+	"""Function which replaces references to other static files by their fingerprinted names.
+	   'path' - path of the file relative to static folder
+	   'data' - content of the file
+	   'assets' - dictionary with paths of built files and their fingerprinted paths
+	   'fonts' - dictionary with paths of fonts and fingerprinted paths of their WOFF2 subsets
+	"""
+
+	directory = posixpath.dirname(path)
+
+	def relative(reference):
+		if reference.startswith('/static/'):
+			return reference[len('/static/'):], '/static/dist/'
+		if '://' in reference or reference.startswith('/') or reference.startswith('data:'):
+			return None, None
+		return posixpath.normpath(posixpath.join(directory, reference)), ''
+
+	def replaceUrl(match):
+		target, prefix = relative(match.group('path'))
+
+		if target not in assets:
+			return match.group(0)
+
+		if prefix:
+			url = prefix + assets[target]
+		else:
+			url = posixpath.relpath(assets[target], directory)
+
+		if target not in fonts:
+			return 'url(%s)' % url
+
+		# browsers which support WOFF2 don't download the TrueType font
+		return 'url(%s) format("woff2"), url(%s) format("truetype")' % (posixpath.relpath(fonts[target], directory), url)
+
+	def replaceSourceMap(match):
+		target, prefix = relative(match.group('path'))
+
+		if target not in assets:
+			return match.group(0)
+
+		return 'sourceMappingURL=%s' % posixpath.relpath(assets[target], directory)
+
+	def replaceStatic(match):
+		if match.group('path') not in assets:
+			return match.group(0)
+
+		return 'static/dist/%s' % assets[match.group('path')]
+
+	if path.endswith('.css'):
+		data = css_url_regular.sub(replaceUrl, data)
+
+	data = source_map_regular.sub(replaceSourceMap, data)
+
+	return static_regular.sub(replaceStatic, data)
+
+
+def writeFile(dist_dir, path, data):
+	"""Function which writes built file and its precompressed variants.
+	   'dist_dir' - folder with built files
+	   'path' - fingerprinted path of the file
+	   'data' - content of the file
+	"""
+
+	filename = os.path.join(dist_dir, path)
+
+	if not os.path.exists(os.path.dirname(filename)):
+		os.makedirs(os.path.dirname(filename))
+
+	f = open(filename, 'wb')
+	f.write(data)
+	f.close()
+
+	if posixpath.splitext(path)[1] not in COMPRESSED_EXTENSIONS:
+		return
+
+	output = StringIO()
+	# fixed mtime keeps the builds reproducible
+	gz = gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=output, mtime=0)
+	gz.write(data)
+	gz.close()
+
+	variants = [('.gz', output.getvalue())]
+
+	if brotli is not None:
+		variants.append(('.br', brotli.compress(data)))
+
+	for suffix, compressed in variants:
+		if len(compressed) < len(data):
+			f = open(filename + suffix, 'wb')
+			f.write(compressed)
+			f.close()
+
+
+def buildAssets(static_dir=STATIC_DIR):
+	"""Function which builds fingerprinted static files into 'dist' folder and writes 'assets.json' with their names. It returns the dictionary from 'assets.json'.
+	   'static_dir' - static folder of embed application
+	"""
+
+	dist_dir = os.path.join(static_dir, 'dist')
+	paths = []
+
+	for root, dirs, files in os.walk(static_dir):
+		# files of previous builds are kept, published pages and cached pages can still refer to them
+		if root == static_dir and 'dist' in dirs:
+			dirs.remove('dist')
+
+		for filename in files:
+			paths.append(os.path.relpath(os.path.join(root, filename), static_dir).replace(os.sep, '/'))
+
+	# files which refer to others are built after them
+	paths.sort(key=lambda path: (posixpath.splitext(path)[1] not in BINARY_EXTENSIONS, path))
+
+	assets = {}
+	fonts = {}
+
+	for path in paths:
+		f = open(os.path.join(static_dir, path), 'rb')
+		data = f.read()
+		f.close()
+
+		if posixpath.splitext(path)[1] not in BINARY_EXTENSIONS:
+			data = rewriteReferences(path, data, assets, fonts)
+
+		assets[path] = fingerprint(path, data)
+		writeFile(dist_dir, assets[path], data)
+
+		if path.endswith('.ttf'):
+			woff2 = subsetFont(data)
+
+			if woff2 is not None:
+				fonts[path] = fingerprint(posixpath.splitext(path)[0] + '.woff2', woff2)
+				writeFile(dist_dir, fonts[path], woff2)
+
+	f = open(os.path.join(dist_dir, 'assets.json'), 'w')
+	f.write(json.dumps(assets, indent=2, sort_keys=True))
+	f.close()
+
+	return assets
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		assets = buildAssets(sys.argv[1])
+	else:
+		assets = buildAssets()
+
+	print '%s static files built' % len(assets)
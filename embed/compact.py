@@ -0,0 +1,54 @@
+"""Script which archives tasks of finished ingest batches from redis to sqlite. Usage: python compact.py [loop | <batch_id> ...]
+
+Without arguments all finished batches are compacted once, with 'loop' they are compacted every COMPACT_INTERVAL seconds (it is run so by supervisord). Batches started before their indexes were introduced are compacted when their IDs are passed, only their finished items are archived."""
+
+import os
+import sys
+import time
+import traceback
+
+import redis
+
+from app.models import db
+from app.compact import compactBatch, compactFinishedBatches, batchItemIds
+from app.batch_db import connect
+
+
+# Number in seconds between compactions in loop
+COMPACT_INTERVAL = int(os.getenv('COMPACT_INTERVAL', 60))
+
+
+def connectSql():
+	return connect(os.getenv('SQL_DB_URL', '/data/sql/db.db'), float(os.getenv('SQL_TIMEOUT', 30)))
+
+
+if __name__ == '__main__':
+	db.init_db(redis.StrictRedis(host=os.getenv('REDIS_SERVER', 'localhost'), port=int(os.getenv('REDIS_PORT_NUMBER', 6379)), db=0))
+	conn = connectSql()
+
+	if len(sys.argv) > 1 and sys.argv[1] != 'loop':
+		for batch_id in sys.argv[1:]:
+			item_ids = batchItemIds(conn, batch_id)
+
+			if item_ids is None:
+				print 'Batch %s doesn\'t exist' % batch_id
+			else:
+				print 'Batch %s: %s tasks archived' % (batch_id, compactBatch(conn, batch_id, item_ids))
+
+		sys.exit(0)
+
+	while True:
+		try:
+			for batch_id, count in sorted(compactFinishedBatches(conn).items()):
+				print 'Batch %s: %s tasks archived' % (batch_id, count)
+		except:
+			# the compaction is repeated in next loop, compacted items are skipped
+			print 'Compaction failed:\n###\n%s###' % traceback.format_exc()
+			conn.close()
+			conn = connectSql()
+
+		if len(sys.argv) == 1:
+			break
+
+		sys.stdout.flush()
+		time.sleep(COMPACT_INTERVAL)
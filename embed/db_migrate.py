@@ -0,0 +1,100 @@
+"""Script which migrates data stored in redis. Name of migration has to be passed as argument, ingest should be stopped while the migration runs."""
+
+import os
+import re
+import sys
+
+import redis
+
+from app.models import db, Item
+from app.collection import indexItem
+
+
+def migrateCodec():
+	"""Re-encodes all Item and Task records by the codec set by RECORD_CODEC environment variable"""
+	
+	count = 0
+	
+	for pattern in ['item_id@*', 'batch@id@*@task@id@*']:
+		for key in db.scan_iter(pattern):
+			record = db.get_record(key)
+			
+			if record is not None:
+				db.set_record(key, record)
+				count += 1
+	
+	# metadata of images of Items stored in hashes are encoded by the codec too
+	for key in db.scan_iter('item@*'):
+		Item(key[len('item@'):]).save('hash')
+		count += 1
+	
+	print '%s records re-encoded by %s codec' % (count, db.codec.name)
+
+
+def migrateStorage(storage):
+	"""Function which stores all Items in specified storage layout.
+	   'storage' - storage layout, 'blob' or 'hash'
+	"""
+	
+	item_ids = Item.get_ids()
+	
+	for item_id in item_ids:
+		Item(item_id).save(storage)
+	
+	print '%s items stored in %s layout, set ITEM_STORAGE=%s for embed and ingest' % (len(item_ids), storage, storage)
+
+
+def migrateHash():
+	"""Stores all Items in redis hashes, so their fields and images can be read separately"""
+	
+	migrateStorage('hash')
+
+
+def migrateBlob():
+	"""Stores all Items back in one record per Item"""
+	
+	migrateStorage('blob')
+
+
+def migrateCollections():
+	"""Builds indexes of batch and institution collections from stored tasks and Items"""
+	
+	task_key = re.compile(r'^batch@id@(?P<batch_id>[^@]+)@item@id(?P<item_id>.+)@task@id@\d+$')
+	batches = {}
+	
+	for key in db.scan_iter('batch@id@*@task@id@*'):
+		test = task_key.match(key)
+		
+		if test:
+			batches.setdefault(test.group('item_id'), set()).add(test.group('batch_id'))
+	
+	item_ids = Item.get_ids() | set(batches.keys())
+	count = 0
+	
+	for item_id in item_ids:
+		try:
+			item = Item(item_id)
+		except:
+			continue
+		
+		for batch_id in sorted(batches.get(item_id, [None])):
+			indexItem(batch_id, item)
+		
+		count += 1
+	
+	print '%s items indexed in collections' % count
+
+
+MIGRATIONS = {'codec': migrateCodec, 'hash': migrateHash, 'blob': migrateBlob, 'collections': migrateCollections}
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2 or sys.argv[1] not in MIGRATIONS:
+		print 'Usage: python db_migrate.py <migration>\n'
+		
+		for name, fn in sorted(MIGRATIONS.items()):
+			print '%-10s %s' % (name, fn.__doc__)
+		
+		sys.exit(1)
+	
+	db.init_db(redis.StrictRedis(host=os.getenv('REDIS_SERVER', 'localhost'), port=int(os.getenv('REDIS_PORT_NUMBER', 6379)), db=0))
+	MIGRATIONS[sys.argv[1]]()
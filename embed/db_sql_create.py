@@ -1,10 +1,47 @@
-import sqlite3
+"""Script which creates sqlite database of ingest batches and migrates batches stored as one JSON blob to BatchItem table"""
 
-conn = sqlite3.connect('data/sql/db.db')
-c = conn.cursor()
-c.execute("CREATE TABLE IF NOT EXISTS Batch (batch_id INTEGER PRIMARY KEY AUTOINCREMENT, batch_data TEXT)")
-c.execute("CREATE TABLE IF NOT EXISTS Task (task_id INTEGER, batch_id INTEGER, item_id VARCHAR(256), status VARCHAR(16), url TEXT, message INTEGER)")
-c.execute("CREATE INDEX IF NOT EXISTS test_index ON Task (batch_id, item_id)")
+import simplejson as json
 
-conn.commit()
-conn.close()
+from app.batch_db import connect, createSchema, itemRow, itemTasks, SQL_INSERT_ITEM
+from app.db_wrapper import BATCH_SIZE
+from app.ingest import batchItemStatus
+
+
+def migrateBatches(conn):
+	"""Function which stores items of batches which have only JSON blob to BatchItem table. Statuses of items are taken from archived tasks, items whose tasks aren't archived are pending until compact.py archives them. It returns count of migrated batches.
+	   'conn' - sqlite connection
+	"""
+
+	batch_ids = [row[0] for row in conn.execute("SELECT batch_id FROM Batch WHERE batch_data IS NOT NULL AND batch_id NOT IN (SELECT DISTINCT batch_id FROM BatchItem)")]
+
+	for batch_id in batch_ids:
+		batch_data = json.loads(conn.execute("SELECT batch_data FROM Batch WHERE batch_id=?", (batch_id,)).fetchone()[0])
+		rows = []
+
+		for order, item_data in enumerate(batch_data):
+			row = itemRow(batch_id, order, item_data)
+			tasks = itemTasks(conn, batch_id, item_data['id'])
+
+			if tasks and row[3] != 'deleted':
+				row = row[:3] + (batchItemStatus(item_data, tasks)['status'],) + row[4:]
+
+			rows.append(row)
+
+		for i in range(0, len(rows), BATCH_SIZE):
+			conn.executemany(SQL_INSERT_ITEM, rows[i:i + BATCH_SIZE])
+
+		# the blob is kept, the original batch is archived in /data/batch anyway
+		conn.commit()
+
+	return len(batch_ids)
+
+
+if __name__ == '__main__':
+	conn = connect('data/sql/db.db', 30)
+	createSchema(conn)
+	count = migrateBatches(conn)
+
+	if count:
+		print '%s batches migrated to BatchItem table' % count
+
+	conn.close()
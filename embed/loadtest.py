@@ -0,0 +1,81 @@
+"""Script which measures throughput of running embed server for increasing count of concurrent clients. Usage: python loadtest.py <url> [seconds] [max_clients]
+
+Clients run in separate processes, so the load test itself isn't limited by one core. Throughput should grow with clients until all uwsgi processes and threads (UWSGI_PROCESSES, UWSGI_THREADS) or all cores of the server are used."""
+
+import sys
+import time
+import urllib2
+import multiprocessing
+
+
+def client(url, deadline, results):
+	"""Function which requests url until deadline and puts count of successful and failed requests and sum of latencies to queue.
+	   'url' - requested url
+	   'deadline' - time when the client stops
+	   'results' - queue for results
+	"""
+
+	ok = 0
+	failed = 0
+	latency = 0.0
+
+	while time.time() < deadline:
+		start = time.time()
+
+		try:
+			urllib2.urlopen(url, timeout=30).read()
+			ok += 1
+			latency += time.time() - start
+		except:
+			failed += 1
+
+	results.put((ok, failed, latency))
+
+
+def run(url, clients, seconds):
+	"""Function which runs clients concurrently and returns count of successful and failed requests and average latency in milliseconds.
+	   'url' - requested url
+	   'clients' - count of concurrent clients
+	   'seconds' - duration of the test
+	"""
+
+	results = multiprocessing.Queue()
+	deadline = time.time() + seconds
+	processes = [multiprocessing.Process(target=client, args=(url, deadline, results)) for i in range(clients)]
+
+	for process in processes:
+		process.start()
+
+	ok, failed, latency = 0, 0, 0.0
+
+	for process in processes:
+		result = results.get()
+		ok += result[0]
+		failed += result[1]
+		latency += result[2]
+
+	for process in processes:
+		process.join()
+
+	if ok:
+		latency = latency * 1000.0 / ok
+
+	return ok, failed, latency
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		print __doc__
+		sys.exit(1)
+
+	url = sys.argv[1]
+	seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+	max_clients = int(sys.argv[3]) if len(sys.argv) > 3 else multiprocessing.cpu_count() * 4
+
+	print '%8s %12s %10s %12s' % ('clients', 'requests/s', 'failed', 'latency ms')
+	clients = 1
+
+	while clients <= max_clients:
+		ok, failed, latency = run(url, clients, seconds)
+		print '%8s %12.1f %10s %12.2f' % (clients, ok / float(seconds), failed, latency)
+		clients *= 2
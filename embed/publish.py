@@ -0,0 +1,44 @@
+"""Script which publishes all Items as static files to PUBLISH_DIR, so nginx can serve them without embed application. Count of processes can be passed as argument."""
+
+import os
+import sys
+import multiprocessing
+
+import redis
+
+from app.models import db, Item
+from app.publish import PUBLISH_DIR, publishItem, unpublishItem
+
+
+def initWorker():
+	# every process needs its own connection to redis
+	db.init_db(redis.StrictRedis(host=os.getenv('REDIS_SERVER', 'localhost'), port=int(os.getenv('REDIS_PORT_NUMBER', 6379)), db=0))
+
+
+if __name__ == '__main__':
+	if not PUBLISH_DIR:
+		print 'PUBLISH_DIR environment variable has to be set'
+		sys.exit(1)
+	
+	if len(sys.argv) > 1:
+		processes = int(sys.argv[1])
+	else:
+		processes = multiprocessing.cpu_count()
+	
+	initWorker()
+	item_ids = Item.get_ids()
+	
+	pool = multiprocessing.Pool(processes, initWorker)
+	published = sum(pool.imap_unordered(publishItem, item_ids, 50))
+	pool.close()
+	pool.join()
+	
+	# files of Items which were deleted while publishing was disabled
+	removed = 0
+	
+	for item_id in os.listdir(PUBLISH_DIR):
+		if item_id != '@tmp' and item_id not in item_ids:
+			unpublishItem(item_id)
+			removed += 1
+	
+	print '%s items published, %s removed' % (published, removed)
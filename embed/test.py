@@ -1,16 +1,62 @@
 """Script which runs unittests"""
 
 import os
+import time
+import gzip
+import shutil
+import sqlite3
+import posixpath
+import random
+import multiprocessing
+import tempfile
 import unittest
 
+import bleach
 import fakeredis
 import simplejson as json
 
 from app import app_factory
-from app.models import Item
+from app.models import Item, Task, ITEM_CHANNEL
+from app.db_wrapper import RecordCodec, BATCH_SIZE
+from app.exceptions import NoItemInDb
+from app.manifest import createManifestFactory, buildManifest, buildValidatedManifest, loadManifest
+from app import manifest as manifest_module
+from app.helper import gunzipData, closeSqlConnection
+from app import helper
+from app.ingest import ingestQueue, planBatch, addBatchItems, processBatchItems, countBatchItem, ERR_MESSAGE_HTTP
+from app import views
+from app import ingest
+from app.validator import isUrl, url_regular
+from app import sanitize
+from app.sanitize import sanitizeItems, sanitizedSize, ALLOWED_TAGS
+from app.cache import LRUCache
+from app.compact import compactBatch, compactFinishedBatches, COMPACT_COUNTER_TTL
+from app.batch_db import connect, createSchema, insertBatch, iterBatchItems
+from db_sql_create import migrateBatches
+from app import collection
+from app import publish
+from app.publish import publishItem, unpublishItem
+from build_assets import buildAssets
+import build_assets
 
 import logging
 
+class FakeQueue():
+	"""Class which replaces celery task in tests, arguments of calls are recorded instead of putting them to the queue.
+	'errors' - count of next calls which fail as if the broker was unavailable
+	"""
+	
+	def __init__(self):
+		self.calls = []
+		self.errors = 0
+	
+	def delay(self, *args):
+		if self.errors:
+			self.errors -= 1
+			raise IOError('Broker is unavailable')
+		
+		self.calls.append(args)
+
 class EmbedTestCase(unittest.TestCase):
 	def setUp(self):
 		app = app_factory(fakeredis.FakeStrictRedis())
@@ -19,12 +65,51 @@ class EmbedTestCase(unittest.TestCase):
 			SERVER_NAME='127.0.0.1:5000',
 			IIIF_SERVER='iiifhawk.klokantech.com'
 		)
+		# the factory is created by app_factory from configuration which is changed above
+		app.extensions['manifest_factory'] = createManifestFactory(app.config)
 		
+		self.flask_app = app
 		self.app = app.test_client()
-		app.extensions['redis'].set('item_id@test_id', json.dumps({'url': ['http://unittest_url.org', 'http://unittest_url2.org'], 'title': 'Unittest title', 'creator': 'Unittest creator', 'source': 'http://unittest_source.org','institution': 'Unittest institution', 'institution_link': 'http://unittest_institution_link.org', 'license': 'http://unittest_license_link.org', 'description': 'Unittest description', 'image_meta': {'http://unittest_url.org': {'width': 1000, 'height': 1000, 'filename': 'test_id.jp2', 'order': 0}, 'http://unittest_url2.org': {'width': 100, 'height': 100, 'filename': 'test_id/1.jp2', 'order': 1}}, 'lock': False}))
+		self.db = app.extensions['redis']
+		self.pubsub = self.db.pubsub()
+		self.pubsub.subscribe(ITEM_CHANNEL)
+		# confirmation of subscription
+		self.pubsub.get_message()
+		self.db.set('item_id@test_id', json.dumps({'url': ['http://unittest_url.org', 'http://unittest_url2.org'], 'title': 'Unittest title', 'creator': 'Unittest creator', 'source': 'http://unittest_source.org','institution': 'Unittest institution', 'institution_link': 'http://unittest_institution_link.org', 'license': 'http://unittest_license_link.org', 'description': 'Unittest description', 'image_meta': {'http://unittest_url.org': {'width': 1000, 'height': 1000, 'filename': 'test_id.jp2', 'order': 0}, 'http://unittest_url2.org': {'width': 100, 'height': 100, 'filename': 'test_id/1.jp2', 'order': 1}}, 'lock': False}))
 
 	def tearDown(self):
-		pass
+		self.pubsub.close()
+		# databases of tests are removed with their directories
+		closeSqlConnection()
+	
+	def batchDirectory(self):
+		"""Method which configures temporary directory of batches with sqlite database for the test and returns connection to the database. The directory is removed after the test."""
+		
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		self.flask_app.config.update(SQL_DB_URL=os.path.join(directory, 'db.db'), BATCH_DIR=directory)
+		conn = connect(self.flask_app.config['SQL_DB_URL'], 1)
+		self.addCleanup(conn.close)
+		createSchema(conn)
+		
+		return conn
+	
+	def fakeQueue(self, module, name):
+		"""Method which replaces celery task imported by module with FakeQueue for the test and returns the FakeQueue"""
+		
+		queue = FakeQueue()
+		self.addCleanup(setattr, module, name, getattr(module, name))
+		setattr(module, name, queue)
+		
+		return queue
+	
+	def deliverInvalidations(self):
+		# messages are delivered by the listener thread in the running application
+		message = self.pubsub.get_message()
+		
+		while message:
+			self.flask_app.extensions['item_listener'].invalidate(message['data'])
+			message = self.pubsub.get_message()
 	
 	def test_root(self):
 		rv = self.app.get('/')
@@ -66,10 +151,131 @@ class EmbedTestCase(unittest.TestCase):
 		assert rv.status_code == 404
 		assert 'Wrong item sequence' in rv.data
 
+	def test_iFrame5(self):
+		# descriptors for zooming are backfilled on the first request
+		rv = self.app.get('/test_id')
+		assert rv.status_code == 200
+		stored = self.db.get('tile_sources@test_id').split('\n')
+		assert stored[:2] == ['', 'iiifhawk.klokantech.com']
+		assert len(stored) == 4
+		
+		# and then only spliced into the page
+		self.db.set('tile_sources@test_id', '\n'.join(stored[:2] + ['{"stored": 0}', '{"stored": 1}']))
+		rv = self.app.get('/test_id/1')
+		assert rv.status_code == 200
+		assert 'tileSources: [{"stored": 1}]' in rv.data
+		
+		# outdated descriptors are computed again
+		item = Item('test_id')
+		item.timestamp = '2016-01-01T10:00:00.000000Z'
+		item.save()
+		self.deliverInvalidations()
+		rv = self.app.get('/test_id/1')
+		assert rv.status_code == 200
+		assert '"@id": "http://iiifhawk.klokantech.com/test_id/1"' in rv.data
+	
+	def test_iFrame6(self):
+		# descriptors stored by the ingest worker are reused by the viewer configured with the same server
+		self.flask_app.config['IIIF_SERVER'] = helper.IIIF_SERVER
+		item = Item('test_id')
+		helper.storeTileSources(item, helper.IIIF_SERVER)
+		self.db.set('tile_sources@test_id', self.db.get('tile_sources@test_id').replace('"order": 1', '"order": 1, "stored": 1'))
+		rv = self.app.get('/test_id/1')
+		assert rv.status_code == 200
+		assert '"stored": 1' in rv.data
+		
+		# which is the default configuration
+		assert app_factory(fakeredis.FakeStrictRedis()).config['IIIF_SERVER'] == helper.IIIF_SERVER
+	
 	def test_iiifMeta0(self):
 		rv = self.app.get('/test_id/manifest.json')
 		assert rv.status_code == 200
-		assert '''{"@context": "http://iiif.io/api/presentation/2/context.json", "@id": "http://127.0.0.1:5000/test_id/manifest.json", "@type": "sc:Manifest", "label": "Unittest title", "metadata": [{"label": "Author", "value": "Unittest creator"}, {"label": "Source", "value": "http://unittest_source.org"}, {"label": "Institution", "value": "Unittest institution"}, {"label": "Institution link", "value": "http://unittest_institution_link.org"}], "description": "Unittest description", "license": "http://unittest_license_link.org", "sequences": [{"@id": "http://127.0.0.1:5000/sequence/s.json", "@type": "sc:Sequence", "label": "Item test_id - sequence 1", "canvases": [{"@id": "http://127.0.0.1:5000/canvas/c0.json", "@type": "sc:Canvas", "label": "Item test_id - image 0", "height": 1000, "width": 1000, "images": [{"@type": "oa:Annotation", "motivation": "sc:painting", "resource": {"@id": "http://iiifhawk.klokantech.com/test_id/full/full/0/native.jpg", "@type": "dctypes:Image", "height": 1000, "width": 1000, "service": {"@context": "http://iiif.io/api/image/2/context.json", "@id": "http://iiifhawk.klokantech.com/test_id", "profile": "http://iiif.io/api/image/2/profiles/level2.json"}}, "on": "http://127.0.0.1:5000/canvas/c0.json"}]}, {"@id": "http://127.0.0.1:5000/canvas/c1.json", "@type": "sc:Canvas", "label": "Item test_id - image 1", "height": 100, "width": 100, "images": [{"@type": "oa:Annotation", "motivation": "sc:painting", "resource": {"@id": "http://iiifhawk.klokantech.com/test_id/1/full/full/0/native.jpg", "@type": "dctypes:Image", "height": 100, "width": 100, "service": {"@context": "http://iiif.io/api/image/2/context.json", "@id": "http://iiifhawk.klokantech.com/test_id/1", "profile": "http://iiif.io/api/image/2/profiles/level2.json"}}, "on": "http://127.0.0.1:5000/canvas/c1.json"}]}]}]}''' in rv.data
+		assert '''{"@context":"http://iiif.io/api/presentation/2/context.json","@id":"http://127.0.0.1:5000/test_id/manifest.json","@type":"sc:Manifest","label":"Unittest title","metadata":[{"label":"Author","value":"Unittest creator"},{"label":"Source","value":"http://unittest_source.org"},{"label":"Institution","value":"Unittest institution"},{"label":"Institution link","value":"http://unittest_institution_link.org"}],"description":"Unittest description","license":"http://unittest_license_link.org","sequences":[{"@id":"http://127.0.0.1:5000/sequence/s.json","@type":"sc:Sequence","label":"Item test_id - sequence 1","canvases":[{"@id":"http://127.0.0.1:5000/canvas/c0.json","@type":"sc:Canvas","label":"Item test_id - image 0","height":1000,"width":1000,"images":[{"@type":"oa:Annotation","motivation":"sc:painting","resource":{"@id":"http://iiifhawk.klokantech.com/test_id/full/full/0/native.jpg","@type":"dctypes:Image","height":1000,"width":1000,"service":{"@context":"http://iiif.io/api/image/2/context.json","@id":"http://iiifhawk.klokantech.com/test_id","profile":"http://iiif.io/api/image/2/profiles/level2.json"}},"on":"http://127.0.0.1:5000/canvas/c0.json"}]},{"@id":"http://127.0.0.1:5000/canvas/c1.json","@type":"sc:Canvas","label":"Item test_id - image 1","height":100,"width":100,"images":[{"@type":"oa:Annotation","motivation":"sc:painting","resource":{"@id":"http://iiifhawk.klokantech.com/test_id/1/full/full/0/native.jpg","@type":"dctypes:Image","height":100,"width":100,"service":{"@context":"http://iiif.io/api/image/2/context.json","@id":"http://iiifhawk.klokantech.com/test_id/1","profile":"http://iiif.io/api/image/2/profiles/level2.json"}},"on":"http://127.0.0.1:5000/canvas/c1.json"}]}]}]}''' in rv.data
+	
+	def test_iiifMeta1(self):
+		rv = self.app.get('/test_id/manifest.json')
+		assert rv.status_code == 200
+		assert gunzipData(self.db.get('manifest@test_id').split('\n', 1)[1]) == rv.data
+		
+		item = Item('test_id')
+		item.title = 'Unittest changed title'
+		item.timestamp = '2016-01-01T00:00:00.000000Z'
+		item.save()
+		self.deliverInvalidations()
+		
+		rv = self.app.get('/test_id/manifest.json')
+		assert rv.status_code == 200
+		assert '"label":"Unittest changed title"' in rv.data
+		timestamp, manifest = self.db.get('manifest@test_id').split('\n', 1)
+		assert timestamp == '2016-01-01T00:00:00.000000Z'
+		assert gunzipData(manifest) == rv.data
+		
+		item.delete()
+		assert self.db.get('manifest@test_id') is None
+		self.deliverInvalidations()
+		assert self.app.get('/test_id/manifest.json').status_code == 404
+	
+	def test_iiifMeta2(self):
+		rv = self.app.get('/test_id/manifest.json')
+		assert rv.status_code == 200
+		# ImageMagick is looked up only when the size of image file is needed
+		assert self.app.application.extensions['manifest_factory']._whichid is None
+	
+	def test_iiifMeta3(self):
+		# the direct builder must produce the same manifest as the validating factory
+		for count in [1, 2, 10]:
+			urls = ['http://unittest_url.org/%s' % i for i in range(count)]
+			item = Item('golden_id', {'url': urls, 'title': 'Golden title', 'creator': 'Golden creator', 'source': 'http://golden_source.org', 'institution': '', 'institution_link': 'http://golden_institution.org', 'license': '', 'description': 'Golden description', 'image_meta': dict((url, {'width': 100 * (i + 1), 'height': 50 + i}) for i, url in enumerate(urls))})
+			item.image_meta[urls[0]] = {}
+			
+			with self.flask_app.test_request_context():
+				self.assertEqual(json.JSONEncoder().encode(buildValidatedManifest(item)), json.JSONEncoder().encode(buildManifest(item)))
+	
+	def test_iiifMeta4(self):
+		item = Item('test_id')
+		item.timestamp = '2016-01-01T10:00:00.000000Z'
+		item.save()
+		self.deliverInvalidations()
+		
+		rv = self.app.get('/test_id/manifest.json', headers={'Accept-Encoding': 'gzip, deflate'})
+		assert rv.status_code == 200
+		assert rv.headers['Content-Encoding'] == 'gzip'
+		assert rv.headers['Vary'] == 'Accept-Encoding'
+		manifest = self.app.get('/test_id/manifest.json')
+		assert 'Content-Encoding' not in manifest.headers
+		assert gunzipData(rv.data) == manifest.data
+		# compressed and uncompressed manifests are different representations
+		assert rv.headers['ETag'] != manifest.headers['ETag']
+		assert self.app.get('/test_id/manifest.json', headers={'Accept-Encoding': 'gzip;q=0'}).data == manifest.data
+	
+	def test_iiifMeta5(self):
+		render = manifest_module.renderManifest
+		
+		def renderExpired(item):
+			# the lock expires and another process takes it while the manifest is rendered
+			self.db.delete('manifest_lock@test_id')
+			self.db.setnx('manifest_lock@test_id', 'another process', 10)
+			
+			return render(item)
+		
+		manifest_module.renderManifest = renderExpired
+		self.addCleanup(setattr, manifest_module, 'renderManifest', render)
+		
+		with self.flask_app.test_request_context():
+			loadManifest(Item('test_id'))
+		
+		# lock of another process isn't released
+		assert self.db.get('manifest_lock@test_id') == 'another process'
+		assert self.db.get('manifest@test_id') is not None
+		
+		# own lock is released
+		manifest_module.renderManifest = render
+		self.db.delete_many(['manifest@test_id', 'manifest_lock@test_id'])
+		
+		with self.flask_app.test_request_context():
+			loadManifest(Item('test_id'))
+		
+		assert self.db.get('manifest_lock@test_id') is None
 	
 	def test_oEmbed0(self):
 		rv = self.app.get('/oembed')
@@ -140,6 +346,349 @@ class EmbedTestCase(unittest.TestCase):
 		assert rv.status_code == 200
 		self.assertEqual('{"provider_url": "http://unittest_institution_link.org", "title": "Unittest title", "html": "<iframe src=\\"http://media.embedr.eu/test_id\\" width=25 height=25 frameborder=0 allowfullscreen>", "author_name": "Unittest creator", "version": "1.0", "author_url": "http://unittest_source.org", "provider_name": "Unittest institution", "type": "rich"}',rv.data,rv.data)
 
+	def test_conditional0(self):
+		item = Item('test_id')
+		item.timestamp = '2016-01-01T10:00:00.000000Z'
+		item.save()
+		self.deliverInvalidations()
+		
+		for url in ['/test_id', '/test_id/1', '/test_id/manifest.json', '/oembed?url=http%3A//127.0.0.1%3A5000/test_id/1&format=json']:
+			rv = self.app.get(url)
+			assert rv.status_code == 200
+			assert rv.headers['Last-Modified'] == 'Fri, 01 Jan 2016 10:00:00 GMT'
+			etag = rv.headers['ETag']
+			
+			rv = self.app.get(url, headers={'If-None-Match': etag})
+			assert rv.status_code == 304
+			assert rv.data == ''
+			
+			rv = self.app.get(url, headers={'If-None-Match': '"other"'})
+			assert rv.status_code == 200
+			
+			rv = self.app.get(url, headers={'If-Modified-Since': 'Fri, 01 Jan 2016 10:00:00 GMT'})
+			assert rv.status_code == 304
+			
+			rv = self.app.get(url, headers={'If-Modified-Since': 'Fri, 01 Jan 2016 09:59:59 GMT'})
+			assert rv.status_code == 200
+		
+		# different representations of the same Item have different ETags
+		rv = self.app.get('/oembed?url=http%3A//127.0.0.1%3A5000/test_id/1&format=json&maxwidth=50', headers={'If-None-Match': etag})
+		assert rv.status_code == 200
+	
+	def test_conditional1(self):
+		# Item without timestamp can't be validated
+		rv = self.app.get('/test_id/manifest.json')
+		assert rv.status_code == 200
+		assert 'ETag' not in rv.headers
+		assert 'Last-Modified' not in rv.headers
+	
+	def test_oEmbed12(self):
+		item = Item('test_id')
+		item.timestamp = '2016-01-01T10:00:00.000000Z'
+		item.save()
+		self.deliverInvalidations()
+		
+		rv = self.app.get('/oembed?url=http%3A//127.0.0.1%3A5000/test_id/1')
+		assert rv.status_code == 200
+		# the same normalized parameters are served from the cache
+		rv2 = self.app.get('/oembed?url=http%3A//127.0.0.1%3A5000/test_id/1&maxwidth=560&format=json')
+		assert rv2.status_code == 200
+		assert rv2.data == rv.data
+		assert rv2.headers['Content-Type'] == 'application/json'
+		
+		stats = json.loads(self.app.get('/stats').data)
+		assert stats['oembed']['hits'] == 1
+		assert stats['oembed']['misses'] == 1
+		
+		# re-finalized Item has a new timestamp
+		item.title = 'Unittest changed title'
+		item.timestamp = '2016-01-02T10:00:00.000000Z'
+		item.save()
+		self.deliverInvalidations()
+		
+		rv = self.app.get('/oembed?url=http%3A//127.0.0.1%3A5000/test_id/1')
+		assert rv.status_code == 200
+		assert '"title": "Unittest changed title"' in rv.data
+	
+	def test_itemCache0(self):
+		assert self.app.get('/test_id/manifest.json').status_code == 200
+		assert self.app.get('/test_id').status_code == 200
+		
+		# the first request loads the Item, the second one takes both its timestamp and the Item from the cache
+		stats = json.loads(self.app.get('/stats').data)
+		assert stats['item']['misses'] == 2
+		assert stats['item']['hits'] == 2
+		
+		# Items changed by other processes are removed from the cache
+		self.db.delete('item_id@test_id')
+		self.db.publish(ITEM_CHANNEL, 'test_id')
+		self.deliverInvalidations()
+		assert self.app.get('/test_id').status_code == 404
+	
+	def test_recordCodec0(self):
+		codec = self.db.codec
+		
+		try:
+			# records are readable regardless of the codec which stored them
+			for name, compress_size in [('msgpack', 1024), ('msgpack', 0), ('json', 1024)]:
+				self.db.codec = RecordCodec(name, compress_size)
+				item = Item('test_id')
+				item.save()
+				item = Item('test_id')
+				assert item.title == 'Unittest title'
+				assert item.image_meta['http://unittest_url2.org']['width'] == 100
+				
+				Task(1, 'test_id', 0, {'url': 'http://unittest_url.org', 'item_tasks_count': 1, 'type': 'add'})
+				assert Task(1, 'test_id', 0).url == 'http://unittest_url.org'
+		finally:
+			self.db.codec = codec
+	
+	def test_itemStorage0(self):
+		item = Item('test_id')
+		item.save('hash')
+		assert self.db.get('item_id@test_id') is None
+		self.deliverInvalidations()
+		
+		# only requested fields are loaded, others are loaded lazily
+		item = Item('test_id', fields=['title'])
+		assert item.partial
+		assert 'description' not in item.__dict__
+		assert item.get_image_meta('http://unittest_url2.org')['width'] == 100
+		assert item.description == 'Unittest description'
+		assert item.url == ['http://unittest_url.org', 'http://unittest_url2.org']
+		
+		rv = self.app.get('/oembed?url=http%3A//127.0.0.1%3A5000/test_id/1')
+		assert rv.status_code == 200
+		assert '"title": "Unittest title"' in rv.data
+		
+		# Items are readable regardless of the layout which stored them
+		item.save('blob')
+		assert self.db.hgetall('item@test_id') == {}
+		item = Item('test_id')
+		assert not item.partial
+		assert item.image_meta['http://unittest_url2.org']['width'] == 100
+		
+		item.save('hash')
+		item.delete()
+		self.assertRaises(NoItemInDb, Item, 'test_id')
+	
+	def test_items0(self):
+		item = Item('test_id2', {'url': ['http://unittest_url3.org'], 'title': 'Unittest title 2', 'image_meta': {'http://unittest_url3.org': {'width': 300, 'height': 200}}})
+		item.save('hash')
+		
+		rv = self.app.get('/items?ids=test_id,missing_id,test_id2,test_id')
+		assert rv.status_code == 200
+		assert rv.headers['Content-Type'] == 'application/json'
+		data = json.loads(rv.data)
+		assert [d['id'] for d in data] == ['test_id', 'missing_id', 'test_id2']
+		assert data[0]['title'] == 'Unittest title'
+		assert data[0]['images'][1] == {'url': 'http://unittest_url2.org', 'width': 100, 'height': 100}
+		assert 'error' in data[1]
+		assert data[2]['images'] == [{'url': 'http://unittest_url3.org', 'width': 300, 'height': 200}]
+		
+		rv = self.app.post('/items', data=json.dumps(['test_id2']))
+		assert rv.status_code == 200
+		assert json.loads(rv.data)[0]['title'] == 'Unittest title 2'
+		
+		assert self.app.get('/items').status_code == 400
+		assert self.app.post('/items', data='{"ids": "test_id"}').status_code == 400
+	
+	def test_collection0(self):
+		page_size = collection.COLLECTION_PAGE_SIZE
+		collection.COLLECTION_PAGE_SIZE = 2
+		
+		try:
+			for i in range(5):
+				item = Item('test_coll%s' % i, {'url': ['http://unittest_url.org'], 'title': 'Unittest title %s' % i, 'institution': 'Unittest institution'})
+				item.save()
+				collection.indexItem(7, item)
+			
+			Item('test_coll3').delete()
+			
+			rv = self.app.get('/batch/7/collection.json')
+			assert rv.status_code == 200
+			data = json.loads(rv.data)
+			assert data['@type'] == 'sc:Collection'
+			# deleted Item is removed from indexes of batches
+			assert data['total'] == 4
+			assert data['first'] == 'http://127.0.0.1:5000/batch/7/collection.json?page=0'
+			assert data['last'] == 'http://127.0.0.1:5000/batch/7/collection.json?page=1'
+			assert not self.db.smembers('collection@batches@test_coll3')
+			
+			rv = self.app.get('/batch/7/collection.json?page=1')
+			assert rv.status_code == 200
+			data = json.loads(rv.data)
+			assert data['prev'] == 'http://127.0.0.1:5000/batch/7/collection.json?page=0'
+			assert 'next' not in data
+			assert [m['label'] for m in data['manifests']] == ['Unittest title 2', 'Unittest title 4']
+			assert data['manifests'][0]['@id'] == 'http://127.0.0.1:5000/test_coll2/manifest.json'
+			
+			rv = self.app.get('/institution/Unittest%20institution/collection.json')
+			assert json.loads(rv.data)['total'] == 4
+			
+			assert self.app.get('/batch/7/collection.json?page=2').status_code == 404
+			assert self.app.get('/batch/8/collection.json').status_code == 404
+			
+			# Item finalized without modification is a part of the batch
+			item_data = dict((key, value) for key, value in json.loads(self.db.get('item_id@test_id')).items() if key not in ('image_meta', 'lock'))
+			Task(8, 'test_id', 0, {'item_id': 'test_id', 'type': 'mod', 'item_tasks_count': 1, 'status': 'ok', 'item_data': dict(item_data, id='test_id')})
+			ingest.finalizeItem(8, 'test_id', 1)
+			assert json.loads(self.app.get('/batch/8/collection.json').data)['total'] == 1
+		finally:
+			collection.COLLECTION_PAGE_SIZE = page_size
+	
+	def test_publish0(self):
+		publish_dir = tempfile.mkdtemp()
+		# the same configuration is used for rendering of published files
+		publish.publisher_app = self.flask_app
+		
+		try:
+			assert publishItem('test_id', publish_dir)
+			assert sorted(os.listdir(os.path.join(publish_dir, 'test_id'))) == ['0', '1', 'index.html', 'manifest.json', 'oembed.json']
+			assert open(os.path.join(publish_dir, 'test_id', 'manifest.json')).read() == self.app.get('/test_id/manifest.json').data
+			assert open(os.path.join(publish_dir, 'test_id', '1', 'index.html')).read() == self.app.get('/test_id/1').data
+			assert json.loads(open(os.path.join(publish_dir, 'test_id', 'oembed.json')).read())['title'] == 'Unittest title'
+			
+			# files of removed image are removed too
+			item = Item('test_id')
+			item.url = item.url[:1]
+			item.save()
+			assert publishItem('test_id', publish_dir)
+			assert not os.path.exists(os.path.join(publish_dir, 'test_id', '1'))
+			
+			item.delete()
+			assert not publishItem('test_id', publish_dir)
+			assert not os.path.exists(os.path.join(publish_dir, 'test_id'))
+			
+			assert not publishItem('..', publish_dir)
+			unpublishItem('test_id', publish_dir)
+		finally:
+			publish.publisher_app = None
+			shutil.rmtree(publish_dir)
+	
+	def test_assets0(self):
+		static_dir = tempfile.mkdtemp()
+		
+		try:
+			shutil.rmtree(static_dir)
+			shutil.copytree(self.flask_app.static_folder, static_dir, ignore=shutil.ignore_patterns('dist'))
+			assets = buildAssets(static_dir)
+			
+			css = open(os.path.join(static_dir, 'dist', assets['css/viewer.css'])).read()
+			assert 'url(/static/dist/%s)' % assets['img/close_dark.png'] in css
+			assert posixpath.relpath(assets['css/fonts/Ubuntu-R.ttf'], 'css') in css
+			assert os.path.exists(os.path.join(static_dir, 'dist', assets['js/viewer.js'] + '.gz'))
+			assert 'static/dist/%s' % assets['img/zoom-in.png'] in open(os.path.join(static_dir, 'dist', assets['js/viewer.js'])).read()
+			
+			self.flask_app.extensions['assets'] = assets
+			rv = self.app.get('/test_id')
+			assert 'href="/static/dist/%s"' % assets['css/viewer.css'] in rv.data
+		finally:
+			shutil.rmtree(static_dir)
+	
+	def test_assets1(self):
+		self.flask_app.extensions['assets'] = {}
+		assert 'href="/static/css/viewer.css"' in self.app.get('/test_id').data
+		rv = self.app.get('/static/css/viewer.css')
+		assert 'immutable' not in rv.headers.get('Cache-Control', '')
+		rv.close()
+	
+	def test_assets2(self):
+		static_dir = tempfile.mkdtemp()
+		
+		class Brotli:
+			@staticmethod
+			def compress(data):
+				return 'br'
+		
+		brotli = build_assets.brotli
+		subset_font = build_assets.subsetFont
+		build_assets.brotli = Brotli
+		build_assets.subsetFont = lambda data: 'woff2 %s' % len(data)
+		
+		try:
+			shutil.rmtree(static_dir)
+			shutil.copytree(self.flask_app.static_folder, static_dir, ignore=shutil.ignore_patterns('dist'))
+			assets = buildAssets(static_dir)
+			
+			assert open(os.path.join(static_dir, 'dist', assets['js/viewer.js'] + '.br')).read() == 'br'
+			assert os.path.exists(os.path.join(static_dir, 'dist', assets['css/viewer.css'] + '.br'))
+			
+			# browsers which support WOFF2 get the subset of the font
+			css = open(os.path.join(static_dir, 'dist', assets['css/viewer.css'])).read()
+			woff2 = [path for path in os.listdir(os.path.join(static_dir, 'dist', 'css', 'fonts')) if path.startswith('Ubuntu-R.') and path.endswith('.woff2')]
+			assert len(woff2) == 1
+			assert 'url(fonts/%s) format("woff2"), url(%s) format("truetype")' % (woff2[0], posixpath.relpath(assets['css/fonts/Ubuntu-R.ttf'], 'css')) in css
+		finally:
+			build_assets.brotli = brotli
+			build_assets.subsetFont = subset_font
+			shutil.rmtree(static_dir)
+	
+	def test_dbBatch0(self):
+		self.db.mset({'batch_test1': 'a', 'batch_test2': 'b'})
+		assert self.db.mget(['batch_test1', 'batch_missing', 'batch_test2']) == ['a', None, 'b']
+		assert sorted(self.db.scan_iter('batch_test*')) == ['batch_test1', 'batch_test2']
+		assert self.db.delete_many(['batch_test1', 'batch_test2', 'batch_missing']) == 2
+		assert self.db.mget(['batch_test1']) == [None]
+		
+		with self.db.pipeline() as pipe:
+			pipe.set_record('batch_record', {'a': 1})
+			pipe.set('batch_raw', 'raw')
+		
+		assert self.db.pipeline().get_record('batch_record').get_record('batch_missing').get('batch_raw').execute() == [{'a': 1}, None, 'raw']
+		
+		# commands aren't executed if the block fails
+		try:
+			with self.db.pipeline() as pipe:
+				pipe.set('batch_failed', 'x')
+				raise ValueError()
+		except ValueError:
+			pass
+		
+		assert self.db.get('batch_failed') is None
+		
+		# lock is released only by its owner
+		self.db.setnx('batch_lock', 'owner', 10)
+		assert not self.db.delete_if_equal('batch_lock', 'another')
+		assert self.db.delete_if_equal('batch_lock', 'owner')
+		assert self.db.get('batch_lock') is None
+	
+	def test_tasks0(self):
+		with self.db.pipeline(2) as pipe:
+			for task_id in range(3):
+				Task(1, 'test_id', task_id, {'url': 'http://unittest_url.org/%s' % task_id, 'item_tasks_count': 3, 'type': 'add'}, pipe)
+			
+			Task(1, 'test_id2', 0, {'url': 'http://unittest_url.org', 'item_tasks_count': 2, 'type': 'add'}, pipe)
+		
+		assert [task.url for task in Task.get_item_tasks(1, 'test_id', 3)] == ['http://unittest_url.org/0', 'http://unittest_url.org/1', 'http://unittest_url.org/2']
+		self.assertRaises(NoItemInDb, Task.get_item_tasks, 1, 'test_id2', 2)
+		
+		tasks = Task.get_items_tasks(1, ['test_id', 'test_id2', 'test_id3'])
+		assert [task.task_id for task in tasks['test_id']] == [0, 1, 2]
+		assert [task.task_id for task in tasks['test_id2']] == [0]
+		assert tasks['test_id3'] == []
+		
+		# task which runs again (e.g. it was put to the queue twice) is counted once
+		assert Task(1, 'test_id', 0).finish_item_task() == (True, 1)
+		assert Task(1, 'test_id', 0).finish_item_task() == (False, 1)
+		assert Task(1, 'test_id', 2).finish_item_task() == (True, 2)
+	
+	def test_ingestQueue0(self):
+		item = json.loads(self.db.get('item_id@test_id'))
+		item_data = {'id': 'test_id', 'url': item['url'], 'title': 'New title'}
+		
+		with self.db.pipeline() as pipe:
+			tasks = processBatchItems(1, [item_data], 0, pipe, LRUCache(100))
+		
+		assert [task.type for task in tasks] == ['mod']
+		
+		# the task put to the queue twice finalizes the item and is counted once
+		ingestQueue(1, 'test_id', 0)
+		ingestQueue(1, 'test_id', 0)
+		assert Item('test_id').title == 'New title'
+		summary = json.loads(self.app.get('/ingest/summary?batch_id=1').data)
+		assert summary['tasks'] == 1 and summary['tasks_finished'] == 1 and summary['ok'] == 1 and summary['pending'] == 0
+	
 	def test_ingest0(self):
 		rv = self.app.get('/ingest')
 		assert rv.status_code == 400
@@ -167,6 +716,320 @@ class EmbedTestCase(unittest.TestCase):
 #		assert rv.status_code == 200
 #		assert '[{"status": "pending", "id": "test_id", "urls": ["ok", "ok"]}]' in rv.data
 
+	def batchTasks(self, item_data, statuses, messages=None):
+		"""Method which stores Tasks of item of batch 1 with specified statuses of its urls"""
+		
+		tasks = []
+		
+		for task_id, url in enumerate(item_data['url']):
+			data = {'url': url, 'url_order': task_id, 'item_tasks_count': len(item_data['url']), 'type': 'add', 'status': statuses[task_id], 'message': (messages or [0] * len(statuses))[task_id]}
+			
+			if task_id == len(item_data['url']) - 1:
+				data['item_data'] = item_data
+			
+			tasks.append(Task(1, item_data['id'], task_id, data))
+		
+		return tasks
+	
+	def startBatch(self):
+		"""Method which starts batch 1 with items test_id0 - test_id4, test_id3 is deleted"""
+		
+		items = [{'id': 'test_id%s' % i, 'url': ['http://unittest_url.org/%s/0' % i, 'http://unittest_url.org/%s/1' % i]} for i in range(5)]
+		items[3] = {'id': 'test_id3', 'status': 'deleted'}
+		addBatchItems(1, [item['id'] for item in items], set(['test_id3']), 8)
+		
+		return items
+	
+	def test_ingestSummary0(self):
+		rv = self.app.get('/ingest/summary')
+		assert rv.status_code == 400
+		rv = self.app.get('/ingest/summary?batch_id=1')
+		assert rv.status_code == 400
+		
+		items = self.startBatch()
+		assert countBatchItem(1, items[0], self.batchTasks(items[0], ['ok', 'ok']), 'ok')
+		assert countBatchItem(1, items[1], self.batchTasks(items[1], ['error', 'error'], [ERR_MESSAGE_HTTP, ERR_MESSAGE_HTTP]), 'error')
+		# finalized again or deleted items aren't counted
+		assert not countBatchItem(1, items[0], self.batchTasks(items[0], ['ok', 'ok']), 'ok')
+		assert not countBatchItem(1, items[3], [], 'error')
+		
+		rv = self.app.get('/ingest/summary?batch_id=1')
+		assert rv.status_code == 200
+		assert json.loads(rv.data) == {'batch_id': 1, 'total': 5, 'pending': 2, 'ok': 1, 'error': 1, 'deleted': 1, 'tasks': 8, 'tasks_finished': 0, 'errors': {'Download failed': 1}}
+	
+	def test_ingestPage0(self):
+		rv = self.app.get('/ingest?batch_id=1&status=error')
+		assert rv.status_code == 400
+		
+		items = self.startBatch()
+		countBatchItem(1, items[1], self.batchTasks(items[1], ['ok', 'error'], [0, ERR_MESSAGE_HTTP]), 'error')
+		countBatchItem(1, items[4], self.batchTasks(items[4], ['ok', 'ok']), 'ok')
+		self.batchTasks(items[2], ['ok', 'pending'])
+		
+		rv = self.app.get('/ingest?batch_id=1&status=error')
+		assert rv.status_code == 200
+		assert json.loads(rv.data) == {'items': [{'id': 'test_id1', 'status': 'error', 'urls': ['ok', 'error'], 'message': 'Download failed'}], 'next_cursor': None}
+		
+		rv = self.app.get('/ingest?batch_id=1&limit=2')
+		assert json.loads(rv.data) == {'items': [{'id': 'test_id0', 'status': 'pending'}, {'id': 'test_id1', 'status': 'error', 'urls': ['ok', 'error'], 'message': 'Download failed'}], 'next_cursor': 2}
+		rv = self.app.get('/ingest?batch_id=1&limit=2&cursor=2')
+		assert json.loads(rv.data) == {'items': [{'id': 'test_id2', 'status': 'pending', 'urls': ['ok', 'pending']}, {'id': 'test_id3', 'status': 'deleted'}], 'next_cursor': 4}
+		
+		rv = self.app.get('/ingest?batch_id=1&status=pending&format=ndjson')
+		assert rv.status_code == 200
+		assert rv.headers['Content-Type'] == 'application/x-ndjson'
+		assert [json.loads(line) for line in rv.data.splitlines()] == [{'id': 'test_id0', 'status': 'pending'}, {'id': 'test_id2', 'status': 'pending', 'urls': ['ok', 'pending']}]
+		
+		rv = self.app.get('/ingest?batch_id=1&status=ok&cursor=1&limit=1&format=ndjson')
+		assert [json.loads(line) for line in rv.data.splitlines()] == [{'id': 'test_id4', 'status': 'ok', 'urls': ['ok', 'ok']}]
+		assert 'X-Next-Cursor' not in rv.headers
+		
+		rv = self.app.get('/ingest?batch_id=1&status=unknown')
+		assert rv.status_code == 400
+		rv = self.app.get('/ingest?batch_id=1&limit=0')
+		assert rv.status_code == 400
+	
+	def test_compact0(self):
+		conn = self.batchDirectory()
+		
+		items = self.startBatch()
+		insertBatch(conn, items)
+		countBatchItem(1, items[0], self.batchTasks(items[0], ['ok', 'ok']), 'ok')
+		countBatchItem(1, items[1], self.batchTasks(items[1], ['ok', 'error'], [0, ERR_MESSAGE_HTTP]), 'error')
+		self.batchTasks(items[2], ['ok', 'pending'])
+		self.db.sadd('batch@id@1@item@idtest_id0@finished', 0)
+		
+		# batch with pending items isn't compacted, but its finished items can be
+		assert compactFinishedBatches(conn) == {}
+		assert compactBatch(conn, 1) == 4
+		tasks = Task.get_items_tasks(1, ['test_id0', 'test_id1', 'test_id2'])
+		assert (len(tasks['test_id0']), len(tasks['test_id1']), len(tasks['test_id2'])) == (0, 0, 2)
+		assert 0 < self.db.backend.ttl('batch@id@1@item@idtest_id0@finished') <= COMPACT_COUNTER_TTL
+		assert conn.execute("SELECT task_id, item_id, status, message FROM Task ORDER BY item_id, task_id").fetchall() == [(0, 'test_id0', 'ok', 0), (1, 'test_id0', 'ok', 0), (0, 'test_id1', 'ok', 0), (1, 'test_id1', 'error', ERR_MESSAGE_HTTP)]
+		
+		# statuses of archived items are still listed
+		rv = self.app.get('/ingest?batch_id=1&status=error')
+		assert json.loads(rv.data)['items'] == [{'id': 'test_id1', 'status': 'error', 'urls': ['ok', 'error'], 'message': 'Download failed'}]
+		
+		countBatchItem(1, items[2], self.batchTasks(items[2], ['ok', 'ok']), 'ok')
+		countBatchItem(1, items[4], self.batchTasks(items[4], ['ok', 'ok']), 'ok')
+		# finished tasks are counted by ingest
+		self.db.hincrby('batch@id@1@summary', 'tasks_finished', 8)
+		summary = self.app.get('/ingest/summary?batch_id=1').data
+		assert compactFinishedBatches(conn) == {1: 4}
+		# compacted batch isn't compacted again
+		assert compactFinishedBatches(conn) == {}
+		assert conn.execute("SELECT COUNT(*) FROM Task").fetchone()[0] == 8
+		assert conn.execute("SELECT item_id, status FROM BatchItem ORDER BY item_order").fetchall() == [('test_id0', 'ok'), ('test_id1', 'error'), ('test_id2', 'ok'), ('test_id3', 'deleted'), ('test_id4', 'ok')]
+		
+		# the batch is removed from redis later
+		keys = ['batch@id@1@%s' % key for key in ['summary', 'items', 'finished', 'status@ok', 'status@error', 'status@deleted', 'compacted']]
+		assert all(0 < self.db.backend.ttl(key) <= COMPACT_COUNTER_TTL for key in keys)
+		self.db.delete_many(keys)
+		# counters of items expire too
+		assert all(self.db.backend.ttl(key) > 0 for key in self.db.scan_iter('batch@id@1@*'))
+		
+		# and then it is read from sqlite
+		assert self.app.get('/ingest/summary?batch_id=1').data == summary
+		rv = self.app.get('/ingest?batch_id=1&status=error')
+		assert json.loads(rv.data)['items'] == [{'id': 'test_id1', 'status': 'error', 'urls': ['ok', 'error'], 'message': 'Download failed'}]
+		assert compactFinishedBatches(conn) == {}
+	
+	def test_compact1(self):
+		conn = self.batchDirectory()
+		queue = self.fakeQueue(views, 'ingestQueue')
+		
+		# deleted item isn't pending, but its tasks are queued
+		rv = self.app.post('/ingest', headers={'Content-Type': 'application/json'}, data=json.dumps([{'id': 'test_id', 'status': 'deleted'}]))
+		assert rv.status_code == 200
+		summary = json.loads(self.app.get('/ingest/summary?batch_id=1').data)
+		assert summary['pending'] == 0 and summary['deleted'] == 1 and summary['tasks'] == 2
+		assert sorted(queue.calls) == [(1, 'test_id', 0), (1, 'test_id', 1)]
+		assert compactFinishedBatches(conn) == {}
+		
+		# the batch is compacted when the tasks are finished by ingest
+		for task_id in range(2):
+			task = Task(1, 'test_id', task_id)
+			task.status = 'deleted'
+			task.save()
+			task.finish_item_task()
+			self.db.hincrby('batch@id@1@summary', 'tasks_finished')
+		
+		assert compactFinishedBatches(conn) == {1: 2}
+		assert conn.execute("SELECT task_id, status FROM Task WHERE item_id='test_id' ORDER BY task_id").fetchall() == [(0, 'deleted'), (1, 'deleted')]
+		assert Task.get_items_tasks(1, ['test_id'])['test_id'] == []
+		assert all(self.db.backend.ttl(key) > 0 for key in self.db.scan_iter('batch@id@1@*'))
+	
+	def test_batchDb0(self):
+		conn = self.batchDirectory()
+		assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+		
+		items = [{'id': 'test_id%s' % i, 'url': ['http://unittest_url.org/%s/0' % i, 'http://unittest_url.org/%s/1' % i]} for i in range(3)]
+		items[1] = {'id': 'test_id1', 'status': 'deleted'}
+		
+		# batch stored as JSON blob before BatchItem table existed, its first item was archived
+		conn.execute("INSERT INTO Batch(batch_data) VALUES (?)", (json.dumps(items),))
+		conn.executemany("INSERT INTO Task VALUES (?,?,?,?,?,?)", [(0, 1, 'test_id0', 'ok', items[0]['url'][0], 0), (1, 1, 'test_id0', 'error', items[0]['url'][1], ERR_MESSAGE_HTTP)])
+		conn.commit()
+		assert migrateBatches(conn) == 1
+		assert migrateBatches(conn) == 0
+		assert [(order, item['id'], status) for order, item, status in iterBatchItems(conn, 1)] == [(0, 'test_id0', 'error'), (1, 'test_id1', 'deleted'), (2, 'test_id2', 'pending')]
+		
+		assert insertBatch(conn, items) == 2
+		self.batchTasks(items[2], ['ok', 'pending'])
+		
+		# batches without redis indexes are listed from sqlite, tasks which aren't archived are read from redis
+		rv = self.app.get('/ingest?batch_id=1')
+		assert rv.status_code == 200
+		assert json.loads(rv.data) == [{'id': 'test_id0', 'status': 'error', 'urls': ['ok', 'error'], 'message': 'Download failed'}, {'id': 'test_id1', 'status': 'deleted'}, {'id': 'test_id2', 'status': 'pending', 'urls': ['ok', 'pending']}]
+		
+		rv = self.app.get('/ingest?batch_id=1&status=error&format=ndjson')
+		assert [json.loads(line) for line in rv.data.splitlines()] == [{'id': 'test_id0', 'status': 'error', 'urls': ['ok', 'error'], 'message': 'Download failed'}]
+		
+		rv = self.app.get('/ingest?batch_id=2&limit=1&cursor=1')
+		assert json.loads(rv.data) == {'items': [{'id': 'test_id1', 'status': 'deleted'}], 'next_cursor': 2}
+		
+		# status of item which isn't archived yet is derived from its tasks
+		self.batchTasks(items[2], ['ok', 'error'], [0, ERR_MESSAGE_HTTP])
+		rv = self.app.get('/ingest?batch_id=1&status=error&limit=1')
+		assert json.loads(rv.data) == {'items': [{'id': 'test_id0', 'status': 'error', 'urls': ['ok', 'error'], 'message': 'Download failed'}], 'next_cursor': 2}
+		rv = self.app.get('/ingest?batch_id=1&status=error&cursor=1')
+		assert json.loads(rv.data) == {'items': [{'id': 'test_id2', 'status': 'error', 'urls': ['ok', 'error'], 'message': 'Download failed'}], 'next_cursor': None}
+		rv = self.app.get('/ingest?batch_id=1&status=pending')
+		assert json.loads(rv.data) == {'items': [], 'next_cursor': None}
+		
+		rv = self.app.get('/ingest?batch_id=3')
+		assert rv.status_code == 400
+	
+	def test_ingestStream0(self):
+		rv = self.app.post('/ingest/stream', headers={'Content-Type': 'application/json'}, data='{}')
+		assert rv.status_code == 400
+		
+		self.batchDirectory()
+		queue = self.fakeQueue(views, 'ingestQueue')
+		
+		lines = [json.dumps({'id': 'test_id', 'url': ['http://unittest_url.org', 'http://unittest_url2.org', 'http://unittest_url3.org'], 'title': 'Unittest title'}), '', 'invalid json', json.dumps({'id': 'test_id2', 'url': ['test']}), json.dumps({'ID': 'test_id3', 'ImageUrl': ['http://unittest_url.org']}), json.dumps({'id': 'test_id'}), json.dumps({'id': 'test_id4', 'status': 'deleted'})]
+		rv = self.app.post('/ingest/stream', headers={'Content-Type': 'application/x-ndjson'}, data='\n'.join(lines) + '\n')
+		assert rv.status_code == 200
+		assert [json.loads(line) for line in rv.data.splitlines()] == [{'batch_id': 1}, {'order': 1, 'errors': ["The item num. 1 isn't valid JSON"]}, {'order': 2, 'errors': ["The 'test' url in the item num. 2 isn't valid url"]}, {'order': 4, 'errors': ['The item num. 4 must have unique ID']}, {'batch_id': 1, 'items': 3, 'errors': 3}]
+		
+		# test_id is already stored, so only its new url is ingested, test_id4 isn't stored, so it has no tasks
+		assert sorted(queue.calls) == [(1, 'test_id', 0), (1, 'test_id3', 0)]
+		assert Task(1, 'test_id', 0).url == 'http://unittest_url3.org'
+		assert Task(1, 'test_id', 0).item_data['title'] == 'Unittest title'
+		assert self.db.get('batch@id@1@open') is None
+		
+		rv = self.app.get('/ingest/summary?batch_id=1')
+		assert json.loads(rv.data)['total'] == 3 and json.loads(rv.data)['deleted'] == 1 and json.loads(rv.data)['tasks'] == 2
+		rv = self.app.get('/ingest?batch_id=1&status=deleted')
+		assert json.loads(rv.data)['items'] == [{'id': 'test_id4', 'status': 'deleted'}]
+		
+		f = gzip.open(os.path.join(self.flask_app.config['BATCH_DIR'], '1.gz'))
+		assert f.read() == '\n'.join(lines) + '\n'
+		f.close()
+		
+		# no batch is created without valid items
+		rv = self.app.post('/ingest/stream', headers={'Content-Type': 'application/x-ndjson'}, data='invalid json\n' + json.dumps({'id': 5, 'url': ['http://unittest_url.org']}) + '\n')
+		assert [json.loads(line) for line in rv.data.splitlines()] == [{'order': 0, 'errors': ["The item num. 0 isn't valid JSON"]}, {'order': 1, 'errors': ['The item num. 1 must have valid ID']}, {'batch_id': None, 'items': 0, 'errors': 2}]
+		assert sorted(path for path in os.listdir(self.flask_app.config['BATCH_DIR']) if not path.startswith('db.db')) == ['1.gz']
+		
+		# the batch is released and its archive is closed if the client disconnects
+		rv = self.app.post('/ingest/stream', headers={'Content-Type': 'application/x-ndjson'}, data='\n'.join(lines[:1] * 3) + '\n', buffered=False)
+		assert json.loads(next(iter(rv.response))) == {'batch_id': 2}
+		assert self.db.get('batch@id@2@open') is not None
+		rv.close()
+		assert self.db.get('batch@id@2@open') is None
+		f = gzip.open(os.path.join(self.flask_app.config['BATCH_DIR'], '2.gz'))
+		assert f.read() == lines[0] + '\n'
+		f.close()
+	
+	def test_ingestAsync0(self):
+		conn = self.batchDirectory()
+		plan_queue = self.fakeQueue(views, 'planBatch')
+		queue = self.fakeQueue(ingest, 'ingestQueue')
+		
+		batch_data = [{'id': 'test_async', 'url': ['http://unittest_url.org', 'http://unittest_url2.org'], 'title': '<b>Unittest title</b>'}, {'id': 'test_async2', 'status': 'deleted'}, {'id': 'test_async3', 'url': ['http://unittest_url.org']}]
+		rv = self.app.post('/ingest?async=1', headers={'Content-Type': 'application/json'}, data=json.dumps(batch_data))
+		assert rv.status_code == 202
+		assert json.loads(rv.data) == {'batch_id': 1}
+		assert plan_queue.calls == [(1,)] and queue.calls == []
+		
+		# the batch isn't compacted until it is planned
+		rv = self.app.get('/ingest/summary?batch_id=1')
+		assert json.loads(rv.data)['plan_total'] == 3 and json.loads(rv.data)['planned'] == 0
+		assert compactFinishedBatches(conn) == {}
+		
+		# items are pending until they are planned
+		rv = self.app.get('/ingest?batch_id=1')
+		assert json.loads(rv.data) == [{'id': 'test_async', 'status': 'pending'}, {'id': 'test_async2', 'status': 'pending'}, {'id': 'test_async3', 'status': 'pending'}]
+		rv = self.app.get('/ingest?batch_id=1&status=pending')
+		assert [item['id'] for item in json.loads(rv.data)['items']] == ['test_async', 'test_async2', 'test_async3']
+		rv = self.app.get('/ingest?batch_id=1&status=ok')
+		assert json.loads(rv.data) == {'items': [], 'next_cursor': None}
+		
+		# planning interrupted while its tasks are queued continues with them
+		ingest.BATCH_SIZE = 1
+		self.addCleanup(setattr, ingest, 'BATCH_SIZE', BATCH_SIZE)
+		queue.errors = 1
+		self.assertRaises(IOError, planBatch, 1)
+		assert queue.calls == [] and json.loads(self.app.get('/ingest/summary?batch_id=1').data)['planned'] == 1
+		assert self.db.get('batch@id@1@open') is not None
+		rv = self.app.get('/ingest?batch_id=1&status=pending&limit=2')
+		assert json.loads(rv.data) == {'items': [{'id': 'test_async', 'status': 'pending', 'urls': ['pending', 'pending']}, {'id': 'test_async2', 'status': 'pending'}], 'next_cursor': 2}
+		rv = self.app.get('/ingest?batch_id=1&status=deleted')
+		assert json.loads(rv.data) == {'items': [], 'next_cursor': None}
+		
+		assert planBatch(1) == 3
+		assert queue.calls == [(1, 'test_async', 0), (1, 'test_async', 1), (1, 'test_async3', 0)]
+		assert Task(1, 'test_async', 1).item_data['title'] == 'Unittest title'
+		assert self.db.get('batch@id@1@open') is None and self.db.lrange('batch@id@1@plan', 0, -1) == [] and self.db.lrange('batch@id@1@plan@tasks', 0, -1) == []
+		
+		# items of the interrupted chunk are counted once
+		rv = self.app.get('/ingest/summary?batch_id=1')
+		summary = json.loads(rv.data)
+		assert summary['planned'] == 3 and summary['total'] == 3 and summary['pending'] == 2 and summary['deleted'] == 1 and summary['tasks'] == 3
+		rv = self.app.get('/ingest?batch_id=1&status=deleted')
+		assert json.loads(rv.data)['items'] == [{'id': 'test_async2', 'status': 'deleted'}]
+		
+		# repeated planning does nothing
+		assert planBatch(1) == 3 and len(queue.calls) == 3
+	
+	def test_planDiff0(self):
+		conn = sqlite3.connect(':memory:')
+		createSchema(conn)
+		unchanged = {'id': 'test_id', 'url': ['http://unittest_url.org', 'http://unittest_url2.org'], 'title': 'Unittest title', 'creator': 'Unittest creator', 'source': 'http://unittest_source.org', 'institution': 'Unittest institution', 'institution_link': 'http://unittest_institution_link.org', 'license': 'http://unittest_license_link.org', 'description': 'Unittest description'}
+		new_item = {'id': 'test_plan', 'url': ['http://unittest_url.org']}
+		insertBatch(conn, [unchanged, new_item])
+		
+		# unchanged item is finished without tasks
+		with self.db.pipeline() as pipe:
+			tasks = processBatchItems(1, [dict(unchanged), dict(new_item)], 0, pipe, LRUCache(100))
+		
+		assert [(task.item_id, task.type) for task in tasks] == [('test_plan', 'add')]
+		rv = self.app.get('/ingest/summary?batch_id=1')
+		assert json.loads(rv.data)['ok'] == 1 and json.loads(rv.data)['pending'] == 1 and json.loads(rv.data)['tasks'] == 1
+		rv = self.app.get('/ingest?batch_id=1&status=ok')
+		assert json.loads(rv.data)['items'] == [{'id': 'test_id', 'urls': ['ok', 'ok'], 'status': 'ok'}]
+		assert json.loads(self.app.get('/batch/1/collection.json').data)['total'] == 1
+		
+		# status of unchanged item is archived by compaction
+		assert compactBatch(conn, 1) == 0
+		assert conn.execute("SELECT item_id, status FROM BatchItem ORDER BY item_order").fetchall() == [('test_id', 'ok'), ('test_plan', 'pending')]
+		
+		# changed metadata are finalized by task in embed process and applied directly by the ingest worker
+		with self.db.pipeline() as pipe:
+			tasks = processBatchItems(2, [dict(unchanged, title='<b>New title</b>')], 0, pipe, LRUCache(100))
+		
+		assert [(task.item_id, task.type) for task in tasks] == [('test_id', 'mod')]
+		
+		with self.db.pipeline() as pipe:
+			tasks = processBatchItems(3, [dict(unchanged, title='<b>New title</b>')], 0, pipe, LRUCache(100), apply_changes=True)
+		
+		assert tasks == []
+		assert Item('test_id').title == 'New title' and Item('test_id').image_meta['http://unittest_url2.org']['width'] == 100
+		rv = self.app.get('/ingest/summary?batch_id=3')
+		assert json.loads(rv.data)['ok'] == 1 and json.loads(rv.data)['pending'] == 0
+	
 	def test_ingest4(self):
 		rv = self.app.post('/ingest', headers={'Content-Type': 'application/json'}, data=json.dumps([{"id": "@test_id"}]))
 		assert rv.status_code == 400
@@ -242,6 +1105,93 @@ class EmbedTestCase(unittest.TestCase):
 		assert rv.status_code == 400
 		assert '''{"errors": ["The item num. 0 has status, but it isn't set to 'deleted' or there are more fields"]}''' in rv.data
 
+	def test_validator0(self):
+		urls = ['http://unittest_url.org', 'HTTPS://unittest_url.org/a', 'http://', 'http://a', 'http://ab', 'http://a.', 'www.unittest_url.org', 'www123.a/', 'www1234.ab', 'unittest_url.org/', 'unittest_url.org/a', 'a.org/b', '.org/b', 'a.o/b', 'a.abcde/b',
+			'http://en.wikipedia.org/wiki/Foo_(bar)', 'http://a.org/(b(c)d)', 'http://a.org/(b(c))x', 'http://(a)', 'http://(a)(', 'http://a(b', 'http://a((b))', 'http://a()', 'http://a.org/b!', 'http://a.org/b.c', 'http://a b', ' http://a.org', '(http://a.org)', 'test',
+			'', 'http://a\xab', u'http://a\u201c', u'http://a\u0161', 'http://\xe1', 'http://a\t\xa0', 123, None]
+		
+		for url in urls:
+			assert isUrl(url) == (isinstance(url, basestring) and bool(url_regular.match(url))), url
+		
+		# random strings of parts of urls have to be validated as by the regex
+		random.seed(0)
+		parts = list(u'htpsw:/.()<>!? a1_-[\t\xab\u201c') + [u'http://', u'www1.', u'.org/', u'(a)']
+		
+		for i in range(20000):
+			url = u''.join(random.choice(parts) for j in range(random.randint(1, 8)))
+			assert isUrl(url) == bool(url_regular.match(url)), url
+		
+		# the regex backtracks exponentially on such urls, time of their validation has to grow linearly with their length
+		def validate(n):
+			assert not isUrl('http://' + '!' * n)
+			assert not isUrl('www.' + '.' * n + '(a')
+			assert isUrl('unittest-url.org/' + '!' * n + 'a')
+		
+		def duration(n):
+			durations = []
+			
+			for i in range(3):
+				start = time.time()
+				validate(n)
+				durations.append(time.time() - start)
+			
+			return min(durations)
+		
+		# 4 times longer urls take 4 times longer, 16 times if the time grew quadratically
+		assert duration(200000) < 10 * duration(50000)
+
+	def test_sanitize0(self):
+		institutions = ['<b>Rijksmuseum</b>', 'Museum <script>alert(1)</script>', 'Museum &amp; Gallery']
+		batch_data = [{'id': 'test_id%s' % i, 'url': ['http://unittest_url.org'], 'title': '<i>Title %s</i>' % (i % 7), 'institution': institutions[i % 3], 'description': '<b>Bold</b> <a href="x">link</a> <i>%s</i>' % (i % 5)} for i in range(300)]
+		batch_data.append({'id': 'test_id_deleted', 'status': 'deleted'})
+		expected = [dict((k, bleach.clean(v, tags=ALLOWED_TAGS if k == 'description' else [], attributes=[], styles=[], strip=True) if k in ['title', 'institution', 'description'] else v) for k, v in item.items()) for item in batch_data]
+		
+		# every distinct value is sanitized only once
+		cache = LRUCache(100)
+		sanitizeItems(batch_data, cache)
+		assert batch_data == expected
+		assert cache.misses == 15 and cache.hits == 0
+		
+		# title and institution are sanitized by the same rules
+		batch_data = [{'id': 'test_id', 'url': ['http://unittest_url.org'], 'title': '<b>Rijksmuseum</b>', 'creator': '<b>Rijksmuseum</b>'}]
+		sanitizeItems(batch_data, cache)
+		assert batch_data[0]['title'] == batch_data[0]['creator'] == 'Rijksmuseum'
+		assert cache.hits == 1
+		
+		batch_data = [dict(item, title='<i>%s</i>' % item['id']) for item in expected[:-1]]
+		expected = [dict(item, title=item['id']) for item in expected[:-1]]
+		pool = multiprocessing.Pool(2)
+		
+		try:
+			sanitize.SANITIZE_POOL_MIN = 100
+			sanitizeItems(batch_data, LRUCache(1000), pool)
+			assert batch_data == expected
+		finally:
+			sanitize.SANITIZE_POOL_MIN = 200
+			pool.terminate()
+		
+		with self.db.pipeline() as pipe:
+			processBatchItems(1, [{'id': 'test_id', 'url': ['http://unittest_url.org'], 'title': '<b>Title</b>', 'description': '<b>Bold</b><br>'}], 0, pipe, LRUCache(100))
+		
+		assert Task(1, 'test_id', 0).item_data['title'] == 'Title'
+		assert Task(1, 'test_id', 0).item_data['description'] == '<b>Bold</b>'
+		
+		# the cache is bounded by memory taken by sanitized values
+		cache = LRUCache(20000, sizeof=sanitizedSize)
+		sanitizeItems([{'id': 'test_id%s' % i, 'url': ['http://unittest_url.org'], 'description': '<b>%s</b>' % (str(i) * 100)} for i in range(100)], cache)
+		assert 0 < cache.size <= 20000 and cache.size == sum(sanitizedSize(key, value[0]) for key, value in cache.data.items())
+		assert len(cache.data) < 100
+		
+		# the pool is started with the application, before its threads
+		os.environ['SANITIZE_PROCESSES'] = '1'
+		
+		try:
+			app = app_factory(fakeredis.FakeStrictRedis())
+			assert sanitize.sanitizeValue((False, '<b>a</b>')) == app.extensions['sanitize_pool'].apply(sanitize.sanitizeValue, [(False, '<b>a</b>')])
+			app.extensions['sanitize_pool'].terminate()
+		finally:
+			del os.environ['SANITIZE_PROCESSES']
+
 if __name__ == '__main__':
 	logging.basicConfig(filename="logfile.txt")
 	logging.getLogger( "EmbedTestCase.test_oEmbed2" ).setLevel( logging.DEBUG )